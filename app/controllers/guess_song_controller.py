@@ -1,50 +1,90 @@
-import os
+import time
 
 from typing import Union
 from termcolor import colored
 
-from core.audio_processing import *
+from core.analysis_profile import get_catalog_profile
 from core.audio_capture import AudioCapture
 from core.database import FingerprintsDatabase
-from utils.audio_utils import *
+from core.identification import identify_stream, fingerprint_query, match_fingerprint
+from core.metrics import span, increment, observe, write_metrics
+from utils.audio_utils import load_pcm
 
 
-def process_identify_song() -> Union[dict, None]:
-    """Identify a song from an audio sample."""
+def process_identify_song(streaming: bool = True) -> Union[dict, None]:
+    """
+    Identify a song from an audio sample.
 
-    file_path = "data/recordings/temp.wav"
+    With `streaming`, the recording is matched every second while it goes on, and stops as soon
+    as a candidate stands out (at most after the full recording duration). Otherwise, the whole
+    recording is captured before being processed.
+    """
 
     audio_capture = AudioCapture()
+    start_time = time.perf_counter()
+
+    with FingerprintsDatabase() as db:
+        if streaming:
+            matches, listened = identify_stream(
+                audio_capture.stream(),
+                sr=audio_capture.sample_rate,
+                max_duration=audio_capture.duration,
+                db=db,
+            )
 
-    audio_capture.start_recording()
-
-    audio_capture.record_to_file(file_path)
+        else:
+            with span("record", path="identify"):
+                samples = audio_capture.record()
+
+            profile = get_catalog_profile(db)
+            with span("load_audio", path="identify"):
+                audio_data, sampling_rate = load_pcm(
+                    samples,
+                    audio_capture.sample_rate,
+                    sr=profile.sampling_rate,
+                    channels=audio_capture.channels,
+                )
+            listened = len(audio_data) / sampling_rate
 
-    audio_data, sampling_rate = load_audio(file_path=file_path)
+            print(colored("Processing audio...", color="yellow"))
+            fingerprint = fingerprint_query(audio_data, sampling_rate, profile)
 
-    print(colored("Processing audio...", color="yellow"))
-    spectrogram, freqs, times = create_spectrogram(y=audio_data, sr=sampling_rate)
-    peaks = get_peaks(spectrogram=spectrogram, amp_thres=-50, neighborhood_size=100)
-    fingerprint = create_fingerprint(peaks, freqs, times, fan_value=150)
+            if fingerprint.check_empty():
+                print(colored("No fingerprint detected...", color="red", attrs=["bold"]))
+                increment("identifications_total", result="no_fingerprint")
+                write_metrics()
+                return None
 
-    os.remove(file_path)
+            matches = match_fingerprint(fingerprint, db=db)
 
-    if not fingerprint.check_empty():
-        with FingerprintsDatabase() as db:
-            song_title = db.identify_song(fingerprint)
+        time_to_answer = time.perf_counter() - start_time
+        observe("time_to_answer_seconds", time_to_answer, streaming=str(streaming).lower())
+        observe("listened_seconds", listened, streaming=str(streaming).lower())
 
-        if not song_title:
+        if not matches:
             print(colored("No song detected...", color="red", attrs=["bold"]))
-
-        else:
-            print(
-                colored(
-                    f"Song identified : {song_title}", color="green", attrs=["bold"]
-                )
+            increment("identifications_total", result="not_found")
+            write_metrics()
+            return None
+
+        best_match = matches[0]
+        print(
+            colored(
+                f"Song identified : {best_match.get_song_id()} "
+                f"(score {best_match.get_score()}, margin {best_match.get_margin()}) "
+                f"in {time_to_answer:.1f} s ({listened:.1f} s of audio)",
+                color="green",
+                attrs=["bold"],
             )
+        )
+
+        with span("metadata", path="identify"):
+            song_details = db.get_song_details_by_id(best_match.get_song_id())
+
+    increment("identifications_total", result="found")
+    write_metrics()
 
-            with FingerprintsDatabase() as db:
-                return db.get_song_details(song_title)
+    if song_details:
+        song_details["time_to_answer"] = time_to_answer
 
-    else:
-        print(colored("No fingerprint detected...", color="red", attrs=["bold"]))
+    return song_details
@@ -7,7 +7,7 @@ from typing import Dict, List, Any
 import streamlit as st
 
 sys.path.append("core")
-from core.store_songs import process_audio_file
+from core.store_songs import store_audio_files, DEFAULT_WORKERS, DEFAULT_BATCH_SIZE
 
 # Regular expression for validating URLs
 URL_REGEX = re.compile(
@@ -166,13 +166,20 @@ def check_metadata(metadata: Dict[str, Any], file_name: str) -> bool:
     return is_valid_url(cover_url) and is_valid_url(video_url)
 
 
-def store_audio_folder(folder_path: str = "data/audio", verbose: int = 1):
+def store_audio_folder(
+    folder_path: str = "data/audio",
+    verbose: int = 1,
+    workers: int = DEFAULT_WORKERS,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+):
     """
     Process all audio files in a folder and store them in a database.
 
     Args:
         folder_path (str): The folder where audio files are stored.
         verbose (int): The verbosity level, to control log messages.
+        workers (int): The number of worker processes computing fingerprints in parallel.
+        batch_size (int): The number of songs written to the database per transaction.
     """
 
     audio_files = [
@@ -186,18 +193,24 @@ def store_audio_folder(folder_path: str = "data/audio", verbose: int = 1):
         st.warning("No audio files found in the specified folder.")
         return
 
-    with st.expander("Processing audio files..."):
-        for i, file_name in enumerate(audio_files):
-            if verbose:
-                print(f"Processing file : {file_name}")
-
-            progress = (i + 1) / total_files
-            my_bar.progress(
-                progress, text=f"Processing {file_name} ({i + 1}/{total_files})"
-            )
+    def update_progress(done: int, total: int, file_name: str):
+        my_bar.progress(done / total, text=f"Processing {file_name} ({done}/{total})")
 
-            process_audio_file(
-                file_name, folder_path, store_in_db=True, verbose=verbose
-            )
-
-        st.success("All audio files have been processed and stored successfully !")
+    with st.expander("Processing audio files..."):
+        result = store_audio_files(
+            audio_files,
+            folder_path,
+            workers=workers,
+            batch_size=batch_size,
+            progress_callback=update_progress,
+            verbose=verbose,
+        )
+
+        if result["skipped"]:
+            st.info(f"{len(result['skipped'])} audio files were already indexed and skipped.")
+
+        for file_name, error in result["failed"].items():
+            st.error(f"{file_name} could not be stored : {error}")
+
+        if not result["failed"]:
+            st.success("All audio files have been processed and stored successfully !")
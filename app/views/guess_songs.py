@@ -11,7 +11,7 @@ def identify_song():
     if st.button("Identify song"):
         result = process_identify_song()
         if result:
-            st.success(f"Song identified !")
+            st.success(f"Song identified in {result['time_to_answer']:.1f} s !")
 
             cover_column, details_column = st.columns([1, 1])
 
@@ -23,7 +23,7 @@ def identify_song():
 
             with details_column:
                 st.write(f"Title : {result['title']}")
-                st.write(f"Artist : {result['artist']}")
+                st.write(f"Artist : {result['artists']}")
                 st.write(f"Album : {result['album']}")
 
             try:
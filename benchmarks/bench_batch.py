@@ -0,0 +1,94 @@
+"""
+Benchmark of batch identification: one matching pass per batch of queries against one per query.
+
+The catalog and the queries are synthetic, as in bench_index.py. With --matcher postgres, the
+catalog is inserted into the PostgreSQL database configured through the usual POSTGRES_*
+environment variables, and deleted at the end of the run.
+
+Usage :
+    python benchmarks/bench_batch.py [--matcher memory] [--songs 200] [--queries 512]
+        [--batch-sizes 1,16,64,256]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_index import synthesize_catalog, make_query
+from core.audio_processing import fingerprint_from_hashes
+from core.fingerprint_index import FingerprintIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--matcher", choices=["memory", "postgres"], default="memory")
+    parser.add_argument("--songs", type=int, default=200)
+    parser.add_argument("--hashes-per-song", type=int, default=38000)
+    parser.add_argument("--queries", type=int, default=512)
+    parser.add_argument(
+        "--batch-sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[1, 16, 64, 256],
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    hashes, song_ids, offsets = synthesize_catalog(rng, args.songs, args.hashes_per_song)
+    expected = rng.integers(1, args.songs + 1, args.queries)
+    queries = [make_query(rng, hashes, song_ids, offsets, int(song_id)) for song_id in expected]
+
+    db, database_ids = None, []
+    if args.matcher == "postgres":
+        from core.database import FingerprintsDatabase
+
+        db = FingerprintsDatabase().__enter__()
+        db.setup()
+        for song_id in range(1, args.songs + 1):
+            song = song_ids == song_id
+            fingerprint = fingerprint_from_hashes(hashes[song], offsets[song])
+            with db.transaction():
+                fingerprint.set_song_id(db.insert_song({"title": f"benchmark-batch-{song_id}"}))
+                db.insert_fingerprint(fingerprint)
+            database_ids.append(fingerprint.get_song_id())
+        db.execute_query("ANALYZE fingerprints")
+        matcher = db
+        expected = np.array(database_ids)[expected - 1]
+    else:
+        matcher = FingerprintIndex.from_arrays(hashes, song_ids, offsets)
+
+    try:
+        reference = None
+        for batch_size in args.batch_sizes:
+            start = time.perf_counter()
+            results = []
+            for first in range(0, args.queries, batch_size):
+                batch = queries[first : first + batch_size]
+                if batch_size == 1:
+                    results.append(matcher.identify_song(batch[0]))
+                else:
+                    results += matcher.identify_songs_batch(batch)
+            elapsed = time.perf_counter() - start
+
+            correct = sum(
+                bool(matches) and matches[0].get_song_id() == song_id
+                for matches, song_id in zip(results, expected)
+            )
+            reference = reference or elapsed
+            print(
+                f"Batch size {batch_size:>4} : {args.queries / elapsed:8.1f} queries/s, "
+                f"{elapsed / args.queries * 1000:7.2f} ms/query ({reference / elapsed:.1f}x), "
+                f"top-1 accuracy {correct / args.queries:.0%}"
+            )
+    finally:
+        if db is not None:
+            for song_id in database_ids:
+                db.delete_song(song_id)
+            db.__exit__(None, None, None)
+
+
+if __name__ == "__main__":
+    main()
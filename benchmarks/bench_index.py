@@ -0,0 +1,98 @@
+"""
+Benchmark of the in-memory fingerprint index on a synthetic catalog.
+
+Songs are made of random hashes whose frequency bins and time deltas follow the skewed
+distribution of real fingerprints. Queries are 10-second excerpts of catalog songs,
+with part of their hashes replaced by noise.
+
+Usage :
+    python benchmarks/bench_index.py [--songs 1000] [--hashes-per-song 38000] [--queries 50]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core.audio_processing import pack_hashes
+from core.fingerprint_index import FingerprintIndex
+
+# Number of spectrogram frames in 10 seconds of audio (hop of 2048 samples at 22050 Hz)
+FRAMES_PER_10_SECONDS = 108
+
+# Length of a song in frames (4 minutes)
+FRAMES_PER_SONG = 2584
+
+
+def random_hashes(rng: np.random.Generator, size: int) -> np.ndarray:
+    anchor_freqs = np.minimum(rng.exponential(300, size), 2048)
+    target_freqs = np.minimum(rng.exponential(300, size), 2048)
+    time_deltas = np.minimum(rng.exponential(30, size), 2000)
+    return pack_hashes(anchor_freqs, target_freqs, time_deltas)
+
+
+def synthesize_catalog(rng: np.random.Generator, nb_songs: int, hashes_per_song: int):
+    size = nb_songs * hashes_per_song
+    hashes = random_hashes(rng, size)
+    song_ids = np.repeat(np.arange(1, nb_songs + 1, dtype=np.int32), hashes_per_song)
+    offsets = rng.integers(0, FRAMES_PER_SONG, size, dtype=np.int32)
+    return hashes, song_ids, offsets
+
+
+def make_query(rng, hashes, song_ids, offsets, song_id: int, noise_ratio: float = 0.5):
+    """10-second excerpt of a catalog song, with `noise_ratio` of its hashes replaced by noise."""
+    start = rng.integers(0, FRAMES_PER_SONG - FRAMES_PER_10_SECONDS)
+    excerpt = np.flatnonzero(
+        (song_ids == song_id)
+        & (offsets >= start)
+        & (offsets < start + FRAMES_PER_10_SECONDS)
+    )
+    query_hashes = hashes[excerpt].copy()
+    noisy = rng.random(len(excerpt)) < noise_ratio
+    query_hashes[noisy] = random_hashes(rng, noisy.sum())
+    return list(zip(query_hashes.tolist(), (offsets[excerpt] - start).tolist()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--songs", type=int, default=1000)
+    parser.add_argument("--hashes-per-song", type=int, default=38000)
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    hashes, song_ids, offsets = synthesize_catalog(
+        rng, args.songs, args.hashes_per_song
+    )
+
+    start = time.perf_counter()
+    index = FingerprintIndex.from_arrays(hashes, song_ids, offsets)
+    print(
+        f"Catalog : {args.songs} songs, {len(index)} postings, "
+        f"built in {time.perf_counter() - start:.1f} s"
+    )
+
+    timings, correct, nb_hashes = [], 0, []
+    for _ in range(args.queries):
+        song_id = int(rng.integers(1, args.songs + 1))
+        query = make_query(rng, hashes, song_ids, offsets, song_id)
+        nb_hashes.append(len(query))
+
+        start = time.perf_counter()
+        matches = index.identify_song(query)
+        timings.append(time.perf_counter() - start)
+        correct += bool(matches) and matches[0].get_song_id() == song_id
+
+    timings = np.array(timings) * 1000
+    print(
+        f"Queries : {args.queries} x ~{int(np.mean(nb_hashes))} hashes, "
+        f"median {np.median(timings):.2f} ms, p95 {np.percentile(timings, 95):.2f} ms, "
+        f"top-1 accuracy {correct / args.queries:.0%}"
+    )
+
+
+if __name__ == "__main__":
+    main()
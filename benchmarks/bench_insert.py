@@ -0,0 +1,84 @@
+"""
+Benchmark of fingerprint insertion: per-row INSERT and commit against the single-transaction COPY path.
+
+Requires a PostgreSQL database configured through the usual POSTGRES_* environment variables.
+The songs inserted by the benchmark are deleted at the end of the run.
+
+Usage :
+    python benchmarks/bench_insert.py [--songs 10] [--legacy-songs 1]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_fingerprint import synthesize_track, SAMPLING_RATE
+from core.database import FingerprintsDatabase
+from core.audio_processing import (
+    create_spectrogram,
+    get_peaks,
+    create_fingerprint,
+    store_fingerprint,
+)
+
+
+def compute_fingerprint(seed: int):
+    y = synthesize_track(240, seed=seed)
+    spectrogram, freqs, times = create_spectrogram(y=y, sr=SAMPLING_RATE)
+    peaks = get_peaks(spectrogram=spectrogram)
+    return create_fingerprint(peaks, freqs, times)
+
+
+def legacy_store(db: FingerprintsDatabase, song_details: dict, fingerprint) -> int:
+    """The original storage path : one INSERT and one commit per hash pair."""
+    song_id = db.insert_song(song_details)
+    for hash_value, offset in fingerprint:
+        db.insert(
+            "fingerprints", {"song_id": song_id, "hash": hash_value, "offset": offset}
+        )
+    return song_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--songs", type=int, default=10, help="Songs stored with COPY.")
+    parser.add_argument(
+        "--legacy-songs", type=int, default=1, help="Songs stored row by row."
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    fingerprints = [compute_fingerprint(seed) for seed in range(args.songs)]
+    compute_time = (time.perf_counter() - start) / args.songs
+    nb_hashes = sum(len(fingerprint) for fingerprint in fingerprints) // args.songs
+    print(f"Fingerprinting : {60 / compute_time:.1f} songs/min ({nb_hashes} hashes/song)")
+
+    song_ids = {legacy_store: [], store_fingerprint: []}
+    with FingerprintsDatabase() as db:
+        db.setup()
+        try:
+            for label, store, count in [
+                ("Row by row", legacy_store, args.legacy_songs),
+                ("Single COPY", store_fingerprint, args.songs),
+            ]:
+                start = time.perf_counter()
+                for i, fingerprint in enumerate(fingerprints[:count]):
+                    song_details = {"title": f"benchmark-{label}-{i}"}
+                    song_ids[store].append(store(db, song_details, fingerprint))
+                elapsed = (time.perf_counter() - start) / count
+                print(f"{label:<12} : {60 / elapsed:8.1f} songs/min")
+        finally:
+            # Songs stored row by row are not counted in the hash statistics
+            legacy_ids = song_ids[legacy_store]
+            db.execute_query(
+                "DELETE FROM fingerprints WHERE song_id = ANY(%s)", (legacy_ids,)
+            )
+            db.execute_query("DELETE FROM songs WHERE id = ANY(%s)", (legacy_ids,))
+            for song_id in song_ids[store_fingerprint]:
+                db.delete_song(song_id)
+
+
+if __name__ == "__main__":
+    main()
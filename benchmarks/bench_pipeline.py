@@ -0,0 +1,358 @@
+"""
+Benchmark suite of the fingerprint pipeline and the matcher, runnable offline.
+
+Reference tracks are synthesized (or loaded from --songs-dir) and fingerprinted with the catalog
+parameters. Queries are excerpts of them, clean, with added noise or clipped, and fingerprinted
+with the query parameters. Every stage (spectrogram, peaks, hashes, matching) is timed separately,
+and end-to-end identification latency and recall are measured at several catalog sizes, catalogs
+being completed with random filler songs. The matcher is the in-memory index by default, or a
+PostgreSQL database (--matcher postgres, the songs inserted by the run are deleted at the end).
+
+Results are written as JSON, and can be compared with a previous run used as baseline.
+
+Usage :
+    python benchmarks/bench_pipeline.py [--tracks 20] [--catalog-sizes 20,200,1000] [--queries 30]
+        [--matcher memory] [--output results.json] [--baseline baseline.json] [--tolerance 0.1]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+from typing import Callable, Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_fingerprint import synthesize_track, SAMPLING_RATE
+from bench_index import random_hashes, FRAMES_PER_SONG
+from core.audio_processing import (
+    create_spectrogram,
+    get_peaks,
+    create_fingerprint,
+    fingerprint_from_hashes,
+)
+from core.fingerprint_index import FingerprintIndex
+from core.identification import (
+    QUERY_AMPLITUDE_THRESHOLD,
+    QUERY_NEIGHBORHOOD_SIZE,
+    QUERY_FAN_VALUE,
+)
+
+# Degradations applied to the query excerpts
+CONDITIONS = ["clean", "noisy", "clipped"]
+
+# Timing changes smaller than this (in ms) are measurement noise, never reported as regressions
+NOISE_FLOOR_MS = 1.0
+
+
+def degrade(y: np.ndarray, condition: str, rng: np.random.Generator, snr_db: float) -> np.ndarray:
+    """Applies a degradation to a query excerpt."""
+    if condition == "noisy":
+        noise_power = np.mean(y**2) / 10 ** (snr_db / 10)
+        return y + rng.normal(0, np.sqrt(noise_power), len(y)).astype(np.float32)
+    if condition == "clipped":
+        return np.clip(4 * y, -0.5, 0.5)
+    return y
+
+
+def fingerprint_stages(y: np.ndarray, stages: Dict[str, list], query: bool = False):
+    """Fingerprints a signal with the catalog or query parameters, timing each stage."""
+    peaks_params = (
+        {"neighborhood_size": QUERY_NEIGHBORHOOD_SIZE, "amp_thres": QUERY_AMPLITUDE_THRESHOLD}
+        if query
+        else {}
+    )
+    fan_params = {"fan_value": QUERY_FAN_VALUE} if query else {}
+
+    start = time.perf_counter()
+    spectrogram, freqs, times = create_spectrogram(y=y, sr=SAMPLING_RATE)
+    stages["spectrogram"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    peaks = get_peaks(spectrogram=spectrogram, **peaks_params)
+    stages["peaks"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    fingerprint = create_fingerprint(peaks, freqs, times, **fan_params)
+    stages["hashes"].append(time.perf_counter() - start)
+
+    return fingerprint
+
+
+def summarize(timings: List[float]) -> dict:
+    timings = np.array(timings) * 1000
+    return {
+        "median_ms": round(float(np.median(timings)), 3),
+        "p95_ms": round(float(np.percentile(timings, 95)), 3),
+    }
+
+
+def load_tracks(args) -> List[np.ndarray]:
+    if args.songs_dir:
+        from utils.audio_utils import load_audio
+
+        file_names = sorted(
+            f for f in os.listdir(args.songs_dir) if f.endswith((".mp3", ".wav", ".flac"))
+        )[: args.tracks]
+        return [
+            load_audio(os.path.join(args.songs_dir, f), sr=SAMPLING_RATE)[0] for f in file_names
+        ]
+
+    return [
+        synthesize_track(args.track_duration, seed=seed) for seed in range(args.tracks)
+    ]
+
+
+class MemoryMatcher:
+    """Catalog served by the in-memory index."""
+
+    def __init__(self):
+        self.columns = []
+
+    def add(self, song_id: int, hashes: np.ndarray, offsets: np.ndarray):
+        self.columns.append(
+            (hashes, np.full(len(hashes), song_id, dtype=np.int32), offsets.astype(np.int32))
+        )
+
+    def build(self):
+        hashes, song_ids, offsets = map(np.concatenate, zip(*self.columns))
+        self.index = FingerprintIndex.from_arrays(hashes, song_ids, offsets)
+        return len(self.index)
+
+    def identify(self, fingerprint):
+        return self.index.identify_song(fingerprint)
+
+    def close(self):
+        pass
+
+
+class PostgresMatcher:
+    """Catalog stored in the PostgreSQL database of the POSTGRES_* environment variables."""
+
+    def __init__(self):
+        from core.database import FingerprintsDatabase
+
+        self.db = FingerprintsDatabase().__enter__()
+        self.db.setup()
+        self.song_ids = {}
+        self.nb_postings = 0
+
+    def add(self, song_id: int, hashes: np.ndarray, offsets: np.ndarray):
+        fingerprint = fingerprint_from_hashes(hashes, offsets)
+        with self.db.transaction():
+            fingerprint.set_song_id(self.db.insert_song({"title": f"benchmark-{song_id}"}))
+            self.db.insert_fingerprint(fingerprint)
+        self.song_ids[song_id] = fingerprint.get_song_id()
+        self.nb_postings += len(hashes)
+
+    def build(self):
+        self.db.execute_query("ANALYZE fingerprints")
+        return self.nb_postings
+
+    def identify(self, fingerprint):
+        matches = self.db.identify_song(fingerprint)
+        database_ids = {v: k for k, v in self.song_ids.items()}
+        for match in matches:
+            match.song_id = database_ids.get(match.song_id, -1)
+        return matches
+
+    def close(self):
+        for song_id in self.song_ids.values():
+            self.db.delete_song(song_id)
+        self.db.__exit__(None, None, None)
+
+
+def run(args) -> dict:
+    rng = np.random.default_rng(args.seed)
+    tracks = load_tracks(args)
+
+    # Catalog fingerprints of the reference tracks
+    ingest_stages = {"spectrogram": [], "peaks": [], "hashes": []}
+    references = []
+    for y in tracks:
+        references.append(fingerprint_stages(y, ingest_stages).get_arrays())
+    hashes_per_song = int(np.mean([len(hashes) for hashes, _ in references]))
+
+    # Queries : excerpts of the reference tracks, fingerprinted once per condition, with the time
+    # each one took to fingerprint
+    query_length = int(args.query_duration * SAMPLING_RATE)
+    query_stages = {"spectrogram": [], "peaks": [], "hashes": []}
+    queries = {condition: [] for condition in CONDITIONS}
+    for _ in range(args.queries):
+        track = int(rng.integers(len(tracks)))
+        start = int(rng.integers(0, max(1, len(tracks[track]) - query_length)))
+        excerpt = tracks[track][start : start + query_length]
+        for condition in CONDITIONS:
+            y = degrade(excerpt, condition, rng, args.snr)
+            fingerprint_start = time.perf_counter()
+            fingerprint = fingerprint_stages(y, query_stages, query=True)
+            fingerprint_time = time.perf_counter() - fingerprint_start
+            queries[condition].append((track + 1, fingerprint, fingerprint_time))
+
+    results = {
+        "config": {
+            **{key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "stages": {
+            "ingest": {stage: summarize(t) for stage, t in ingest_stages.items()},
+            "query": {stage: summarize(t) for stage, t in query_stages.items()},
+        },
+        "hashes_per_song": hashes_per_song,
+        "catalogs": [],
+    }
+
+    matcher = PostgresMatcher() if args.matcher == "postgres" else MemoryMatcher()
+    try:
+        for song_id, (hashes, offsets) in enumerate(references, 1):
+            matcher.add(song_id, hashes, offsets)
+        nb_songs = len(references)
+
+        for catalog_size in sorted(args.catalog_sizes):
+            # Complete the catalog with filler songs made of random hashes
+            for song_id in range(nb_songs + 1, catalog_size + 1):
+                matcher.add(
+                    song_id,
+                    random_hashes(rng, hashes_per_song),
+                    rng.integers(0, FRAMES_PER_SONG, hashes_per_song, dtype=np.int32),
+                )
+            nb_songs = max(nb_songs, catalog_size)
+
+            start = time.perf_counter()
+            nb_postings = matcher.build()
+            build_time = time.perf_counter() - start
+
+            catalog = {
+                "songs": nb_songs,
+                "postings": nb_postings,
+                "build_s": round(build_time, 3),
+                "conditions": {},
+            }
+            for condition, condition_queries in queries.items():
+                timings, end_to_end, found = [], [], 0
+                for song_id, fingerprint, fingerprint_time in condition_queries:
+                    start = time.perf_counter()
+                    matches = matcher.identify(fingerprint) if len(fingerprint) else []
+                    timings.append(time.perf_counter() - start)
+                    found += bool(matches) and matches[0].get_song_id() == song_id
+
+                    # End-to-end latency : fingerprinting and matching of this excerpt
+                    end_to_end.append(fingerprint_time + timings[-1])
+
+                catalog["conditions"][condition] = {
+                    "recall": round(found / len(condition_queries), 4),
+                    "match": summarize(timings),
+                    "end_to_end": summarize(end_to_end),
+                }
+            results["catalogs"].append(catalog)
+    finally:
+        matcher.close()
+
+    return results
+
+
+def flatten(results: dict, prefix: str = "") -> Dict[str, float]:
+    """Numeric metrics of a result tree, by path ("catalogs.0.conditions.clean.recall"...)."""
+    items = results.items() if isinstance(results, dict) else enumerate(results)
+    metrics = {}
+    for key, value in items:
+        path = f"{prefix}{key}"
+        if isinstance(value, (dict, list)):
+            metrics.update(flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[path] = value
+    return metrics
+
+
+def compare(results: dict, baseline: dict, tolerance: float, report: Callable = print) -> bool:
+    """
+    Compares the timings (lower is better) and recalls (higher is better) of two runs, printing
+    the change of each metric.
+
+    :return: True if no metric regressed by more than `tolerance` (relative change).
+    """
+    current, reference = flatten(results), flatten(baseline)
+    ok = True
+
+    for path, value in current.items():
+        if path.startswith("config.") or path not in reference:
+            continue
+        if not (path.endswith("_ms") or path.endswith("_s") or path.endswith("recall")):
+            continue
+
+        old = reference[path]
+        change = (value - old) / old if old else 0.0
+        higher_is_better = path.endswith("recall")
+        if higher_is_better:
+            regressed = -change > tolerance
+        else:
+            delta_ms = (value - old) * (1000 if path.endswith("_s") else 1)
+            regressed = change > tolerance and delta_ms > NOISE_FLOOR_MS
+        ok &= not regressed
+
+        report(
+            f"{'REGRESSION ' if regressed else '           '}{path:<55} "
+            f"{old:>10.3f} -> {value:>10.3f} ({change:+.1%})"
+        )
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tracks", type=int, default=20, help="Reference tracks.")
+    parser.add_argument("--track-duration", type=float, default=60, help="Synthetic track length (s).")
+    parser.add_argument("--songs-dir", help="Load reference tracks from this folder instead.")
+    parser.add_argument(
+        "--catalog-sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[20, 200, 1000],
+        help="Comma-separated catalog sizes (songs).",
+    )
+    parser.add_argument("--queries", type=int, default=30, help="Queries per condition.")
+    parser.add_argument("--query-duration", type=float, default=10, help="Query length (s).")
+    parser.add_argument("--snr", type=float, default=5, help="SNR of noisy queries (dB).")
+    parser.add_argument("--matcher", choices=["memory", "postgres"], default="memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare the results with this JSON file.")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="Relative change counted as a regression."
+    )
+    args = parser.parse_args()
+
+    results = run(args)
+
+    for phase, stages in results["stages"].items():
+        print(
+            f"{phase:<7}: "
+            + ", ".join(f"{stage} {t['median_ms']:.1f} ms" for stage, t in stages.items())
+        )
+    for catalog in results["catalogs"]:
+        print(
+            f"{catalog['songs']:>7} songs ({catalog['postings']} postings) : "
+            + ", ".join(
+                f"{condition} recall {c['recall']:.0%} / {c['end_to_end']['median_ms']:.1f} ms"
+                for condition, c in catalog["conditions"].items()
+            )
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
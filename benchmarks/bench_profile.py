@@ -0,0 +1,184 @@
+"""
+Benchmark of the analysis profiles : cost of each stage of the fingerprint pipeline, and recall.
+
+Reference tracks are synthesized at 44.1 kHz, as decoded from a CD-quality file, then for each profile
+resampled to its rate ("decode" stage, with SciPy's polyphase resampler standing in for the
+decoder's), fingerprinted with the catalog parameters, and stored in an in-memory index completed
+with random filler songs. Queries are excerpts of the 44.1 kHz tracks, clean, with added noise or
+clipped, resampled and fingerprinted with the query parameters of the same profile. The query
+parameters only pick a few peaks per excerpt : with --dense-queries, queries are fingerprinted with
+the catalog parameters instead, to compare the profiles on short and noisy excerpts.
+
+Usage :
+    python benchmarks/bench_profile.py [--profiles standard,reduced,narrowband] [--tracks 20]
+        [--queries 30] [--catalog-size 500] [--dense-queries --query-duration 3 --snr -10]
+"""
+
+import os
+import sys
+import time
+import argparse
+from math import gcd
+from typing import Dict
+
+import numpy as np
+from scipy.signal import resample_poly
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_fingerprint import synthesize_track
+from bench_index import random_hashes, FRAMES_PER_SONG
+from bench_pipeline import degrade, CONDITIONS
+from core.analysis_profile import AnalysisProfile, PROFILES
+from core.audio_processing import create_spectrogram, get_peaks, create_fingerprint
+from core.fingerprint_index import FingerprintIndex
+from core.identification import (
+    QUERY_AMPLITUDE_THRESHOLD,
+    QUERY_NEIGHBORHOOD_SIZE,
+    QUERY_FAN_VALUE,
+)
+
+# Sampling rate (in Hz) of the synthesized source tracks.
+SOURCE_SAMPLING_RATE = 44100
+
+STAGES = ["decode", "spectrogram", "peaks", "hashes"]
+
+
+def resample(y: np.ndarray, sr: int) -> np.ndarray:
+    """Resamples a source track to `sr`."""
+    divisor = gcd(SOURCE_SAMPLING_RATE, sr)
+    return resample_poly(y, sr // divisor, SOURCE_SAMPLING_RATE // divisor).astype(np.float32)
+
+
+def fingerprint_stages(
+    y: np.ndarray, profile: AnalysisProfile, stages: Dict[str, list], query: bool = False
+):
+    """Resamples and fingerprints a source signal with a profile, timing each stage."""
+    peaks_params = (
+        {"neighborhood_size": QUERY_NEIGHBORHOOD_SIZE, "amp_thres": QUERY_AMPLITUDE_THRESHOLD}
+        if query
+        else {}
+    )
+    fan_params = {"fan_value": QUERY_FAN_VALUE} if query else {}
+
+    start = time.perf_counter()
+    y = resample(y, profile.sampling_rate)
+    stages["decode"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    spectrogram, freqs, times = create_spectrogram(
+        y=y, sr=profile.sampling_rate, **profile.get_spectrogram_params()
+    )
+    stages["spectrogram"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    peaks = get_peaks(spectrogram=spectrogram, **peaks_params)
+    stages["peaks"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    fingerprint = create_fingerprint(peaks, freqs, times, **fan_params)
+    stages["hashes"].append(time.perf_counter() - start)
+
+    return fingerprint
+
+
+def run_profile(profile: AnalysisProfile, tracks: list, queries: list, args) -> dict:
+    rng = np.random.default_rng(args.seed)
+
+    ingest_stages = {stage: [] for stage in STAGES}
+    columns = []
+    for song_id, y in enumerate(tracks, 1):
+        hashes, offsets = fingerprint_stages(y, profile, ingest_stages).get_arrays()
+        columns.append((hashes, np.full(len(hashes), song_id, dtype=np.int32), offsets))
+    hashes_per_song = int(np.mean([len(hashes) for hashes, _, _ in columns]))
+
+    for song_id in range(len(tracks) + 1, args.catalog_size + 1):
+        columns.append(
+            (
+                random_hashes(rng, hashes_per_song),
+                np.full(hashes_per_song, song_id, dtype=np.int32),
+                rng.integers(0, FRAMES_PER_SONG, hashes_per_song, dtype=np.int32),
+            )
+        )
+    index = FingerprintIndex.from_arrays(*map(np.concatenate, zip(*columns)))
+
+    query_stages = {stage: [] for stage in STAGES}
+    recall = {}
+    for condition in CONDITIONS:
+        found = 0
+        for song_id, excerpt in queries[condition]:
+            fingerprint = fingerprint_stages(
+                excerpt, profile, query_stages, query=not args.dense_queries
+            )
+            matches = index.identify_song(fingerprint) if len(fingerprint) else []
+            found += bool(matches) and matches[0].get_song_id() == song_id
+        recall[condition] = found / len(queries[condition])
+
+    # Ingest stages are reported per minute of audio, query stages per query
+    minutes = args.track_duration / 60
+    return {
+        "ingest_ms": {s: np.median(t) * 1000 / minutes for s, t in ingest_stages.items()},
+        "query_ms": {s: np.median(t) * 1000 for s, t in query_stages.items()},
+        "hashes_per_song": hashes_per_song,
+        "recall": recall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--profiles",
+        type=lambda value: value.split(","),
+        default=list(PROFILES),
+        help="Comma-separated profiles, the first one being the reference.",
+    )
+    parser.add_argument("--tracks", type=int, default=20, help="Reference tracks.")
+    parser.add_argument("--track-duration", type=float, default=60, help="Track length (s).")
+    parser.add_argument("--queries", type=int, default=30, help="Queries per condition.")
+    parser.add_argument("--query-duration", type=float, default=10, help="Query length (s).")
+    parser.add_argument("--snr", type=float, default=5, help="SNR of noisy queries (dB).")
+    parser.add_argument("--catalog-size", type=int, default=500, help="Songs, with fillers.")
+    parser.add_argument(
+        "--dense-queries", action="store_true", help="Fingerprint queries like catalog songs."
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    tracks = [
+        synthesize_track(args.track_duration, sr=SOURCE_SAMPLING_RATE, seed=seed)
+        for seed in range(args.tracks)
+    ]
+
+    # The same degraded excerpts are used with every profile
+    query_length = int(args.query_duration * SOURCE_SAMPLING_RATE)
+    queries = {condition: [] for condition in CONDITIONS}
+    for _ in range(args.queries):
+        track = int(rng.integers(len(tracks)))
+        start = int(rng.integers(0, max(1, len(tracks[track]) - query_length)))
+        excerpt = tracks[track][start : start + query_length]
+        for condition in CONDITIONS:
+            queries[condition].append((track + 1, degrade(excerpt, condition, rng, args.snr)))
+
+    reference = None
+    for name in args.profiles:
+        results = run_profile(PROFILES[name], tracks, queries, args)
+        ingest_total = sum(results["ingest_ms"].values())
+        query_total = sum(results["query_ms"].values())
+        reference = reference or (ingest_total, query_total)
+
+        print(
+            f"{name:<11} : ingest {ingest_total:7.1f} ms/min ({reference[0] / ingest_total:4.2f}x) "
+            + ", ".join(f"{stage} {t:.1f}" for stage, t in results["ingest_ms"].items())
+        )
+        print(
+            f"{'':<11}   query  {query_total:7.1f} ms     ({reference[1] / query_total:4.2f}x) "
+            + ", ".join(f"{stage} {t:.1f}" for stage, t in results["query_ms"].items())
+        )
+        print(
+            f"{'':<11}   {results['hashes_per_song']} hashes/song, recall "
+            + ", ".join(f"{condition} {r:.0%}" for condition, r in results["recall"].items())
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark of the hash stop-list : matched rows, latency and accuracy per query by threshold.
+
+The catalog and the queries are synthetic, as in bench_index.py, except that a share of the hashes
+of each song is drawn from a small pool of common hashes (silence, hum, drum hits...) with a Zipf
+distribution, so that a few hashes are held by most of the songs. For each threshold, the hashes
+held by more songs are dropped from the catalog and from the queries, as with HASH_MAX_DF, and the
+queries are matched with the in-memory index.
+
+Usage :
+    python benchmarks/bench_stoplist.py [--songs 500] [--queries 200] [--thresholds 0,200,100,50,20]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_index import synthesize_catalog, make_query, random_hashes
+from core.fingerprint_index import FingerprintIndex
+
+
+def document_frequencies(hashes: np.ndarray, song_ids: np.ndarray):
+    """Returns the distinct hashes and the number of songs holding each of them."""
+    pairs = np.unique((hashes << 16) | song_ids.astype(np.int64))
+    return np.unique(pairs >> 16, return_counts=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--songs", type=int, default=500)
+    parser.add_argument("--hashes-per-song", type=int, default=38000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--common-hashes", type=int, default=5000)
+    parser.add_argument("--common-ratio", type=float, default=0.02)
+    parser.add_argument(
+        "--thresholds",
+        type=lambda value: [int(threshold) for threshold in value.split(",")],
+        default=[0, 200, 100, 50, 20],
+        help="Values of HASH_MAX_DF to compare, 0 for no stop-list.",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    hashes, song_ids, offsets = synthesize_catalog(rng, args.songs, args.hashes_per_song)
+
+    common = rng.random(len(hashes)) < args.common_ratio
+    ranks = np.minimum(rng.zipf(2.0, common.sum()), args.common_hashes) - 1
+    hashes[common] = random_hashes(rng, args.common_hashes)[ranks]
+
+    expected = rng.integers(1, args.songs + 1, args.queries)
+    queries = [make_query(rng, hashes, song_ids, offsets, int(song_id)) for song_id in expected]
+
+    # Repeated hash pairs of a song are stored once
+    order = np.lexsort((offsets, hashes, song_ids))
+    song_ids, hashes, offsets = song_ids[order], hashes[order], offsets[order]
+    distinct = np.ones(len(hashes), dtype=bool)
+    distinct[1:] = (
+        (song_ids[1:] != song_ids[:-1])
+        | (hashes[1:] != hashes[:-1])
+        | (offsets[1:] != offsets[:-1])
+    )
+    song_ids, hashes, offsets = song_ids[distinct], hashes[distinct], offsets[distinct]
+
+    unique_hashes, dfs = document_frequencies(hashes, song_ids)
+    print(
+        f"Catalog : {args.songs} songs, {len(hashes)} hash pairs, {len(unique_hashes)} distinct "
+        f"hashes, document frequency median {np.median(dfs):g}, max {dfs.max()}"
+    )
+
+    reference = None
+    for threshold in args.thresholds:
+        stop_list = unique_hashes[dfs > threshold] if threshold else unique_hashes[:0]
+        kept = ~np.isin(hashes, stop_list)
+        index = FingerprintIndex.from_arrays(hashes[kept], song_ids[kept], offsets[kept])
+
+        matched_rows, timings, correct = [], [], 0
+        for query_pairs, song_id in zip(queries, expected):
+            pairs = np.array(query_pairs, dtype=np.int64).reshape(-1, 2)
+            pairs = pairs[~np.isin(pairs[:, 0], stop_list)]
+
+            start = time.perf_counter()
+            matches = index.identify_song(pairs.tolist()) if len(pairs) else []
+            timings.append(time.perf_counter() - start)
+
+            matched_rows.append(len(index.lookup(pairs[:, 0], pairs[:, 1])[0]))
+            correct += bool(matches) and matches[0].get_song_id() == song_id
+
+        mean_rows = np.mean(matched_rows)
+        reference = reference or mean_rows
+        label = f"HASH_MAX_DF={threshold}" if threshold else "No stop-list"
+        print(
+            f"{label:<16} : {len(stop_list):>7} hashes stop-listed, "
+            f"{kept.mean():6.1%} of the hash pairs stored, "
+            f"{mean_rows:9.0f} matched rows/query ({mean_rows / reference - 1:+7.2%}), "
+            f"{np.median(timings) * 1000:6.2f} ms/query, top-1 accuracy {correct / args.queries:.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
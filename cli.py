@@ -0,0 +1,288 @@
+"""
+Headless command-line tool for batch jobs : imports and identifies audio files without the Streamlit
+interface, and writes one JSON object per line (JSON Lines) with the result and timings of each file.
+
+    ingest <folder>       Fingerprint the `.mp3` files of a folder (described by its
+                          `song_details.json`) and store them. Files already indexed are skipped.
+    identify <files...>   Identify audio files (or the audio files of folders) against the catalog.
+    stats                 Size of the catalog and of its tables.
+
+Decoding and fingerprinting run in a pool of worker processes, and identification matches the files
+in batches of `--batch-size` queries. Results go to stdout (or `--output`), messages to stderr.
+The exit status is 1 when a file failed, so that cron and batch jobs can detect it.
+
+Usage :
+    python3 cli.py ingest data/songs [--workers 8] [--batch-size 8]
+    python3 cli.py identify clips/*.wav [--workers 8] [--batch-size 64] [--duration 30]
+    python3 cli.py stats
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from contextlib import ExitStack, redirect_stdout
+from typing import Iterator, List, Optional, TextIO, Tuple
+
+import numpy as np
+from termcolor import colored
+
+import __init__
+from core.analysis_profile import AnalysisProfile, get_catalog_profile
+from core.database import FingerprintsDatabase, BATCH_MAX_QUERIES, HASH_MAX_DF
+from core.identification import fingerprint_query, match_fingerprints_batch, MATCHING_ENGINE
+from core.metrics import write_metrics
+from core.store_songs import store_audio_files, DEFAULT_WORKERS, DEFAULT_BATCH_SIZE
+from core.workers import run_in_worker_pool
+from models.song_fingerprint import SongFingerprint
+from utils.audio_utils import load_audio
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Extensions of the audio files identified in the folders given to `identify`.
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac", ".ogg", ".m4a")
+
+# Default duration (in seconds) of audio fingerprinted from each identified file, from its start.
+# 0 fingerprints whole files.
+DEFAULT_IDENTIFY_DURATION = int(os.getenv("CLI_IDENTIFY_DURATION", 30))
+
+# Default number of files matched per query batch.
+DEFAULT_IDENTIFY_BATCH_SIZE = 64
+
+# ------------------------------------------------------------------------------------------------- #
+
+
+def log(message: str, color: str = "green"):
+    """Prints a log message on stderr, stdout being reserved for the results."""
+    print(colored(message, color=color), file=sys.stderr)
+
+
+def emit(output: TextIO, record: dict):
+    """Writes a result as a JSON line, flushed so that consumers see it immediately."""
+    output.write(json.dumps(record) + "\n")
+    output.flush()
+
+
+def list_audio_files(paths: List[str]) -> List[str]:
+    """Expands folders into the audio files they contain, in order."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                os.path.join(path, file_name)
+                for file_name in os.listdir(path)
+                if file_name.lower().endswith(AUDIO_EXTENSIONS)
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def fingerprint_file(
+    file_path: str, profile: AnalysisProfile, duration: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray, float, float, float]:
+    """
+    Decode and fingerprint a file to identify with the analysis profile of the catalog, in a
+    worker process.
+
+    :return: The hashes and offsets of the fingerprint, the duration (in seconds) of audio
+        fingerprinted, and the time (in seconds) spent decoding and fingerprinting.
+    """
+    start = time.perf_counter()
+    y, sr = load_audio(file_path, sr=profile.sampling_rate, duration=duration or None)
+    decoded = time.perf_counter()
+
+    hashes, offsets = fingerprint_query(y, sr, profile).get_arrays()
+
+    return hashes, offsets, len(y) / sr, decoded - start, time.perf_counter() - decoded
+
+
+def fingerprint_files(
+    files: List[str], profile: AnalysisProfile, workers: int, duration: Optional[int] = None
+) -> Iterator[Tuple[str, object]]:
+    """
+    Fingerprint files in worker processes.
+
+    :return: An iterator of (file path, result of `fingerprint_file`) in completion order, where
+        the result is replaced by the exception raised if the file could not be processed (or
+        killed its worker process).
+    """
+    if workers <= 1:
+        for file_path in files:
+            try:
+                yield file_path, fingerprint_file(file_path, profile, duration)
+            except Exception as e:
+                yield file_path, e
+        return
+
+    jobs = {file_path: (file_path, profile, duration) for file_path in files}
+    yield from run_in_worker_pool(fingerprint_file, jobs, workers, profile=profile)
+
+
+def match_batch(db: FingerprintsDatabase, batch: List[dict], output: TextIO):
+    """
+    Match a batch of fingerprinted files and emit their results. The time of the batch lookup is
+    divided among its files.
+    """
+    fingerprints = [record.pop("fingerprint") for record in batch]
+
+    start = time.perf_counter()
+    candidates = match_fingerprints_batch(fingerprints, db=db)
+    match_seconds = (time.perf_counter() - start) / len(batch)
+
+    for record, matches in zip(batch, candidates):
+        record["match_seconds"] = match_seconds
+
+        if not matches:
+            emit(output, {**record, "status": "no_match"})
+            continue
+
+        best = matches[0]
+        details = db.get_song_details_by_id(best.get_song_id()) or {}
+        emit(
+            output,
+            {
+                **record,
+                "status": "matched",
+                "song_id": best.get_song_id(),
+                "title": details.get("title"),
+                "artists": details.get("artists"),
+                "score": best.get_score(),
+                "margin": best.get_margin(),
+                "offset": best.get_offset(),
+            },
+        )
+
+
+def identify(args, output: TextIO) -> int:
+    files = list_audio_files(args.files)
+    log(
+        f"Identifying {len(files)} files ({args.workers} workers, batches of {args.batch_size}, "
+        f"{MATCHING_ENGINE} engine)."
+    )
+
+    failed, batch = 0, []
+    with FingerprintsDatabase() as db:
+        profile = get_catalog_profile(db)
+        for file_path, result in fingerprint_files(files, profile, args.workers, args.duration):
+            if isinstance(result, Exception):
+                failed += 1
+                emit(output, {"file": file_path, "status": "failed", "error": repr(result)})
+                continue
+
+            hashes, offsets, duration, decode_seconds, fingerprint_seconds = result
+            batch.append(
+                {
+                    "file": file_path,
+                    "fingerprint": SongFingerprint.from_arrays(hashes, offsets),
+                    "duration": duration,
+                    "hashes": len(hashes),
+                    "decode_seconds": decode_seconds,
+                    "fingerprint_seconds": fingerprint_seconds,
+                }
+            )
+
+            if len(batch) >= args.batch_size:
+                match_batch(db, batch, output)
+                batch = []
+
+        if batch:
+            match_batch(db, batch, output)
+
+    write_metrics()
+    log(f"{len(files) - failed} files identified, {failed} failed.", "red" if failed else "green")
+    return 1 if failed else 0
+
+
+def ingest(args, output: TextIO) -> int:
+    file_names = sorted(
+        file_name for file_name in os.listdir(args.folder) if file_name.endswith(".mp3")
+    )
+    log(f"Importing {len(file_names)} files ({args.workers} workers, batches of {args.batch_size}).")
+
+    with FingerprintsDatabase() as db:
+        db.setup()
+
+    result = store_audio_files(
+        file_names,
+        args.folder,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        file_callback=lambda record: emit(output, record),
+        verbose=0,
+    )
+
+    log(
+        f"{len(result['stored'])} songs stored, {len(result['skipped'])} already indexed, "
+        f"{len(result['failed'])} failed.",
+        "red" if result["failed"] else "green",
+    )
+    return 1 if result["failed"] else 0
+
+
+def stats(args, output: TextIO) -> int:
+    with FingerprintsDatabase() as db:
+        record = db.get_catalog_stats()
+        sizes = db.get_table_sizes()
+        profile = get_catalog_profile(db)
+
+    emit(
+        output,
+        {
+            **record,
+            "hash_max_df": HASH_MAX_DF,
+            "analysis_profile": profile.name,
+            "matching_engine": MATCHING_ENGINE,
+            "table_bytes": sizes["table"],
+            "index_bytes": sizes["index"],
+            "total_bytes": sizes["total"],
+        },
+    )
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="File the JSON lines are written to (stdout by default).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Import the audio files of a folder.")
+    ingest_parser.add_argument("folder")
+    ingest_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    ingest_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    ingest_parser.set_defaults(run=ingest)
+
+    identify_parser = subparsers.add_parser("identify", help="Identify audio files.")
+    identify_parser.add_argument("files", nargs="+")
+    identify_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    identify_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_IDENTIFY_BATCH_SIZE,
+        help=f"Files matched per query batch (at most {BATCH_MAX_QUERIES} per SQL statement).",
+    )
+    identify_parser.add_argument(
+        "--duration",
+        type=int,
+        default=DEFAULT_IDENTIFY_DURATION,
+        help="Seconds of audio fingerprinted from the start of each file, 0 for whole files.",
+    )
+    identify_parser.set_defaults(run=identify)
+
+    stats_parser = subparsers.add_parser("stats", help="Show the size of the catalog.")
+    stats_parser.set_defaults(run=stats)
+
+    args = parser.parse_args()
+    if getattr(args, "batch_size", 1) < 1:
+        parser.error("--batch-size must be at least 1.")
+
+    # Messages printed by the library go to stderr, so that stdout only carries the results
+    with ExitStack() as stack:
+        output = sys.stdout if args.output is None else stack.enter_context(open(args.output, "a"))
+        stack.enter_context(redirect_stdout(sys.stderr))
+        return args.run(args, output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+import os
+import time
+import argparse
+import threading
+from typing import Optional
+
+from termcolor import colored
+
+import __init__
+from core.audio_processing import get_hop_length, DEFAULT_WINDOW_SIZE, DEFAULT_WINDOW_RATIO
+from core.database import FingerprintsDatabase
+from utils.audio_utils import DEFAULT_SAMPLING_RATE
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Analysis profile of a new catalog, recorded in its settings by the first import. Afterwards, the
+# profile recorded with the catalog is used by imports and identifications alike.
+ANALYSIS_PROFILE = os.getenv("ANALYSIS_PROFILE", "standard")
+
+# Name of the catalog setting holding the analysis profile.
+PROFILE_SETTING = "analysis_profile"
+
+# Time (in seconds) a process keeps using the profile of the catalog before reading it again, so that
+# a long-running service picks up a profile changed with `set --force` and a re-import.
+PROFILE_REFRESH_INTERVAL = float(os.getenv("PROFILE_REFRESH_INTERVAL", 300))
+
+# ------------------------------------------------------------------------------------------------- #
+
+
+class AnalysisProfile:
+    """
+    Sampling rate and spectrogram parameters audio is analyzed with. The frequency bins above
+    `max_frequency` (Hz) are dropped from the spectrogram, all of them are kept if None.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        sampling_rate: int,
+        window_size: int,
+        window_ratio: float = DEFAULT_WINDOW_RATIO,
+        max_frequency: Optional[float] = None,
+    ):
+        self.name = name
+        self.sampling_rate = sampling_rate
+        self.window_size = window_size
+        self.window_ratio = window_ratio
+        self.max_frequency = max_frequency
+
+    def __repr__(self) -> str:
+        return (
+            f"AnalysisProfile(name={self.name}, sampling_rate={self.sampling_rate}, "
+            f"window_size={self.window_size}, window_ratio={self.window_ratio}, "
+            f"max_frequency={self.max_frequency})"
+        )
+
+    def get_hop_length(self) -> int:
+        return get_hop_length(self.window_size, self.window_ratio)
+
+    def get_spectrogram_params(self) -> dict:
+        """Arguments of `create_spectrogram` and `stream_fingerprint` for this profile."""
+        return {
+            "wsize": self.window_size,
+            "wratio": self.window_ratio,
+            "max_frequency": self.max_frequency,
+        }
+
+    def get_params(self) -> dict:
+        """
+        Parameters the fingerprints depend on. The band limit only appears when set, so that the
+        standard profile keeps the parameters (and manifest entries) of catalogs indexed before
+        profiles existed.
+        """
+        params = {
+            "sampling_rate": self.sampling_rate,
+            "window_size": self.window_size,
+            "window_ratio": self.window_ratio,
+        }
+        if self.max_frequency is not None:
+            params["max_frequency"] = self.max_frequency
+        return params
+
+
+# The reduced profiles keep the window (about 186 ms), the hop (about 93 ms) and the bin width (about
+# 5.4 Hz) of the standard one, so that the peak neighborhood, the fan value and the hash time deltas
+# keep their meaning : they halve the FFT size, and only analyze the band where robust peaks lie.
+PROFILES = {
+    "standard": AnalysisProfile("standard", DEFAULT_SAMPLING_RATE, DEFAULT_WINDOW_SIZE),
+    "reduced": AnalysisProfile("reduced", 11025, 2048, max_frequency=5000),
+    "narrowband": AnalysisProfile("narrowband", 8000, 1500),
+}
+
+
+def get_profile(name: str = ANALYSIS_PROFILE) -> AnalysisProfile:
+    """Returns an analysis profile by name."""
+    if name not in PROFILES:
+        raise ValueError(
+            f"Unknown analysis profile {name!r}, expected one of : {', '.join(PROFILES)}."
+        )
+    return PROFILES[name]
+
+
+def read_profile_name(db: FingerprintsDatabase, record: bool = False) -> Optional[str]:
+    """
+    Reads the name of the profile of the catalog. Songs stored before profiles were recorded were
+    fingerprinted with the standard one. With `record`, the profile of a catalog without one is
+    recorded : the standard one if it holds songs, ANALYSIS_PROFILE if it is empty.
+
+    :return: The name of the profile, None for an empty catalog without profile.
+    """
+    name = db.get_setting(PROFILE_SETTING)
+    if name is not None:
+        return name
+
+    has_songs = db.fetch_one("SELECT EXISTS (SELECT 1 FROM songs)")[0]
+    if not (has_songs or record):
+        return None
+
+    name = "standard" if has_songs else ANALYSIS_PROFILE
+    if record:
+        db.setup_settings()
+        db.set_setting(PROFILE_SETTING, name)
+    return name
+
+
+# Profile recorded with the catalog, reloaded every PROFILE_REFRESH_INTERVAL seconds
+_catalog_profile: Optional[AnalysisProfile] = None
+_catalog_profile_loaded_at = 0.0
+_catalog_profile_lock = threading.Lock()
+
+
+def get_catalog_profile(
+    db: Optional[FingerprintsDatabase] = None, record: bool = False, refresh: bool = False
+) -> AnalysisProfile:
+    """
+    Returns the analysis profile of the catalog, loaded from its settings on first use.
+    An empty catalog without a recorded profile uses ANALYSIS_PROFILE.
+
+    :param db: An open database connection, a new one if None.
+    :param record: Record the profile of the catalog if it has none yet, before songs are imported.
+    :param refresh: Reload the profile even if it is recent (always done with `record`).
+    """
+    global _catalog_profile, _catalog_profile_loaded_at
+
+    with _catalog_profile_lock:
+        if (
+            not (refresh or record)
+            and _catalog_profile is not None
+            and time.monotonic() - _catalog_profile_loaded_at <= PROFILE_REFRESH_INTERVAL
+        ):
+            return _catalog_profile
+
+        if db is None:
+            with FingerprintsDatabase() as db:
+                name = read_profile_name(db, record)
+        else:
+            name = read_profile_name(db, record)
+
+        if name is None:
+            name = ANALYSIS_PROFILE
+        elif (
+            "ANALYSIS_PROFILE" in os.environ
+            and name != ANALYSIS_PROFILE
+            and (_catalog_profile is None or name != _catalog_profile.name)
+        ):
+            print(
+                colored(
+                    f"The catalog uses the {name} analysis profile, ANALYSIS_PROFILE={ANALYSIS_PROFILE} "
+                    f"is ignored (see `python -m core.analysis_profile set`).",
+                    color="yellow",
+                )
+            )
+
+        _catalog_profile = get_profile(name)
+        _catalog_profile_loaded_at = time.monotonic()
+        return _catalog_profile
+
+
+def print_profiles(current: Optional[str] = None):
+    for name, profile in PROFILES.items():
+        band = f"{profile.max_frequency:g} Hz" if profile.max_frequency else "full band"
+        print(
+            colored(
+                f"{'*' if name == current else ' '} {name:<11} : {profile.sampling_rate} Hz, "
+                f"window {profile.window_size} ({profile.window_size / profile.sampling_rate * 1000:.0f} ms), "
+                f"hop {profile.get_hop_length()}, {band}",
+                color="green" if name == current else None,
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the analysis profile of the catalog.")
+    parser.add_argument("command", choices=["status", "set"])
+    parser.add_argument("profile", nargs="?", choices=list(PROFILES))
+    parser.add_argument(
+        "--force", action="store_true", help="Change the profile of a catalog holding songs."
+    )
+    args = parser.parse_args()
+
+    with FingerprintsDatabase() as db:
+        db.setup_settings()
+
+        if args.command == "status":
+            name = read_profile_name(db)
+            if name is None:
+                print(
+                    colored(
+                        f"No profile recorded : the next import records {ANALYSIS_PROFILE}.",
+                        color="yellow",
+                    )
+                )
+            print_profiles(name or ANALYSIS_PROFILE)
+
+        elif args.command == "set":
+            if args.profile is None:
+                parser.error("Name the profile to use.")
+
+            nb_songs = db.fetch_one("SELECT COUNT(*) FROM songs")[0]
+            if nb_songs and not args.force:
+                parser.error(
+                    f"The catalog holds {nb_songs} songs fingerprinted with its current profile, "
+                    "which would no longer match queries. Pass --force, then import the songs "
+                    "again to re-index them."
+                )
+
+            db.set_setting(PROFILE_SETTING, args.profile)
+            print(colored(f"Analysis profile of the catalog : {args.profile}.", color="green"))
+            if nb_songs:
+                print(
+                    colored(
+                        "Run the import again to re-index the songs with it, and rebuild the "
+                        "fingerprint index files.",
+                        color="yellow",
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
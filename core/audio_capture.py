@@ -1,5 +1,9 @@
+import os
+import time
+from typing import Iterator, Optional
+
+import numpy as np
 from termcolor import colored
-import pyaudio
 import wave
 
 # ------------------------------------------- CONSTANTS ------------------------------------------- #
@@ -19,9 +23,50 @@ DEFAULT_CHANNELS = 1
 # Default recording duration in seconds. This is the maximum recording time before automatic stop.
 DEFAULT_RECORDING_DURATION = 10
 
+# Directory where each recording is also saved as a WAV file, for debugging. Unset, recordings are
+# only kept in memory.
+RECORDING_DEBUG_DIR = os.getenv("RECORDING_DEBUG_DIR")
+
 # ------------------------------------------------------------------------------------------------- #
 
 
+class RingBuffer:
+    """
+    Fixed-capacity audio buffer keeping the last `capacity` samples written to it.
+    Writes never allocate : once full, the oldest samples are overwritten in place.
+    """
+
+    def __init__(self, capacity: int, dtype=np.float32):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.position = 0  # Index where the next sample is written
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def write(self, samples: np.ndarray):
+        """Appends samples, dropping the oldest ones once the buffer is full."""
+        samples = samples[-self.capacity :]
+        end = self.position + len(samples)
+
+        if end <= self.capacity:
+            self.data[self.position : end] = samples
+        else:
+            split = self.capacity - self.position
+            self.data[self.position :] = samples[:split]
+            self.data[: end - self.capacity] = samples[split:]
+
+        self.position = end % self.capacity
+        self.size = min(self.size + len(samples), self.capacity)
+
+    def get(self) -> np.ndarray:
+        """Returns a copy of the buffered samples, oldest first."""
+        if self.size < self.capacity:
+            return self.data[: self.size].copy()
+        return np.concatenate([self.data[self.position :], self.data[: self.position]])
+
+
 class AudioCapture:
     def __init__(
         self,
@@ -40,12 +85,17 @@ class AudioCapture:
         self.sample_rate = sample_rate
         self.channels = channels
         self.duration = duration
+        # Imported here, so that the ring buffer of this module can be used without PortAudio
+        import pyaudio
+
         self.audio = pyaudio.PyAudio()
-        self.stream = None
+        self.input_stream = None
 
     def start_recording(self, verbose: bool = True):
         """Start the audio recording stream."""
-        self.stream = self.audio.open(
+        import pyaudio
+
+        self.input_stream = self.audio.open(
             format=pyaudio.paInt16,
             channels=self.channels,
             rate=self.sample_rate,
@@ -63,23 +113,26 @@ class AudioCapture:
 
     def stop_recording(self):
         """Stop the audio recording stream."""
-        if self.stream:
-            self.stream.stop_stream()
-            self.stream.close()
+        if self.input_stream:
+            self.input_stream.stop_stream()
+            self.input_stream.close()
+            self.input_stream = None
             self.audio.terminate()
 
-    def record_to_file(
-        self, file_path: str = "data/recordings/output.wav", verbose: bool = True
-    ):
-        """Record audio for a maximum duration but allow manual interruption."""
-        frames = []
-        self.start_recording()
+    def read_chunks(self, verbose: bool = True) -> Iterator[np.ndarray]:
+        """
+        Record audio chunk by chunk for a maximum duration, yielding the int16 samples of each chunk
+        (interleaved if there are several channels) as soon as it is read. The recording stops when
+        the duration is reached, on manual interruption, or when the consumer closes the iterator.
+        """
+        self.start_recording(verbose=verbose)
 
         try:
-            # Record audio for the set duration or until manually interrupted
             for _ in range(0, int(self.sample_rate / self.chunk_size * self.duration)):
-                data = self.stream.read(self.chunk_size)
-                frames.append(data)
+                # The consumer may fall behind while matching : keep the samples buffered by
+                # PyAudio rather than failing on an input overflow
+                data = self.input_stream.read(self.chunk_size, exception_on_overflow=False)
+                yield np.frombuffer(data, dtype=np.int16)
 
         except KeyboardInterrupt:
             if verbose:
@@ -88,11 +141,59 @@ class AudioCapture:
         finally:
             self.stop_recording()
 
-            with wave.open(file_path, "wb") as wf:
-                wf.setnchannels(self.channels)
-                wf.setsampwidth(self.audio.get_sample_size(pyaudio.paInt16))
-                wf.setframerate(self.sample_rate)
-                wf.writeframes(b"".join(frames))
+    def stream(self, verbose: bool = True) -> Iterator[np.ndarray]:
+        """
+        Record audio chunk by chunk like `read_chunks`, yielding each chunk as float32 samples
+        in [-1, 1].
+        """
+        chunks = self.read_chunks(verbose=verbose)
+        try:
+            for chunk in chunks:
+                yield chunk.astype(np.float32) / 32768
+        finally:
+            chunks.close()
 
-            if verbose:
-                print(colored(f"Audio recorded to {file_path}", color="green"))
+    def record(self, verbose: bool = True, file_path: Optional[str] = None) -> np.ndarray:
+        """
+        Record audio for a maximum duration but allow manual interruption, in memory.
+
+        :param verbose: Print the start and the end of the recording.
+        :param file_path: Also save the recording as a WAV file at this path. By default, it is only
+            saved if RECORDING_DEBUG_DIR is set.
+        :return: The int16 samples recorded, interleaved if there are several channels.
+        """
+        nb_chunks = int(self.sample_rate / self.chunk_size * self.duration)
+        samples = np.empty(nb_chunks * self.chunk_size * self.channels, dtype=np.int16)
+        size = 0
+
+        for chunk in self.read_chunks(verbose=verbose):
+            samples[size : size + len(chunk)] = chunk
+            size += len(chunk)
+        samples = samples[:size]
+
+        if file_path is None and RECORDING_DEBUG_DIR:
+            os.makedirs(RECORDING_DEBUG_DIR, exist_ok=True)
+            file_path = os.path.join(
+                RECORDING_DEBUG_DIR, f"recording-{time.strftime('%Y%m%d-%H%M%S')}.wav"
+            )
+        if file_path is not None:
+            self.save(samples, file_path, verbose=verbose)
+
+        return samples
+
+    def save(self, samples: np.ndarray, file_path: str, verbose: bool = True):
+        """Save recorded samples as a WAV file."""
+        with wave.open(file_path, "wb") as wf:
+            wf.setnchannels(self.channels)
+            wf.setsampwidth(np.dtype(np.int16).itemsize)
+            wf.setframerate(self.sample_rate)
+            wf.writeframes(samples.tobytes())
+
+        if verbose:
+            print(colored(f"Audio recorded to {file_path}", color="green"))
+
+    def record_to_file(
+        self, file_path: str = "data/recordings/output.wav", verbose: bool = True
+    ):
+        """Record audio for a maximum duration but allow manual interruption, to a WAV file."""
+        self.record(verbose=verbose, file_path=file_path)
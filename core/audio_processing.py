@@ -1,18 +1,13 @@
-from typing import Tuple
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional, Tuple
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
 from termcolor import colored
-from scipy.ndimage import maximum_filter
-from scipy.ndimage import (
-    generate_binary_structure,
-    iterate_structure,
-    binary_erosion,
-)
 
-from core.database import FingerprintsDatabase
-from models.song_fingerprint import SongHashPair, SongFingerprint
+from core.stft import stft, frame_signal, power_spectrum, power_to_db, get_nb_bins
+from models.song_fingerprint import SongFingerprint
+
+if TYPE_CHECKING:
+    from core.database import FingerprintsDatabase
 
 # ------------------------------------------- CONSTANTS ------------------------------------------- #
 
@@ -36,34 +31,65 @@ PEAK_NEIGHBORHOOD_SIZE = 20
 # Peaks with amplitude values below this threshold will be ignored to reduce noise and focus on more prominent features.
 DEFAULT_AMPLITUDE_THRESHOLD = -50
 
+# Number of frequency bands (logarithmically spaced) in which the peaks of a frame are budgeted
+# when a maximum number of peaks per band is set.
+DEFAULT_PEAK_BANDS = 6
+
 # Default number of neighboring peaks to consider when creating hash pairs for the audio fingerprint.
 # A value of 30 means each peak will be paired with the next 30 closest peaks in time.
 DEFAULT_FAN_VALUE = 30
 
+# Maximum time difference (in seconds) between the two peaks of a hash pair.
+# Pairs whose target peak comes before the anchor or more than this delay after it are discarded.
+MAX_HASH_TIME_DELTA = 200
+
+# Number of bits used by each field (anchor frequency bin, target frequency bin, time delta in frames)
+# of a packed integer hash. 16 bits per field covers every FFT size and pairing window used here.
+HASH_FIELD_BITS = 16
+
+# Number of anchor peaks paired at once when computing hashes.
+# Bounds the size of the temporary pairing arrays on long songs and large fan values.
+HASH_BLOCK_SIZE = 65536
+
+# Number of spectrogram frames searched for peaks at once when streaming audio.
+# With the peak neighborhood kept on each side, it bounds the memory used on arbitrarily long audio.
+STREAM_CHUNK_FRAMES = 256
+
+# Range and resolution (in dB) of the histogram used to estimate the background level of a stream.
+BACKGROUND_HISTOGRAM_RANGE = (-400, 200)
+BACKGROUND_HISTOGRAM_RESOLUTION = 0.1
 
 # ------------------------------------------------------------------------------------------------- #
 
 
+def get_hop_length(wsize: int = DEFAULT_WINDOW_SIZE, wratio: float = DEFAULT_WINDOW_RATIO) -> int:
+    """
+    Number of samples between the starts of two consecutive spectrogram frames.
+    """
+    return wsize - int(wsize * wratio)
+
+
 def create_spectrogram(
     y: np.ndarray,
     sr: int,
     wsize: int = DEFAULT_WINDOW_SIZE,
     wratio: float = DEFAULT_WINDOW_RATIO,
     plot: bool = False,
+    max_frequency: Optional[float] = None,
 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    Create a spectrogram using matplotlib's specgram function.
-    If visualize is True, display a plot of the spectrogram.
+    Create a spectrogram in dB (float32), with the frames and scaling of matplotlib's specgram.
+    With `max_frequency` (Hz), only the band below it is kept.
+    If plot is True, display a plot of the spectrogram.
     """
 
-    spectrogram, freqs, times = mlab.specgram(
-        y, NFFT=wsize, Fs=sr, window=mlab.window_hanning, noverlap=int(wsize * wratio)
+    spectrogram_db, freqs, times = stft(
+        y, sr, wsize, get_hop_length(wsize, wratio), max_frequency=max_frequency
     )
 
-    # Convert to dB scale
-    spectrogram_db = 10 * np.log10(spectrogram)
-
     if plot:
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(12, 8))
         plt.imshow(
             spectrogram_db,
@@ -80,44 +106,132 @@ def create_spectrogram(
     return spectrogram_db, freqs, times
 
 
+def diamond_maximum_filter(spectrogram: np.ndarray, radius: int) -> np.ndarray:
+    """
+    Maximum of each point's diamond neighborhood (points within an L1 distance of `radius`),
+    identical to `maximum_filter` with the footprint `iterate_structure(cross, radius)`.
+
+    The diamond is the `radius`-fold dilation of a 3x3 cross, so the filter is computed as `radius`
+    cross maxima, each made of four in-place shifted maxima : O(radius) per point instead of
+    O(radius²), without temporary arrays. Edges behave like the "reflect" mode of `maximum_filter`.
+    """
+    source = np.array(spectrogram, copy=True)
+    result = np.empty_like(source)
+
+    for _ in range(radius):
+        np.copyto(result, source)
+        np.maximum(result[1:], source[:-1], out=result[1:])
+        np.maximum(result[:-1], source[1:], out=result[:-1])
+        np.maximum(result[:, 1:], source[:, :-1], out=result[:, 1:])
+        np.maximum(result[:, :-1], source[:, 1:], out=result[:, :-1])
+        source, result = result, source
+
+    return source
+
+
+def find_peaks(
+    spectrogram: np.ndarray,
+    neighborhood_size: int,
+    amp_thres: float,
+    background_threshold: float,
+    padding: Tuple[int, int] = (0, 0),
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the points of a spectrogram above `amp_thres` that are either local maxima outside of the
+    eroded background, or points of the eroded background that are not local maxima.
+    The `padding` columns on each side only serve as neighborhood, and count as background.
+
+    :return: The frequency bins and frames (counted after the left padding) of the peaks.
+    """
+    before, after = padding
+    end = spectrogram.shape[1] - after
+    values = spectrogram[:, before:end]
+
+    local_max = diamond_maximum_filter(spectrogram, neighborhood_size) == spectrogram
+    detected = local_max[:, before:end]
+
+    # The eroded background only holds points at or below the background threshold :
+    # it only changes points above the amplitude threshold when the background threshold is above it
+    if background_threshold > amp_thres:
+        from scipy.ndimage import binary_erosion, generate_binary_structure
+
+        background = spectrogram <= background_threshold
+        background[:, :before] = True
+        background[:, end:] = True
+        eroded_background = binary_erosion(
+            background,
+            structure=generate_binary_structure(2, 1),
+            iterations=neighborhood_size,
+            border_value=1,
+        )
+        detected ^= eroded_background[:, before:end]
+
+    return np.nonzero(detected & (values > amp_thres))
+
+
+def limit_peaks_per_band(
+    peaks: np.ndarray,
+    nb_bins: int,
+    max_peaks: int,
+    nb_bands: int = DEFAULT_PEAK_BANDS,
+) -> np.ndarray:
+    """
+    Keep at most the `max_peaks` strongest peaks of each frame in each of `nb_bands` logarithmically
+    spaced frequency bands, preserving the order of the peaks. Bounds the number of hashes produced
+    per second of audio.
+
+    :param peaks: (N x 3) array of (frequency bin, frame index, amplitude).
+    :param nb_bins: The number of frequency bins of the spectrogram.
+    """
+    if len(peaks) == 0:
+        return peaks
+
+    band_edges = np.geomspace(1, nb_bins, nb_bands + 1)[1:-1]
+    bands = np.searchsorted(band_edges, peaks[:, 0], side="right")
+    groups = peaks[:, 1].astype(np.int64) * nb_bands + bands
+
+    # Rank the peaks of each (frame, band) group by decreasing amplitude
+    order = np.lexsort((-peaks[:, 2], groups))
+    sorted_groups = groups[order]
+    ranks = np.arange(len(order)) - np.searchsorted(sorted_groups, sorted_groups)
+
+    return peaks[np.sort(order[ranks < max_peaks])]
+
+
 def get_peaks(
     spectrogram: np.ndarray,
     plot: bool = False,
     neighborhood_size: int = PEAK_NEIGHBORHOOD_SIZE,
     amp_thres: int = DEFAULT_AMPLITUDE_THRESHOLD,
-) -> list:
+    max_peaks_per_band: Optional[int] = None,
+    nb_bands: int = DEFAULT_PEAK_BANDS,
+) -> np.ndarray:
     """
     Extract peaks from an array of spectrogram data.
-    """
-
-    struct = generate_binary_structure(2, 1)
-
-    neighborhood = iterate_structure(struct, neighborhood_size)
-    local_max = maximum_filter(spectrogram, footprint=neighborhood) == spectrogram
+    With `max_peaks_per_band`, only the strongest peaks of each frame and frequency band are kept.
 
-    # Filter out background
-    background_threshold = np.percentile(spectrogram, 5)
-    background = spectrogram <= background_threshold
+    :return: (N x 3) array of (frequency bin, frame index, amplitude), sorted by bin, then frame.
+    """
 
-    eroded_background = binary_erosion(
-        background, structure=neighborhood, border_value=1
+    peaks_x, peaks_y = find_peaks(
+        spectrogram,
+        neighborhood_size,
+        amp_thres,
+        background_threshold=np.percentile(spectrogram, 5),
     )
+    peaks = np.column_stack([peaks_x, peaks_y, spectrogram[peaks_x, peaks_y]])
 
-    # Identify peaks
-    detected_peaks = local_max ^ eroded_background
-
-    # Filter out peaks below amplitude threshold
-    peaks_x, peaks_y = np.where(detected_peaks)
-    peaks = [
-        (x, y, spectrogram[x, y])
-        for x, y in zip(peaks_x, peaks_y)
-        if spectrogram[x, y] > amp_thres
-    ]
+    if max_peaks_per_band is not None:
+        peaks = limit_peaks_per_band(
+            peaks, spectrogram.shape[0], max_peaks_per_band, nb_bands=nb_bands
+        )
 
     if plot:
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(12, 8))
         plt.imshow(spectrogram, aspect="auto", origin="lower")
-        plt.scatter([p[1] for p in peaks], [p[0] for p in peaks], c="r", s=10)
+        plt.scatter(peaks[:, 1], peaks[:, 0], c="r", s=10)
         plt.colorbar(label="Intensity (dB)")
         plt.ylabel("Frequency (Hz)")
         plt.xlabel("Time (s)")
@@ -127,49 +241,336 @@ def get_peaks(
     return peaks
 
 
+def stream_spectrogram(
+    blocks: Iterable[np.ndarray],
+    sr: int,
+    wsize: int = DEFAULT_WINDOW_SIZE,
+    wratio: float = DEFAULT_WINDOW_RATIO,
+    max_frequency: Optional[float] = None,
+) -> Iterator[np.ndarray]:
+    """
+    Compute the spectrogram of a stream of audio blocks, with the same frames, band and scaling as
+    `create_spectrogram` on the whole signal. The samples of the last incomplete window of each
+    block are carried over to the next one.
+    Yields (frequency bins x frames) chunks of the spectrogram in dB.
+    """
+    hop = get_hop_length(wsize, wratio)
+    nb_bins = get_nb_bins(wsize, sr, max_frequency)
+
+    def to_db(frames: np.ndarray) -> np.ndarray:
+        return power_to_db(power_spectrum(frames, sr, nb_bins=nb_bins)).T
+
+    carry = np.empty(0, dtype=np.float32)
+    nb_frames = 0
+
+    for block in blocks:
+        samples = np.concatenate([carry, block])
+        if len(samples) < wsize:
+            carry = samples
+            continue
+
+        frames = frame_signal(samples, wsize, hop)
+        nb_frames += len(frames)
+        yield to_db(frames)
+        carry = samples[len(frames) * hop :]
+
+    # Like matplotlib, a signal shorter than a window is zero-padded into a single frame
+    if nb_frames == 0 and len(carry) > 0:
+        yield to_db(frame_signal(carry, wsize, hop))
+
+
+def stream_peaks(
+    spectrogram_chunks: Iterable[np.ndarray],
+    neighborhood_size: int = PEAK_NEIGHBORHOOD_SIZE,
+    amp_thres: int = DEFAULT_AMPLITUDE_THRESHOLD,
+    chunk_frames: int = STREAM_CHUNK_FRAMES,
+    max_peaks_per_band: Optional[int] = None,
+    nb_bands: int = DEFAULT_PEAK_BANDS,
+) -> Iterator[np.ndarray]:
+    """
+    Extract peaks from a stream of spectrogram chunks with the same neighborhood, amplitude
+    threshold and peak budget as `get_peaks`, on a sliding window of `chunk_frames` frames plus the neighborhood
+    on each side. Local maxima are identical to those of `get_peaks` on the whole spectrogram. The
+    background level (5th percentile) is estimated from the frames seen so far, which only matters
+    when it lies above the amplitude threshold.
+    Yields (N x 3) arrays of (frequency bin, frame index, amplitude), frames counted from the stream start.
+    """
+    context = neighborhood_size
+
+    low, high = BACKGROUND_HISTOGRAM_RANGE
+    bin_edges = np.arange(low, high + BACKGROUND_HISTOGRAM_RESOLUTION, BACKGROUND_HISTOGRAM_RESOLUTION)
+    histogram = np.zeros(len(bin_edges) - 1, dtype=np.int64)
+
+    history = None  # Last frames already searched, used as context for the next window
+    pending = []  # Frames not searched yet
+    first_frame = 0  # Index of the first pending frame in the stream
+
+    def search(nb_frames: int, final: bool) -> np.ndarray:
+        nonlocal history, pending, first_frame
+
+        frames = np.concatenate(pending, axis=1)
+        lookahead = frames.shape[1] - nb_frames
+        window = frames if history is None else np.concatenate([history, frames], axis=1)
+        before = 0 if history is None else history.shape[1]
+
+        # Mirror the spectrogram at the edges of the stream, like `maximum_filter` does,
+        # the edges of the stream counting as background
+        pad = (context if history is None else 0, context if final else 0)
+        padded = np.pad(window, ((0, 0), pad), mode="symmetric")
+
+        cumulative = np.cumsum(histogram)
+        background_threshold = bin_edges[
+            np.searchsorted(cumulative, 0.05 * cumulative[-1]) + 1
+        ]
+        peaks_x, peaks_y = find_peaks(
+            padded, neighborhood_size, amp_thres, background_threshold, padding=pad
+        )
+
+        # Keep the peaks of the searched frames, the history and lookahead being context only
+        searched_peaks = (peaks_y >= before) & (peaks_y < before + nb_frames)
+        peaks_x, peaks_y = peaks_x[searched_peaks], peaks_y[searched_peaks]
+        core = window[:, before : before + nb_frames]
+        peaks = np.column_stack(
+            [peaks_x, peaks_y - before + first_frame, window[peaks_x, peaks_y]]
+        )
+
+        if max_peaks_per_band is not None:
+            peaks = limit_peaks_per_band(
+                peaks, window.shape[0], max_peaks_per_band, nb_bands=nb_bands
+            )
+
+        searched = np.concatenate([history, core], axis=1) if history is not None else core
+        history = searched[:, -context:] if context else searched[:, :0]
+        pending = [frames[:, nb_frames:]] if lookahead else []
+        first_frame += nb_frames
+
+        return peaks
+
+    nb_pending = 0
+    for chunk in spectrogram_chunks:
+        histogram += np.histogram(np.clip(chunk, low, high), bins=bin_edges)[0]
+        pending.append(chunk)
+        nb_pending += chunk.shape[1]
+
+        while nb_pending >= chunk_frames + context:
+            yield search(chunk_frames, final=False)
+            nb_pending -= chunk_frames
+
+    if nb_pending:
+        yield search(nb_pending, final=True)
+
+
+def pack_hashes(
+    anchor_freqs: np.ndarray, target_freqs: np.ndarray, time_deltas: np.ndarray
+) -> np.ndarray:
+    """
+    Pack (anchor frequency bin, target frequency bin, time delta in frames) triplets
+    into 64-bit integer hashes.
+    """
+    mask = (1 << HASH_FIELD_BITS) - 1
+
+    return (
+        (np.asarray(anchor_freqs, dtype=np.int64) & mask) << (2 * HASH_FIELD_BITS)
+        | (np.asarray(target_freqs, dtype=np.int64) & mask) << HASH_FIELD_BITS
+        | (np.asarray(time_deltas, dtype=np.int64) & mask)
+    )
+
+
+def compute_hashes(
+    peaks, times: np.ndarray, fan_value: int = DEFAULT_FAN_VALUE
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Build all (anchor, target) hash pairs from the peaks with array operations.
+
+    Each peak is paired with the `fan_value - 1` peaks that follow it in `peaks`,
+    keeping only the pairs whose time difference lies within [0, MAX_HASH_TIME_DELTA] seconds.
+    Returns the packed integer hashes (int64) and the anchor offsets as frame indices (int32).
+    """
+    peaks = np.asarray(peaks)
+    if peaks.size == 0 or fan_value < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+
+    freq_idx = peaks[:, 0].astype(np.int64)
+    time_idx = peaks[:, 1].astype(np.int64)
+    peak_times = np.asarray(times)[time_idx]
+    nb_peaks = len(peaks)
+    steps = np.arange(1, fan_value)
+
+    hashes, offsets = [], []
+    for start in range(0, nb_peaks, HASH_BLOCK_SIZE):
+        # Pair every anchor of the block with its `fan_value - 1` successors
+        anchors = np.arange(start, min(start + HASH_BLOCK_SIZE, nb_peaks))[:, None]
+        targets = anchors + steps
+        valid = targets < nb_peaks
+
+        anchors = np.broadcast_to(anchors, targets.shape)[valid]
+        targets = targets[valid]
+
+        time_delta = peak_times[targets] - peak_times[anchors]
+        keep = (time_delta >= 0) & (time_delta <= MAX_HASH_TIME_DELTA)
+        anchors, targets = anchors[keep], targets[keep]
+
+        hashes.append(
+            pack_hashes(
+                freq_idx[anchors],
+                freq_idx[targets],
+                time_idx[targets] - time_idx[anchors],
+            )
+        )
+        offsets.append(time_idx[anchors].astype(np.int32))
+
+    return np.concatenate(hashes), np.concatenate(offsets)
+
+
+def stream_hashes(
+    peak_chunks: Iterable[np.ndarray],
+    frame_duration: float,
+    fan_value: int = DEFAULT_FAN_VALUE,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Build hash pairs from a stream of peaks in time order, as they arrive.
+
+    The hash pairs are the same as those of `compute_hashes` on all the peaks sorted by frequency bin,
+    then time (the order of `get_peaks`), in a different order. For each frequency bin, only its last
+    `fan_value - 1` peaks (anchors still expecting targets) and its first `fan_value - 1` peaks
+    (targets of the anchors of the lower bins, paired when the stream ends) are kept in memory.
+    Yields (hashes, offsets) batches, as returned by `compute_hashes`.
+    """
+    fan = fan_value - 1
+    max_time_delta = MAX_HASH_TIME_DELTA / frame_duration
+    steps = np.arange(1, fan + 1)
+
+    # Peaks as (frequency bin, frame) rows, sorted by bin, then time
+    tails = np.empty((0, 2), dtype=np.int64)
+    heads = np.empty((0, 2), dtype=np.int64)
+
+    def to_hashes(anchors: np.ndarray, targets: np.ndarray):
+        time_delta = targets[:, 1] - anchors[:, 1]
+        keep = (time_delta >= 0) & (time_delta <= max_time_delta)
+        anchors, targets = anchors[keep], targets[keep]
+        return (
+            pack_hashes(anchors[:, 0], targets[:, 0], targets[:, 1] - anchors[:, 1]),
+            anchors[:, 1].astype(np.int32),
+        )
+
+    def rank_in_bin(bins: np.ndarray, from_end: bool = False) -> np.ndarray:
+        positions = np.arange(len(bins))
+        if from_end:
+            return np.searchsorted(bins, bins, side="right") - 1 - positions
+        return positions - np.searchsorted(bins, bins, side="left")
+
+    for peaks in peak_chunks:
+        if fan < 1 or len(peaks) == 0:
+            continue
+        peaks = np.asarray(peaks)[:, :2].astype(np.int64)
+
+        # Pair each new peak with the `fan` peaks preceding it in its frequency bin
+        touched = np.isin(tails[:, 0], peaks[:, 0])
+        candidates = np.concatenate([tails[touched], peaks])
+        is_new = np.arange(len(candidates)) >= touched.sum()
+        order = np.lexsort((is_new, candidates[:, 1], candidates[:, 0]))
+        candidates, is_new = candidates[order], is_new[order]
+
+        targets = np.flatnonzero(is_new)[:, None]
+        anchors = targets - steps
+        valid = anchors >= 0
+        valid[valid] = (
+            candidates[anchors[valid], 0]
+            == candidates[np.broadcast_to(targets, anchors.shape)[valid], 0]
+        )
+        yield to_hashes(
+            candidates[anchors[valid]],
+            candidates[np.broadcast_to(targets, anchors.shape)[valid]],
+        )
+
+        # Keep the last `fan` peaks of each bin as future anchors
+        tails = np.concatenate(
+            [tails[~touched], candidates[rank_in_bin(candidates[:, 0], from_end=True) < fan]]
+        )
+        tails = tails[np.lexsort((tails[:, 1], tails[:, 0]))]
+
+        # Keep the first `fan` peaks of each bin as targets for the anchors of lower bins
+        peaks = peaks[np.lexsort((peaks[:, 1], peaks[:, 0]))]
+        nb_heads = np.bincount(heads[:, 0], minlength=peaks[:, 0].max() + 1)
+        new_heads = peaks[nb_heads[peaks[:, 0]] + rank_in_bin(peaks[:, 0]) < fan]
+        heads = np.concatenate([heads, new_heads])
+        heads = heads[np.lexsort((heads[:, 1], heads[:, 0]))]
+
+    if len(tails) == 0:
+        return
+
+    # Anchors with fewer than `fan` later peaks in their bin are paired with the first peaks of the next bins
+    missing = fan - rank_in_bin(tails[:, 0], from_end=True)
+    first_target = np.searchsorted(heads[:, 0], tails[:, 0], side="right")
+    targets = first_target[:, None] + np.arange(fan)
+    valid = (np.arange(fan) < missing[:, None]) & (targets < len(heads))
+
+    yield to_hashes(
+        np.broadcast_to(tails[:, None, :], targets.shape + (2,))[valid],
+        heads[targets[valid]],
+    )
+
+
 def create_fingerprint(
-    peaks: list, freqs: list, times: list, fan_value: int = DEFAULT_FAN_VALUE
+    peaks: np.ndarray, freqs: np.ndarray, times: np.ndarray, fan_value: int = DEFAULT_FAN_VALUE
 ) -> SongFingerprint:
     """
     Create hash pairs from the peaks.
     """
 
-    fingerprint = SongFingerprint()
+    hashes, offsets = compute_hashes(peaks, times, fan_value=fan_value)
 
-    # Iterate over each peak
-    for i in range(len(peaks)):
-        # Consider `fan_value` neighboring peaks for pairing
-        for j in range(1, fan_value):
-            if (i + j) < len(peaks):
-                # Get frequencies and times for the current pair of peaks
-                freq1 = freqs[peaks[i][0]]
-                freq2 = freqs[peaks[i + j][0]]
-                time1 = times[peaks[i][1]]
-                time2 = times[peaks[i + j][1]]
+    return fingerprint_from_hashes(hashes, offsets)
 
-                # Calculate time difference between the pair
-                time_delta = time2 - time1
 
-                if 0 <= time_delta <= 200:
-                    # Create a hash string for the pair and append it to the list
-                    hash_pair = SongHashPair(
-                        hash=f"{freq1:.0f}|{freq2:.0f}|{time_delta:.2f}", offset=time1
-                    )
+def fingerprint_from_hashes(hashes: np.ndarray, offsets: np.ndarray) -> SongFingerprint:
+    """
+    Create a fingerprint from arrays of packed hashes and offsets.
+    """
+    return SongFingerprint.from_arrays(hashes, offsets)
 
-                    fingerprint.add_hash_pair(hash_pair)
 
-    return fingerprint
+def stream_fingerprint(
+    blocks: Iterable[np.ndarray],
+    sr: int,
+    wsize: int = DEFAULT_WINDOW_SIZE,
+    wratio: float = DEFAULT_WINDOW_RATIO,
+    neighborhood_size: int = PEAK_NEIGHBORHOOD_SIZE,
+    amp_thres: int = DEFAULT_AMPLITUDE_THRESHOLD,
+    fan_value: int = DEFAULT_FAN_VALUE,
+    max_peaks_per_band: Optional[int] = None,
+    max_frequency: Optional[float] = None,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Fingerprint a stream of audio blocks with bounded memory : spectrogram, peak picking and
+    hashing all run incrementally. Yields (hashes, offsets) batches as they are produced.
+    """
+    spectrogram_chunks = stream_spectrogram(
+        blocks, sr, wsize=wsize, wratio=wratio, max_frequency=max_frequency
+    )
+    peak_chunks = stream_peaks(
+        spectrogram_chunks,
+        neighborhood_size=neighborhood_size,
+        amp_thres=amp_thres,
+        max_peaks_per_band=max_peaks_per_band,
+    )
+
+    return stream_hashes(
+        peak_chunks, get_hop_length(wsize, wratio) / sr, fan_value=fan_value
+    )
 
 
 def store_fingerprint(
-    db: FingerprintsDatabase, song_details: dict, fingerprint: SongFingerprint
+    db: "FingerprintsDatabase", song_details: dict, fingerprint: SongFingerprint
 ) -> int:
     """
-    Store the fingerprint in the database.
+    Store the song and its fingerprint in the database within a single transaction,
+    so that a failure leaves neither the song nor part of its fingerprint behind.
     """
-    song_id = db.insert_song(song_details)
-    fingerprint.set_song_id(song_id)
-    db.insert_fingerprint(fingerprint)
+    with db.transaction():
+        song_id = db.insert_song(song_details)
+        fingerprint.set_song_id(song_id)
+        db.insert_fingerprint(fingerprint)
     print(colored("Stored fingerprint in the database.", color="green"))
 
     return song_id
@@ -1,12 +1,228 @@
+import io
 import os
-from typing import List, Tuple, Any, Optional, Union
-from collections import Counter
+import time
+import threading
+from typing import Dict, List, Optional, Tuple, Any, Union
+from contextlib import contextmanager
 
-import psycopg2
-from psycopg2 import sql
+import numpy as np
 
 import __init__
-from models.song_fingerprint import SongFingerprint
+from core.metrics import record_query
+from models.song_fingerprint import SongFingerprint, to_hash_arrays
+from models.song_match import SongMatch, rank_matches
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Default number of candidate songs returned by an identification.
+# Only this many rows cross the wire, whatever the number of matching hashes.
+DEFAULT_TOP_K = 5
+
+# Maximum number of queries matched by a single statement of a batch identification. Larger batches
+# are split, so that the intermediate histograms of a statement stay small enough for work_mem.
+BATCH_MAX_QUERIES = 256
+
+# Document frequency (number of songs holding a hash) above which a hash is stop-listed : hashes that
+# common (silence, hum, drum hits...) pull back huge posting lists without telling songs apart, so
+# they are neither stored nor looked up anymore. Unset or 0, every hash is kept.
+HASH_MAX_DF = int(os.getenv("HASH_MAX_DF", 0))
+
+# Number of connections opened when the connection pool of a database is created, and maximum number
+# of connections it holds. Sessions beyond the maximum wait for a connection to be returned.
+POOL_MIN_SIZE = int(os.getenv("POSTGRES_POOL_MIN", 1))
+POOL_MAX_SIZE = int(os.getenv("POSTGRES_POOL_MAX", 10))
+
+# Maximum time (in seconds) a session waits for a free connection before failing.
+POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", 30))
+
+# Idle time (in seconds) after which a pooled connection is checked with a round trip before reuse.
+# Connections closed by the server (restart, idle timeout...) are then replaced transparently.
+POOL_HEALTH_CHECK_INTERVAL = 30
+
+# ------------------------------------------------------------------------------------------------- #
+
+# Signature, flags and header extension length opening a PostgreSQL binary COPY stream.
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + b"\x00" * 8
+
+# Field count of -1 closing a PostgreSQL binary COPY stream.
+COPY_BINARY_TRAILER = b"\xff\xff"
+
+
+def to_copy_binary(columns: List[np.ndarray]) -> io.BytesIO:
+    """
+    Encodes integer columns as a PostgreSQL binary COPY stream.
+    Each column becomes one field, sized after its dtype (int32 for INTEGER, int64 for BIGINT).
+    """
+    fields = [("field_count", ">i2")]
+    for i, column in enumerate(columns):
+        fields += [(f"length_{i}", ">i4"), (f"value_{i}", f">i{column.dtype.itemsize}")]
+
+    rows = np.empty(len(columns[0]), dtype=fields)
+    rows["field_count"] = len(columns)
+    for i, column in enumerate(columns):
+        rows[f"length_{i}"] = column.dtype.itemsize
+        rows[f"value_{i}"] = column
+
+    return io.BytesIO(COPY_BINARY_HEADER + rows.tobytes() + COPY_BINARY_TRAILER)
+
+
+def from_copy_binary(data: bytes, dtypes: List[np.dtype]) -> List[np.ndarray]:
+    """
+    Decodes a PostgreSQL binary COPY stream of non-null integer fields into one array per column.
+    """
+    header_extension = int.from_bytes(data[15:19], "big")
+    body = data[19 + header_extension : -len(COPY_BINARY_TRAILER)]
+
+    fields = [("field_count", ">i2")]
+    for i, dtype in enumerate(dtypes):
+        fields += [(f"length_{i}", ">i4"), (f"value_{i}", f">i{np.dtype(dtype).itemsize}")]
+
+    rows = np.frombuffer(body, dtype=fields)
+
+    return [rows[f"value_{i}"].astype(dtype) for i, dtype in enumerate(dtypes)]
+
+
+def collapse_hash_pairs(
+    hashes: np.ndarray, offsets: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Removes the repeated (hash, offset) pairs of a fingerprint. A hash repeated at other offsets
+    (e.g. in each chorus) is kept at each of them.
+
+    :return: The distinct hashes and offsets, sorted by hash then offset.
+    """
+    order = np.lexsort((offsets, hashes))
+    hashes, offsets = hashes[order], offsets[order]
+
+    distinct = np.ones(len(hashes), dtype=bool)
+    distinct[1:] = (hashes[1:] != hashes[:-1]) | (offsets[1:] != offsets[:-1])
+
+    return hashes[distinct], offsets[distinct]
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of connections to a database, shared by all the sessions of a process.
+
+    A session checks out a connection for its whole duration and returns it when it ends.
+    When all the connections are checked out, sessions wait up to `timeout` seconds for one.
+    Connections returned in the middle of a transaction are rolled back and kept, and connections
+    found broken (when returned, or when checked out after being idle) are discarded.
+    """
+
+    def __init__(
+        self,
+        min_size: int = POOL_MIN_SIZE,
+        max_size: int = POOL_MAX_SIZE,
+        timeout: float = POOL_TIMEOUT,
+        **connect_kwargs,
+    ):
+        # The driver is loaded with the first pool : processes that never connect do not import it
+        import psycopg2.pool
+
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            min_size, max_size, **connect_kwargs
+        )
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.last_used: Dict[int, float] = {}
+
+    def is_healthy(self, conn) -> bool:
+        """Checks a connection, with a round trip if it has been idle for a while."""
+        import psycopg2
+
+        if conn.closed:
+            return False
+
+        idle_time = time.monotonic() - self.last_used.get(id(conn), time.monotonic())
+        if idle_time < POOL_HEALTH_CHECK_INTERVAL:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Checks out a healthy connection, waiting for one if they are all in use."""
+        import psycopg2.pool
+
+        if not self.slots.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError(
+                f"No database connection available after {self.timeout} seconds."
+            )
+
+        try:
+            # After a server restart, every idle connection of the pool may be broken : they are
+            # discarded one by one, until the pool returns a healthy one or opens a new one
+            for _ in range(self.max_size + 1):
+                conn = self.pool.getconn()
+                if self.is_healthy(conn):
+                    return conn
+                self.last_used.pop(id(conn), None)
+                self.pool.putconn(conn, close=True)
+
+            raise psycopg2.OperationalError("No healthy database connection could be opened.")
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn):
+        """Returns a connection to the pool, rolling back what its session left uncommitted."""
+        import psycopg2
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+        try:
+            close = bool(conn.closed)
+            if not close and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+
+            if close:
+                self.last_used.pop(id(conn), None)
+            else:
+                self.last_used[id(conn)] = time.monotonic()
+            self.pool.putconn(conn, close=close)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        """Closes all the connections of the pool."""
+        self.pool.closeall()
+
+
+# Connection pools of the process, by process ID and connection parameters
+_pools: Dict[tuple, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(**connect_kwargs) -> ConnectionPool:
+    """
+    Returns the connection pool of the process for the given connection parameters,
+    created on first use. A forked child process gets its own pools, since connections
+    cannot be shared across processes.
+    """
+    key = (os.getpid(), tuple(sorted(connect_kwargs.items())))
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(**connect_kwargs)
+        return _pools[key]
+
+
+def close_pools():
+    """Closes all the connection pools of the process."""
+    with _pools_lock:
+        for (pid, _), pool in list(_pools.items()):
+            if pid == os.getpid():
+                pool.close()
+        _pools.clear()
 
 
 class PostgresDatabase:
@@ -17,35 +233,77 @@ class PostgresDatabase:
         password: str = os.getenv("POSTGRES_PASSWORD"),
         host: str = os.getenv("POSTGRES_HOST"),
         port: str = os.getenv("POSTGRES_PORT"),
+        dsn: Optional[str] = None,
     ):
+        self.pool = None
         self.conn = None
         self.cursor = None
+        self.in_transaction = False
         self.dbname = dbname
         self.user = user
         self.password = password
         self.host = host
         self.port = port
+        self.dsn = dsn
 
     def connect(self):
-        """Establishes a connection to the PostgreSQL database using environment variables."""
-        self.conn = psycopg2.connect(
-            dbname=self.dbname,
-            user=self.user,
-            password=self.password,
-            host=self.host,
-            port=self.port,
-        )
+        """
+        Checks out a connection to the PostgreSQL database from the process-wide pool,
+        opened with the connection string `dsn` if set, with the connection parameters of the
+        environment variables otherwise.
+        """
+        if self.dsn:
+            self.pool = get_pool(dsn=self.dsn)
+        else:
+            self.pool = get_pool(
+                dbname=self.dbname,
+                user=self.user,
+                password=self.password,
+                host=self.host,
+                port=self.port,
+            )
+        self.conn = self.pool.getconn()
         self.cursor = self.conn.cursor()
 
     def disconnect(self):
-        """Closes the database connection."""
+        """Returns the connection to the pool, rolling back any uncommitted work."""
         if self.conn:
-            self.conn.close()
+            if not self.cursor.closed:
+                self.cursor.close()
+            self.pool.putconn(self.conn)
+            self.conn = None
+            self.cursor = None
+
+    def commit(self) -> None:
+        """Commits the current transaction, unless inside a `transaction` block."""
+        if not self.in_transaction:
+            self.conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups every query executed inside the block in a single transaction.
+        The transaction is committed when the block exits and rolled back if it raises.
+        A block nested in another one joins the enclosing transaction.
+        """
+        if self.in_transaction:
+            yield self
+            return
+
+        self.in_transaction = True
+        try:
+            yield self
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self.in_transaction = False
 
     def execute_query(self, query: str, params: Tuple[Any, ...] = ()) -> None:
         """Executes a SQL query."""
         self.cursor.execute(query, params)
-        self.conn.commit()
+        self.commit()
 
     def fetch_all(
         self, query: str, params: Tuple[Any, ...] = ()
@@ -61,6 +319,8 @@ class PostgresDatabase:
 
     def create_table(self, table_name: str, columns: List[str]) -> None:
         """Creates a new table."""
+        from psycopg2 import sql
+
         query = sql.SQL("CREATE TABLE IF NOT EXISTS {table} ({fields})").format(
             table=sql.Identifier(table_name),
             fields=sql.SQL(", ").join(map(sql.SQL, columns)),
@@ -69,6 +329,8 @@ class PostgresDatabase:
 
     def insert(self, table_name: str, data: dict) -> None:
         """Inserts data into a table."""
+        from psycopg2 import sql
+
         columns = sql.SQL(", ").join(map(sql.Identifier, data.keys()))
         values = sql.SQL(", ").join(sql.Placeholder() * len(data))
         query = sql.SQL("INSERT INTO {table} ({columns}) VALUES ({values})").format(
@@ -76,10 +338,36 @@ class PostgresDatabase:
         )
         self.execute_query(query, tuple(data.values()))
 
+    def copy_from(
+        self, table_name: str, columns: List[str], data: List[np.ndarray]
+    ) -> None:
+        """Bulk loads integer columns into a table with a single binary COPY."""
+        from psycopg2 import sql
+
+        query = sql.SQL("COPY {table} ({columns}) FROM STDIN WITH (FORMAT binary)").format(
+            table=sql.Identifier(table_name),
+            columns=sql.SQL(", ").join(map(sql.Identifier, columns)),
+        )
+        self.cursor.copy_expert(query, to_copy_binary(data))
+        self.commit()
+
+    def copy_to(self, query: str, dtypes: List[np.dtype]) -> List[np.ndarray]:
+        """Exports the integer columns of a SELECT query with a single binary COPY."""
+        from psycopg2 import sql
+
+        buffer = io.BytesIO()
+        copy_query = sql.SQL("COPY ({query}) TO STDOUT WITH (FORMAT binary)").format(
+            query=sql.SQL(query)
+        )
+        self.cursor.copy_expert(copy_query, buffer)
+        return from_copy_binary(buffer.getvalue(), dtypes)
+
     def select(
         self, table_name: str, columns: List[str] = ["*"], condition: str = ""
     ) -> List[Tuple[Any, ...]]:
         """Selects data from a table."""
+        from psycopg2 import sql
+
         query = sql.SQL("SELECT {fields} FROM {table} {condition}").format(
             fields=sql.SQL(", ").join(map(sql.Identifier, columns)),
             table=sql.Identifier(table_name),
@@ -89,6 +377,8 @@ class PostgresDatabase:
 
     def update(self, table_name: str, data: dict, condition: str) -> None:
         """Updates data in a table."""
+        from psycopg2 import sql
+
         set_clause = sql.SQL(", ").join(
             [
                 sql.SQL("{} = {}").format(sql.Identifier(k), sql.Placeholder())
@@ -104,6 +394,8 @@ class PostgresDatabase:
 
     def delete(self, table_name: str, condition: str) -> None:
         """Deletes data from a table."""
+        from psycopg2 import sql
+
         query = sql.SQL("DELETE FROM {table} WHERE {condition}").format(
             table=sql.Identifier(table_name), condition=sql.SQL(condition)
         )
@@ -120,6 +412,39 @@ class PostgresDatabase:
 class FingerprintsDatabase(PostgresDatabase):
     def __init__(self):
         super().__init__()
+        self.shards = None
+
+    def connect(self):
+        """
+        Checks out a connection to the main database. When the fingerprints are sharded
+        (FINGERPRINT_SHARDS), the session also gets connections to the shards, opened on first use.
+        """
+        from core.sharding import FINGERPRINT_SHARDS, ShardSet
+
+        super().connect()
+        if FINGERPRINT_SHARDS:
+            self.shards = ShardSet(self)
+
+    def disconnect(self):
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
+        super().disconnect()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups every query executed inside the block in a single transaction, on the main database
+        and on each shard. The shards commit first : if one of them fails, nothing is committed
+        on the main database.
+        """
+        if self.shards is None or self.in_transaction:
+            with super().transaction():
+                yield self
+            return
+
+        with super().transaction(), self.shards.transaction():
+            yield self
 
     def setup(self):
         """Initializes the database with necessary tables."""
@@ -141,8 +466,8 @@ class FingerprintsDatabase(PostgresDatabase):
             [
                 "id SERIAL PRIMARY KEY",
                 "song_id INTEGER REFERENCES songs(id)",
-                "hash VARCHAR(150) NOT NULL",
-                '"offset" FLOAT NOT NULL',
+                "hash BIGINT NOT NULL",
+                '"offset" INTEGER NOT NULL',
             ],
         )
 
@@ -150,6 +475,104 @@ class FingerprintsDatabase(PostgresDatabase):
             "CREATE INDEX IF NOT EXISTS idx_fingerprints_hash ON fingerprints(hash)"
         )
 
+        self.setup_manifest()
+        self.setup_hash_stats()
+        self.setup_settings()
+
+        if self.shards is not None:
+            self.shards.setup()
+
+    def setup_manifest(self):
+        """
+        Creates the ingestion manifest : one row per indexed audio file and fingerprint parameters,
+        recording the content hash of the file and the song stored from it. Copies of a file have
+        a row each, pointing to the same song.
+        """
+        self.create_table(
+            "ingest_manifest",
+            [
+                "file_path VARCHAR(500) NOT NULL",
+                "params_key CHAR(16) NOT NULL",
+                "content_hash CHAR(64) NOT NULL",
+                "file_size BIGINT NOT NULL",
+                "modified_time DOUBLE PRECISION NOT NULL",
+                "song_id INTEGER NOT NULL REFERENCES songs(id)",
+                "ingested_at TIMESTAMP NOT NULL DEFAULT now()",
+                "PRIMARY KEY (file_path, params_key)",
+            ],
+        )
+
+        # Manifests created with one row per content hash
+        query = """
+        SELECT a.attname FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = 'ingest_manifest'::regclass AND i.indisprimary
+        """
+        if self.fetch_one(query)[0] == "content_hash":
+            self.execute_query(
+                """
+                ALTER TABLE ingest_manifest DROP CONSTRAINT ingest_manifest_pkey,
+                    ADD PRIMARY KEY (file_path, params_key)
+                """
+            )
+            self.execute_query("DROP INDEX IF EXISTS idx_ingest_manifest_path")
+
+        self.execute_query(
+            "CREATE INDEX IF NOT EXISTS idx_ingest_manifest_song ON ingest_manifest(song_id)"
+        )
+
+    def setup_hash_stats(self):
+        """
+        Creates the hash statistics : the document frequency of each stored hash, i.e. the number
+        of songs holding it, kept up to date by `insert_fingerprint` and `delete_song`, and the
+        stop-listed pairs : the (song, hash) pairs counted in it whose hash pairs are not stored,
+        so that deleting a song removes it from the count of every hash it held.
+        """
+        self.create_table("hash_stats", ["hash BIGINT PRIMARY KEY", "df INTEGER NOT NULL"])
+        self.create_table(
+            "stop_listed_pairs",
+            [
+                "song_id INTEGER NOT NULL REFERENCES songs(id)",
+                "hash BIGINT NOT NULL",
+                "PRIMARY KEY (song_id, hash)",
+            ],
+        )
+
+    def setup_settings(self):
+        """
+        Creates the catalog settings : values the whole catalog depends on, such as the analysis
+        profile its songs were fingerprinted with.
+        """
+        self.create_table(
+            "catalog_settings", ["name VARCHAR(50) PRIMARY KEY", "value VARCHAR(500) NOT NULL"]
+        )
+
+    def get_setting(self, name: str) -> Union[str, None]:
+        """
+        Retrieves a catalog setting.
+
+        :param name: The name of the setting.
+        :return: Its value, or None if it is not set (or the catalog has no settings yet).
+        """
+        if not self.fetch_one("SELECT to_regclass('catalog_settings') IS NOT NULL")[0]:
+            return None
+
+        result = self.fetch_one("SELECT value FROM catalog_settings WHERE name = %s", (name,))
+        return result[0] if result else None
+
+    def set_setting(self, name: str, value: str):
+        """
+        Sets a catalog setting, replacing its previous value.
+
+        :param name: The name of the setting.
+        :param value: Its value.
+        """
+        query = """
+        INSERT INTO catalog_settings (name, value) VALUES (%s, %s)
+        ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value
+        """
+        self.execute_query(query, (name, value))
+
     def check_existence(self, song_title: str, song_artist: str) -> bool:
         """
         Checks if a song already exists in the database based on its title and artist.
@@ -158,9 +581,81 @@ class FingerprintsDatabase(PostgresDatabase):
         :param song_artist: The artist of the song.
         :return: True if the song exists, False otherwise.
         """
-        query = "SELECT COUNT(*) FROM songs WHERE title = %s AND artists = %s"
+        return self.find_song(song_title, song_artist) is not None
+
+    def find_song(self, song_title: str, song_artist: str) -> Union[int, None]:
+        """
+        Finds a song based on its title and artist.
+
+        :param song_title: The title of the song.
+        :param song_artist: The artist of the song.
+        :return: The ID of the song if it exists, else None.
+        """
+        query = "SELECT id FROM songs WHERE title = %s AND artists = %s LIMIT 1"
         result = self.fetch_one(query, (song_title, song_artist))
-        return result[0] > 0
+        return result[0] if result else None
+
+    def delete_song(self, song_id: int):
+        """
+        Deletes a song with its fingerprints and its manifest entries.
+
+        :param song_id: The ID of the song.
+        """
+        with self.transaction():
+            self.execute_query("DELETE FROM ingest_manifest WHERE song_id = %s", (song_id,))
+            self.remove_hash_stats(
+                np.union1d(self.get_song_hashes(song_id), self.get_stop_listed_hashes(song_id))
+            )
+            self.execute_query("DELETE FROM stop_listed_pairs WHERE song_id = %s", (song_id,))
+            if self.shards is not None:
+                self.shards.delete_song(song_id)
+            else:
+                self.execute_query("DELETE FROM fingerprints WHERE song_id = %s", (song_id,))
+            self.execute_query("DELETE FROM songs WHERE id = %s", (song_id,))
+
+    def get_manifest(self) -> List[dict]:
+        """
+        Retrieves the ingestion manifest.
+
+        :return: One dictionary per indexed file, with its path, size, modification time and content
+            hash, the fingerprint parameters key and the ID of the song stored from it.
+        """
+        query = """
+        SELECT file_path, file_size, modified_time, content_hash, params_key, song_id
+        FROM ingest_manifest
+        """
+        columns = ["file_path", "file_size", "modified_time", "content_hash", "params_key", "song_id"]
+        return [dict(zip(columns, row)) for row in self.fetch_all(query)]
+
+    def add_to_manifest(self, entry: dict):
+        """
+        Records a stored song in the ingestion manifest, replacing any entry with the same file path
+        and fingerprint parameters.
+
+        :param entry: A dictionary with the same keys as the rows of `get_manifest`.
+        """
+        query = """
+        INSERT INTO ingest_manifest
+            (file_path, file_size, modified_time, content_hash, params_key, song_id)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (file_path, params_key) DO UPDATE SET
+            content_hash = EXCLUDED.content_hash,
+            file_size = EXCLUDED.file_size,
+            modified_time = EXCLUDED.modified_time,
+            song_id = EXCLUDED.song_id,
+            ingested_at = now()
+        """
+        self.execute_query(
+            query,
+            (
+                entry["file_path"],
+                entry["file_size"],
+                entry["modified_time"],
+                entry["content_hash"],
+                entry["params_key"],
+                entry["song_id"],
+            ),
+        )
 
     def insert_song(self, song_details: dict) -> int:
         """
@@ -175,55 +670,443 @@ class FingerprintsDatabase(PostgresDatabase):
 
     def insert_fingerprint(self, fingerprint: SongFingerprint):
         """
-        Inserts a list of fingerprints into the fingerprints table.
+        Inserts the hash pairs of a fingerprint into the fingerprints table with a single COPY.
+
+        Repeated hash pairs are stored once, and the document frequency of the hashes of the song
+        is updated. Stop-listed hashes (held by more than HASH_MAX_DF songs) are counted but not
+        stored, and recorded in the stop-listed pairs of the song.
+
+        :param fingerprint: The fingerprint to store, with its song ID set.
+        """
+        hashes, offsets = collapse_hash_pairs(*fingerprint.get_arrays())
+
+        stop_listed = self.add_hash_stats(np.unique(hashes))
+        if len(stop_listed):
+            kept = ~np.isin(hashes, stop_listed)
+            hashes, offsets = hashes[kept], offsets[kept]
+            self.copy_from(
+                "stop_listed_pairs",
+                ["song_id", "hash"],
+                [np.full(len(stop_listed), fingerprint.get_song_id(), dtype=np.int32), stop_listed],
+            )
+
+        song_ids = np.full(len(hashes), fingerprint.get_song_id(), dtype=np.int32)
+
+        if self.shards is not None:
+            self.shards.insert(song_ids, hashes, offsets)
+            return
+
+        self.copy_from("fingerprints", ["song_id", "hash", "offset"], [song_ids, hashes, offsets])
+
+    def add_hash_stats(self, hashes: np.ndarray, max_df: int = HASH_MAX_DF) -> np.ndarray:
+        """
+        Counts a new song in the document frequency of its hashes.
+
+        :param hashes: The distinct hashes of the song, sorted (so that concurrent imports lock
+            the rows of the statistics in the same order).
+        :param max_df: The stop-list threshold, 0 to disable it.
+        :return: The hashes of the song that are now stop-listed.
+        """
+        query = """
+        WITH counted AS (
+            INSERT INTO hash_stats (hash, df)
+            SELECT hash, 1 FROM unnest(%s::bigint[]) AS h(hash)
+            ON CONFLICT (hash) DO UPDATE SET df = hash_stats.df + 1
+            RETURNING hash, df
+        )
+        SELECT hash FROM counted WHERE %s > 0 AND df > %s
+        """
+        rows = self.fetch_all(query, (hashes.tolist(), max_df, max_df))
+        return np.array([row[0] for row in rows], dtype=np.int64)
+
+    def remove_hash_stats(self, hashes: np.ndarray):
+        """
+        Removes a deleted song from the document frequency of its hashes.
+
+        :param hashes: The distinct hashes of the song, stored or stop-listed.
+        """
+        hashes = hashes.tolist()
+        self.execute_query("UPDATE hash_stats SET df = df - 1 WHERE hash = ANY(%s)", (hashes,))
+        self.execute_query("DELETE FROM hash_stats WHERE hash = ANY(%s) AND df <= 0", (hashes,))
+
+    def get_song_hashes(self, song_id: int) -> np.ndarray:
+        """Returns the distinct hashes stored for a song."""
+        if self.shards is not None:
+            return self.shards.get_song_hashes(song_id)
+
+        query = self.cursor.mogrify(
+            "SELECT DISTINCT hash FROM fingerprints WHERE song_id = %s", (song_id,)
+        )
+        return self.copy_to(query.decode(), [np.int64])[0]
+
+    def get_stop_listed_hashes(self, song_id: int) -> np.ndarray:
+        """Returns the hashes of a song that are counted in the statistics but not stored."""
+        query = self.cursor.mogrify(
+            "SELECT hash FROM stop_listed_pairs WHERE song_id = %s", (song_id,)
+        )
+        return self.copy_to(query.decode(), [np.int64])[0]
+
+    def get_stop_list(self, max_df: int = HASH_MAX_DF) -> np.ndarray:
+        """
+        Returns the stop-listed hashes : the ones held by more than `max_df` songs, sorted.
+        """
+        query = f"SELECT hash FROM hash_stats WHERE df > {int(max_df)} ORDER BY hash"
+        return self.copy_to(query, [np.int64])[0]
+
+    def get_hash_stats(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the hashes of the statistics and their document frequency."""
+        return tuple(self.copy_to("SELECT hash, df FROM hash_stats", [np.int64, np.int32]))
 
-        :param song_id: The ID of the song to which the fingerprints belong.
-        :param fingerprints: A list of tuples, each containing a fingerprint hash and its offset.
+    def rebuild_hash_stats(self):
         """
-        song_id = fingerprint.get_song_id()
+        Recounts the document frequency of the hashes from the fingerprints table and the
+        stop-listed pairs, e.g. for a catalog imported before the statistics existed.
+        """
+        if self.shards is not None:
+            stored_hashes, stored_dfs = self.shards.count_hashes()
+            stop_listed_hashes, stop_listed_dfs = self.copy_to(
+                "SELECT hash, COUNT(*)::integer FROM stop_listed_pairs GROUP BY hash",
+                [np.int64, np.int32],
+            )
+            # The hash pairs of a song are either stored or stop-listed : `prune_stop_listed` only
+            # leaves both when it is interrupted, and running it again deletes the stored ones
+            hashes, inverse = np.unique(
+                np.concatenate([stored_hashes, stop_listed_hashes]), return_inverse=True
+            )
+            dfs = np.bincount(
+                inverse, weights=np.concatenate([stored_dfs, stop_listed_dfs])
+            ).astype(np.int32)
+        else:
+            hashes, dfs = self.copy_to(
+                """
+                SELECT hash, COUNT(DISTINCT song_id)::integer FROM (
+                    SELECT song_id, hash FROM fingerprints WHERE song_id IS NOT NULL
+                    UNION ALL SELECT song_id, hash FROM stop_listed_pairs
+                ) AS pairs GROUP BY hash
+                """,
+                [np.int64, np.int32],
+            )
+
+        with self.transaction():
+            self.execute_query("TRUNCATE hash_stats")
+            self.copy_from("hash_stats", ["hash", "df"], [hashes, dfs])
+
+    def prune_stop_listed(self, max_df: int = HASH_MAX_DF) -> int:
+        """
+        Deletes the stored hash pairs of the stop-listed hashes, e.g. after lowering HASH_MAX_DF or
+        for hashes that became common after songs holding them were stored. The songs holding them
+        are recorded in the stop-listed pairs first, so that they stay counted.
+
+        :return: The number of hash pairs deleted.
+        """
+        stop_list = self.get_stop_list(max_df).tolist()
+        if not stop_list:
+            return 0
+
+        if self.shards is not None:
+            song_ids, hashes = self.shards.get_hash_songs(stop_list)
+            with self.transaction():
+                self.execute_query(
+                    "CREATE TEMPORARY TABLE pruned_pairs (song_id INTEGER, hash BIGINT) "
+                    "ON COMMIT DROP"
+                )
+                self.copy_from("pruned_pairs", ["song_id", "hash"], [song_ids, hashes])
+                self.execute_query(
+                    "INSERT INTO stop_listed_pairs (song_id, hash) "
+                    "SELECT song_id, hash FROM pruned_pairs ON CONFLICT DO NOTHING"
+                )
+            return self.shards.delete_hashes(stop_list)
 
-        for hash_value, offset in fingerprint:
-            data = {"song_id": song_id, "hash": hash_value, "offset": offset}
-            self.insert("fingerprints", data)
+        with self.transaction():
+            self.execute_query(
+                """
+                INSERT INTO stop_listed_pairs (song_id, hash)
+                SELECT DISTINCT song_id, hash FROM fingerprints
+                WHERE hash = ANY(%s) AND song_id IS NOT NULL
+                ON CONFLICT DO NOTHING
+                """,
+                (stop_list,),
+            )
+            self.execute_query("DELETE FROM fingerprints WHERE hash = ANY(%s)", (stop_list,))
+            return self.cursor.rowcount
 
     def identify_song(
-        self, query_fingerprints: List[Tuple[str, float]]
-    ) -> List[Tuple[int, Optional[int]]]:
+        self, query_fingerprints: List[Tuple[int, int]], top_k: int = DEFAULT_TOP_K
+    ) -> List[SongMatch]:
         """
         Identifies a song based on a list of fingerprint hashes.
 
+        Candidates are scored by the histogram of offset differences (song offset - query offset)
+        of their matching hashes : the score of a song is the height of its highest bin, i.e. the
+        number of hashes aligned in time with the query. The aggregation runs in the database and
+        only the `top_k` best candidates are returned, with the total number of matching rows.
+
         :param query_fingerprints: A list of tuples, each containing a fingerprint hash and its offset.
-        :return: The title of the identified song.
+        :param top_k: The maximum number of candidates to return.
+        :return: The candidates ranked by decreasing score, empty if no hash matched.
         """
-        query_hashes = [fp[0] for fp in query_fingerprints]
+        start_time = time.perf_counter()
+        query_hashes, query_offsets = to_hash_arrays(query_fingerprints)
 
-        if not query_hashes:
+        if len(query_hashes) == 0:
             raise ValueError("Empty fingerprint list provided.")
 
+        if self.shards is not None:
+            return self.shards.identify_song(query_hashes, query_offsets, top_k=top_k)
+
         query = """
-        SELECT song_id
-        FROM fingerprints
-        WHERE hash = ANY(%s)
+        WITH query AS (
+            SELECT * FROM unnest(%s::bigint[], %s::integer[]) AS q(hash, "offset")
+        ),
+        histogram AS (
+            SELECT f.song_id, f."offset" - q."offset" AS delta, COUNT(*) AS score
+            FROM fingerprints f
+            JOIN query q ON f.hash = q.hash
+            GROUP BY f.song_id, delta
+        ),
+        best_delta AS (
+            SELECT DISTINCT ON (song_id) song_id, score, delta
+            FROM histogram
+            ORDER BY song_id, score DESC
+        )
+        SELECT song_id, score, delta, (SELECT SUM(score) FROM histogram) AS matched_rows
+        FROM best_delta
+        ORDER BY score DESC
+        LIMIT %s
         """
 
-        matching_rows = self.fetch_all(query, (query_hashes,))
+        rows = self.fetch_all(query, (query_hashes.tolist(), query_offsets.tolist(), top_k + 1))
 
-        if not matching_rows:
-            return None
+        record_query(
+            "postgres",
+            time.perf_counter() - start_time,
+            nb_hashes=len(query_hashes),
+            matched_rows=int(rows[0][3]) if rows else 0,
+        )
+
+        return rank_matches([row[:3] for row in rows])[:top_k]
 
-        song_id_counts = Counter(row[0] for row in matching_rows)
+    def identify_songs_batch(
+        self,
+        queries: List[List[Tuple[int, int]]],
+        top_k: int = DEFAULT_TOP_K,
+        batch_size: int = BATCH_MAX_QUERIES,
+    ) -> List[List[SongMatch]]:
+        """
+        Identifies many songs at once, with the same scoring as `identify_song`.
 
-        most_commons_song_id = song_id_counts.most_common(2)
-        best_match_song_id = most_commons_song_id[0][0]
-        second_best_match_song_id = (
-            most_commons_song_id[1][0] if len(most_commons_song_id) > 1 else None
+        The queries of a batch are sent in a single statement : the union of their hashes is
+        deduplicated and probed once in the fingerprints table, then the matching rows are joined
+        back to each query for its own offset histogram, ranked per query in the database.
+
+        :param queries: A list of queries, each a list of (hash, offset) tuples.
+        :param top_k: The maximum number of candidates to return per query.
+        :param batch_size: The maximum number of queries matched per statement.
+        :return: The candidates of each query ranked by decreasing score, empty if no hash matched
+            (or if the query is empty).
+        """
+        query = """
+        WITH query AS (
+            SELECT * FROM unnest(%s::integer[], %s::bigint[], %s::integer[])
+                AS q(query_id, hash, "offset")
+        ),
+        postings AS MATERIALIZED (
+            SELECT f.hash, f.song_id, f."offset"
+            FROM fingerprints f
+            WHERE f.hash = ANY(ARRAY(SELECT DISTINCT hash FROM query))
+        ),
+        histogram AS (
+            SELECT q.query_id, p.song_id, p."offset" - q."offset" AS delta, COUNT(*) AS score
+            FROM postings p
+            JOIN query q ON p.hash = q.hash
+            GROUP BY q.query_id, p.song_id, delta
+        ),
+        best_delta AS (
+            SELECT DISTINCT ON (query_id, song_id) query_id, song_id, score, delta
+            FROM histogram
+            ORDER BY query_id, song_id, score DESC
+        ),
+        ranked AS (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY query_id ORDER BY score DESC) AS rank
+            FROM best_delta
         )
+        SELECT query_id, song_id, score, delta, (SELECT SUM(score) FROM histogram)
+        FROM ranked
+        WHERE rank <= %s
+        ORDER BY query_id, rank
+        """
+
+        queries = [to_hash_arrays(query_pairs) for query_pairs in queries]
+        results = []
+
+        if self.shards is not None:
+            for first in range(0, len(queries), batch_size):
+                batch = queries[first : first + batch_size]
+                results += self.shards.identify_songs_batch(batch, top_k=top_k)
+            return results
+
+        for first in range(0, len(queries), batch_size):
+            start_time = time.perf_counter()
+            batch = queries[first : first + batch_size]
+
+            query_ids = np.repeat(np.arange(len(batch)), [len(hashes) for hashes, _ in batch])
+            query_hashes = np.concatenate([hashes for hashes, _ in batch])
+            query_offsets = np.concatenate([offsets for _, offsets in batch])
+
+            rows = []
+            if len(query_hashes):
+                rows = self.fetch_all(
+                    query,
+                    (
+                        query_ids.tolist(),
+                        query_hashes.tolist(),
+                        query_offsets.tolist(),
+                        top_k + 1,
+                    ),
+                )
+
+            record_query(
+                "postgres",
+                time.perf_counter() - start_time,
+                nb_hashes=len(query_hashes),
+                matched_rows=int(rows[0][4]) if rows else 0,
+            )
+
+            candidates = [[] for _ in batch]
+            for query_id, song_id, score, delta, _ in rows:
+                candidates[query_id].append((song_id, score, delta))
+            results += [rank_matches(c)[:top_k] for c in candidates]
+
+        return results
+
+    def get_song_details_by_id(self, song_id: int) -> Union[dict, None]:
+        """
+        Retrieves the details of a song based on its ID.
+
+        :param song_id: The ID of the song.
+        :return: A dictionary containing the song's details if it exists, else None.
+        """
+        query = "SELECT * FROM songs WHERE id = %s"
+        return self.to_song_details(self.fetch_one(query, (song_id,)))
+
+    def export_fingerprints(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Exports the whole fingerprints table as arrays.
+
+        :return: The hashes (int64), song IDs (int32) and offsets (int32) of every stored hash pair.
+        """
+        if self.shards is not None:
+            return self.shards.export()
+
+        query = 'SELECT hash, song_id, "offset" FROM fingerprints WHERE song_id IS NOT NULL'
+        hashes, song_ids, offsets = self.copy_to(query, [np.int64, np.int32, np.int32])
 
-        return (
-            (best_match_song_id, second_best_match_song_id)
-            if second_best_match_song_id
-            else best_match_song_id
+        return hashes, song_ids, offsets
+
+    def get_catalog_stats(self, max_df: int = HASH_MAX_DF) -> dict:
+        """
+        Returns the size of the catalog.
+
+        :param max_df: The stop-list threshold, no stop-listed hashes are counted if 0.
+        :return: A dictionary with the number of `songs`, of stored `hash_pairs`, of files in the
+            ingestion manifest, and of `distinct_hashes` and `stop_listed_hashes` according to
+            the hash statistics.
+        """
+        songs = self.fetch_one("SELECT COUNT(*) FROM songs")[0]
+        manifest = self.fetch_one("SELECT COUNT(*) FROM ingest_manifest")[0]
+
+        if self.shards is not None:
+            hash_pairs = self.shards.count_rows()
+        else:
+            query = "SELECT COUNT(*) FROM fingerprints WHERE song_id IS NOT NULL"
+            hash_pairs = self.fetch_one(query)[0]
+
+        query = "SELECT COUNT(*), COUNT(*) FILTER (WHERE df > %s) FROM hash_stats"
+        distinct_hashes, stop_listed = self.fetch_one(query, (int(max_df) if max_df else None,))
+
+        return {
+            "songs": songs,
+            "hash_pairs": hash_pairs,
+            "manifest_files": manifest,
+            "distinct_hashes": distinct_hashes,
+            "stop_listed_hashes": stop_listed,
+        }
+
+    def get_table_sizes(self) -> dict:
+        """
+        Returns the on-disk size (in bytes) of the fingerprints table and of its hash index.
+
+        :return: A dictionary with the table, index and total relation sizes.
+        """
+        query = """
+        SELECT
+            pg_relation_size('fingerprints'),
+            pg_relation_size('idx_fingerprints_hash'),
+            pg_total_relation_size('fingerprints')
+        """
+        table_size, index_size, total_size = self.fetch_one(query)
+
+        return {"table": table_size, "index": index_size, "total": total_size}
+
+    def get_hash_column_type(self) -> str:
+        """
+        Returns the SQL type of the `hash` column of the fingerprints table.
+
+        :return: The data type name, e.g. 'bigint' or 'character varying'.
+        """
+        query = """
+        SELECT data_type
+        FROM information_schema.columns
+        WHERE table_name = 'fingerprints' AND column_name = 'hash'
+        """
+        return self.fetch_one(query)[0]
+
+    def migrate_fingerprints(
+        self, sampling_rate: int, window_size: int, hop_length: int
+    ) -> bool:
+        """
+        Converts a catalog stored with text hashes ("1234|5678|0.46", frequencies in Hz and time delta
+        in seconds) and float offsets (in seconds) in place to packed BIGINT hashes and INTEGER frame offsets.
+
+        The spectrogram parameters must be the ones the catalog was built with, so that frequencies and
+        times map back to the exact frequency bins and frame indices. Hashes already stored as integers
+        in the text column are cast directly. The hash index is rebuilt by PostgreSQL during the rewrite.
+
+        :param sampling_rate: Sampling rate (in Hz) the songs were analyzed at.
+        :param window_size: FFT window size (in samples) of the spectrogram.
+        :param hop_length: Number of samples between two consecutive spectrogram frames.
+        :return: True if the table was converted, False if it already uses the integer format.
+        """
+        from psycopg2 import sql
+
+        if self.get_hash_column_type() == "bigint":
+            return False
+
+        bin_width = sampling_rate / window_size
+        frame_duration = hop_length / sampling_rate
+        first_frame_time = window_size / 2 / sampling_rate
+
+        query = sql.SQL(
+            """
+            ALTER TABLE fingerprints
+            ALTER COLUMN hash TYPE BIGINT USING (
+                CASE WHEN strpos(hash, '|') > 0 THEN
+                    (round(split_part(hash, '|', 1)::float / {bin_width})::bigint << 32)
+                    | (round(split_part(hash, '|', 2)::float / {bin_width})::bigint << 16)
+                    | round(split_part(hash, '|', 3)::float / {frame_duration})::bigint
+                ELSE hash::bigint END
+            ),
+            ALTER COLUMN "offset" TYPE INTEGER USING
+                round(("offset" - {first_frame_time}) / {frame_duration})::integer
+            """
+        ).format(
+            bin_width=sql.Literal(bin_width),
+            frame_duration=sql.Literal(frame_duration),
+            first_frame_time=sql.Literal(first_frame_time),
         )
+        self.execute_query(query)
+
+        return True
 
     def get_song_details(self, song_title: str) -> Union[dict, None]:
         """
@@ -233,14 +1116,17 @@ class FingerprintsDatabase(PostgresDatabase):
         :return: A dictionary containing the song's details if it exists, else None.
         """
         query = "SELECT * FROM songs WHERE title = %s"
-        result = self.fetch_one(query, (song_title,))
+        return self.to_song_details(self.fetch_one(query, (song_title,)))
 
-        if result:
+    @staticmethod
+    def to_song_details(row: Tuple[Any, ...]) -> Union[dict, None]:
+        """Converts a row of the songs table into a dictionary of song details."""
+        if row:
             return {
-                "title": result[1],
-                "artists": result[2],
-                "album": result[3],
-                "lyrics": result[4],
-                "cover": result[5],
-                "url": result[6],
+                "title": row[1],
+                "artists": row[2],
+                "album": row[3],
+                "lyrics": row[4],
+                "cover": row[5],
+                "url": row[6],
             }
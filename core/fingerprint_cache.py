@@ -0,0 +1,297 @@
+import os
+import json
+import hashlib
+import zipfile
+import argparse
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+from termcolor import colored
+
+from core.audio_processing import (
+    create_spectrogram,
+    get_peaks,
+    compute_hashes,
+    fingerprint_from_hashes,
+    stream_fingerprint,
+    DEFAULT_WINDOW_SIZE,
+    DEFAULT_WINDOW_RATIO,
+    PEAK_NEIGHBORHOOD_SIZE,
+    DEFAULT_AMPLITUDE_THRESHOLD,
+    DEFAULT_FAN_VALUE,
+    MAX_HASH_TIME_DELTA,
+    HASH_FIELD_BITS,
+)
+from models.song_fingerprint import SongFingerprint
+from utils.audio_utils import load_audio, stream_audio, hash_file, DEFAULT_SAMPLING_RATE
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Directory of the on-disk cache of the intermediate results of the fingerprint pipeline.
+# The cache is disabled when it is not set.
+FINGERPRINT_CACHE_DIR = os.getenv("FINGERPRINT_CACHE_DIR")
+
+# Maximum size (in MB) of the cache. The least recently used entries are evicted beyond it.
+FINGERPRINT_CACHE_MAX_SIZE_MB = int(os.getenv("FINGERPRINT_CACHE_MAX_SIZE_MB", 10240))
+
+# Stages of the pipeline whose results are cached, in order : each one is computed from the
+# previous one, and its key depends on the key of the previous one and on its own parameters.
+#   audio : resampled mono PCM samples
+#   peaks : peaks of the spectrogram, with its frequencies and frame times
+#   hashes : packed hashes and their offsets
+CACHE_STAGES = ["audio", "peaks", "hashes"]
+
+# ------------------------------------------------------------------------------------------------- #
+
+
+class FingerprintCache:
+    """
+    On-disk cache of the intermediate results of the fingerprint pipeline, stored as compressed
+    `.npz` files keyed by the content hash of the audio file and the parameters of each stage.
+
+    Changing a parameter only invalidates its stage and the following ones : re-indexing with a new
+    fan value reuses the cached peaks, a new peak neighborhood reuses the decoded audio.
+    The size of the cache is capped, the least recently used entries being evicted first.
+    """
+
+    def __init__(
+        self, cache_dir: str, max_size: int = FINGERPRINT_CACHE_MAX_SIZE_MB << 20
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.stats = {stage: {"hits": 0, "misses": 0} for stage in CACHE_STAGES}
+        self.lock = threading.Lock()
+
+        for stage in CACHE_STAGES:
+            os.makedirs(os.path.join(cache_dir, stage), exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path, _ in self.entries())
+
+    @staticmethod
+    def key(parent_key: str, params: dict) -> str:
+        """Key of a stage result, computed from the key of its input and its parameters."""
+        content = json.dumps([parent_key, params], sort_keys=True).encode()
+        return hashlib.sha256(content).hexdigest()
+
+    def path(self, stage: str, key: str) -> str:
+        return os.path.join(self.cache_dir, stage, f"{key}.npz")
+
+    def entries(self):
+        """Yields the (path, last use time) of every entry of the cache."""
+        for stage in CACHE_STAGES:
+            with os.scandir(os.path.join(self.cache_dir, stage)) as it:
+                for entry in it:
+                    if entry.name.endswith(".npz"):
+                        yield entry.path, entry.stat().st_mtime
+
+    def load(self, stage: str, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Loads the arrays of a stage result, marking it as recently used.
+
+        :return: The arrays by name, or None if the result is not in the cache.
+        """
+        path = self.path(stage, key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # Missing, evicted by another process meanwhile, or corrupted entry
+            with self.lock:
+                self.stats[stage]["misses"] += 1
+            return None
+
+        with self.lock:
+            self.stats[stage]["hits"] += 1
+        return arrays
+
+    def store(self, stage: str, key: str, **arrays: np.ndarray):
+        """Stores the arrays of a stage result, then evicts entries if the cache is too large."""
+        path = self.path(stage, key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+
+        with open(temp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            self.size += os.path.getsize(path)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in 90% of its maximum size."""
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        self.size = sum(os.path.getsize(path) for path, _ in entries)
+
+        for path, _ in entries:
+            if self.size <= 0.9 * self.max_size:
+                break
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def get_stats(self) -> dict:
+        """Returns the hits and misses of each stage since the cache was opened, and its size."""
+        with self.lock:
+            return {
+                "stages": {stage: dict(counts) for stage, counts in self.stats.items()},
+                "size": self.size,
+            }
+
+
+# Cache of the process, opened on first use
+_shared_cache: Optional[FingerprintCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_fingerprint_cache() -> Optional[FingerprintCache]:
+    """
+    Returns the fingerprint cache of the process, opened on first use at FINGERPRINT_CACHE_DIR,
+    or None if the cache is disabled.
+    """
+    global _shared_cache
+
+    if not FINGERPRINT_CACHE_DIR:
+        return None
+
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = FingerprintCache(FINGERPRINT_CACHE_DIR)
+        return _shared_cache
+
+
+def fingerprint_file_cached(
+    cache: FingerprintCache,
+    file_path: str,
+    content_hash: Optional[str] = None,
+    streaming: bool = False,
+    sr: int = DEFAULT_SAMPLING_RATE,
+    wsize: int = DEFAULT_WINDOW_SIZE,
+    wratio: float = DEFAULT_WINDOW_RATIO,
+    neighborhood_size: int = PEAK_NEIGHBORHOOD_SIZE,
+    amp_thres: int = DEFAULT_AMPLITUDE_THRESHOLD,
+    fan_value: int = DEFAULT_FAN_VALUE,
+    max_frequency: Optional[float] = None,
+) -> SongFingerprint:
+    """
+    Fingerprint an audio file, reusing the results cached for its content and computing only the
+    stages downstream of the last cached one.
+
+    With `streaming`, the file is fingerprinted with the bounded-memory pipeline and only the
+    hashes are cached, the decoded audio and the peaks of a long file being too large to keep.
+
+    :param content_hash: The content hash of the file, if already known.
+    """
+    if content_hash is None:
+        content_hash = hash_file(file_path)
+
+    peaks_params = {
+        "window_size": wsize,
+        "window_ratio": wratio,
+        "neighborhood_size": neighborhood_size,
+        "amplitude_threshold": amp_thres,
+    }
+    # Only band-limited spectrograms have the parameter, so that the full band keeps its entries
+    if max_frequency is not None:
+        peaks_params["max_frequency"] = max_frequency
+
+    audio_key = cache.key(content_hash, {"sampling_rate": sr})
+    peaks_key = cache.key(audio_key, peaks_params)
+    hashes_key = cache.key(
+        peaks_key,
+        {
+            "fan_value": fan_value,
+            "max_hash_time_delta": MAX_HASH_TIME_DELTA,
+            "hash_field_bits": HASH_FIELD_BITS,
+        },
+    )
+
+    cached = cache.load("hashes", hashes_key)
+    if cached is not None:
+        return fingerprint_from_hashes(cached["hashes"], cached["offsets"])
+
+    if streaming:
+        hash_batches = list(
+            stream_fingerprint(
+                stream_audio(file_path, sr=sr),
+                sr=sr,
+                wsize=wsize,
+                wratio=wratio,
+                neighborhood_size=neighborhood_size,
+                amp_thres=amp_thres,
+                fan_value=fan_value,
+                max_frequency=max_frequency,
+            )
+        )
+        hashes, offsets = map(
+            np.concatenate,
+            zip(*hash_batches, (np.empty(0, np.int64), np.empty(0, np.int32))),
+        )
+
+    else:
+        peaks = cache.load("peaks", peaks_key)
+        if peaks is None:
+            audio = cache.load("audio", audio_key)
+            if audio is None:
+                y, _ = load_audio(file_path=file_path, sr=sr)
+                audio = {"y": np.asarray(y, dtype=np.float32)}
+                cache.store("audio", audio_key, **audio)
+
+            spectrogram, freqs, times = create_spectrogram(
+                y=audio["y"], sr=sr, wsize=wsize, wratio=wratio, max_frequency=max_frequency
+            )
+            peaks = {
+                "peaks": np.asarray(
+                    get_peaks(
+                        spectrogram=spectrogram,
+                        neighborhood_size=neighborhood_size,
+                        amp_thres=amp_thres,
+                    ),
+                    dtype=np.float64,
+                ).reshape(-1, 3),
+                "freqs": freqs,
+                "times": times,
+            }
+            cache.store("peaks", peaks_key, **peaks)
+
+        hashes, offsets = compute_hashes(
+            peaks["peaks"], peaks["times"], fan_value=fan_value
+        )
+
+    cache.store("hashes", hashes_key, hashes=hashes, offsets=offsets)
+
+    return fingerprint_from_hashes(hashes, offsets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the fingerprint cache.")
+    parser.add_argument("command", choices=["info", "clear"])
+    parser.add_argument(
+        "--dir", default=FINGERPRINT_CACHE_DIR, help="Directory of the cache."
+    )
+    args = parser.parse_args()
+
+    if not args.dir:
+        parser.error("Set FINGERPRINT_CACHE_DIR or pass --dir.")
+
+    cache = FingerprintCache(args.dir)
+
+    if args.command == "info":
+        for stage in CACHE_STAGES:
+            paths = [path for path, _ in cache.entries() if f"{os.sep}{stage}{os.sep}" in path]
+            size = sum(os.path.getsize(path) for path in paths)
+            print(f"{stage} : {len(paths)} entries, {size / (1 << 20):.1f} MB")
+        print(f"Total : {cache.size / (1 << 20):.1f} MB / {cache.max_size / (1 << 20):.0f} MB")
+
+    elif args.command == "clear":
+        for path, _ in cache.entries():
+            os.remove(path)
+        print(colored(f"Cache {args.dir} cleared.", color="green"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+import os
+import time
+import argparse
+import threading
+from typing import List, Tuple, Optional
+
+import numpy as np
+from termcolor import colored
+
+import __init__
+from core.database import FingerprintsDatabase, DEFAULT_TOP_K, HASH_MAX_DF
+from core.index_file import write_index_file, open_index_file, verify_index_file
+from core.metrics import record_query
+from models.song_fingerprint import to_hash_arrays
+from models.song_match import SongMatch, rank_matches
+
+# Path of a prebuilt index file, opened with mmap instead of loading the index from the database.
+# Build it with `python -m core.fingerprint_index build <path>`.
+FINGERPRINT_INDEX_PATH = os.getenv("FINGERPRINT_INDEX_PATH")
+
+
+def score_offset_alignment(
+    song_ids: np.ndarray,
+    deltas: np.ndarray,
+    top_k: int = DEFAULT_TOP_K,
+    weights: Optional[np.ndarray] = None,
+) -> List[SongMatch]:
+    """
+    Scores candidate songs by the histogram of their offset differences (song offset - query offset).
+    The score of a song is the height of its highest bin.
+
+    :param song_ids: Song ID of each matching posting.
+    :param deltas: Offset difference of each matching posting.
+    :param top_k: The maximum number of candidates to return.
+    :param weights: Number of postings of each (song ID, delta) entry, when they are partial
+        histograms (of several shards) rather than single postings.
+    :return: The candidates ranked by decreasing score.
+    """
+    if len(song_ids) == 0:
+        return []
+
+    # Count the postings of each (song, delta) bin
+    bins = (song_ids.astype(np.int64) << 32) | (deltas.astype(np.int64) & 0xFFFFFFFF)
+    if weights is None:
+        bins, counts = np.unique(bins, return_counts=True)
+    else:
+        bins, inverse = np.unique(bins, return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(bins))
+        counts = counts.astype(np.int64)
+    bin_song_ids = bins >> 32
+
+    # Keep the highest bin of each song : bins are sorted by song, then by count
+    order = np.lexsort((counts, bin_song_ids))
+    last_of_song = np.append(bin_song_ids[order][1:] != bin_song_ids[order][:-1], True)
+    best = order[last_of_song]
+
+    # Select the top candidates (one more to compute the margin of the last one)
+    if len(best) > top_k + 1:
+        best = best[np.argpartition(-counts[best], top_k)[: top_k + 1]]
+
+    best_deltas = (bins[best] & 0xFFFFFFFF).astype(np.uint32).view(np.int32)
+    candidates = zip(
+        bin_song_ids[best].tolist(), counts[best].tolist(), best_deltas.tolist()
+    )
+
+    return rank_matches(list(candidates))[:top_k]
+
+
+class FingerprintIndex:
+    """
+    In-memory inverted index of the fingerprints table.
+
+    Hash pairs are stored as sorted NumPy arrays : `keys` holds the distinct hashes in increasing
+    order and `starts[i]:starts[i + 1]` delimits the postings (song ID, offset) of `keys[i]`.
+    Lookups are answered with a single batch `searchsorted` probe and scored in memory.
+    PostgreSQL stays the system of record : the index is (re)built from it with `refresh`,
+    leaving out the hashes stop-listed at that time when HASH_MAX_DF is set (`max_df`), so that
+    lookups need no stop-list.
+    """
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.starts = np.zeros(1, dtype=np.int64)
+        self.song_ids = np.empty(0, dtype=np.int32)
+        self.offsets = np.empty(0, dtype=np.int32)
+        self.max_df = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.song_ids)
+
+    @classmethod
+    def from_arrays(
+        cls, hashes: np.ndarray, song_ids: np.ndarray, offsets: np.ndarray
+    ) -> "FingerprintIndex":
+        """Builds an index from the columns of the fingerprints table."""
+        index = cls()
+        index.set_arrays(*cls.build_arrays(hashes, song_ids, offsets))
+        return index
+
+    @classmethod
+    def from_database(cls, db: FingerprintsDatabase) -> "FingerprintIndex":
+        """Builds an index from the fingerprints table, without the stop-listed hashes."""
+        index = cls()
+        index.refresh(db)
+        return index
+
+    @classmethod
+    def from_file(cls, file_path: str, verify: bool = False) -> "FingerprintIndex":
+        """
+        Opens an index file with mmap : the arrays are served from the shared page cache.
+
+        :param file_path: The path to the index file.
+        :param verify: Also check the checksum of the whole file before serving it.
+        """
+        arrays = open_index_file(file_path, verify=verify)
+        index = cls()
+        index.set_arrays(
+            arrays["keys"],
+            arrays["starts"],
+            arrays["song_ids"],
+            arrays["offsets"],
+            max_df=arrays["max_df"],
+        )
+        return index
+
+    def save(self, file_path: str):
+        """Writes the index to a file that can be opened with `from_file`."""
+        with self.lock:
+            write_index_file(
+                file_path,
+                self.keys,
+                self.starts,
+                self.song_ids,
+                self.offsets,
+                max_df=self.max_df,
+            )
+
+    @staticmethod
+    def build_arrays(
+        hashes: np.ndarray, song_ids: np.ndarray, offsets: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Sorts the hash pairs by hash and groups them into (keys, starts, song_ids, offsets)."""
+        order = np.argsort(hashes, kind="stable")
+        hashes = hashes[order]
+
+        keys, starts = np.unique(hashes, return_index=True)
+        starts = np.append(starts, len(hashes)).astype(np.int64)
+
+        return (
+            keys,
+            starts,
+            song_ids[order].astype(np.int32),
+            offsets[order].astype(np.int32),
+        )
+
+    def set_arrays(
+        self,
+        keys: np.ndarray,
+        starts: np.ndarray,
+        song_ids: np.ndarray,
+        offsets: np.ndarray,
+        max_df: int = 0,
+    ):
+        """
+        Atomically replaces the content of the index. `max_df` is the stop-list threshold whose
+        stop-listed hashes were left out of the arrays, 0 if none were.
+        """
+        with self.lock:
+            self.keys, self.starts, self.song_ids, self.offsets, self.max_df = (
+                keys,
+                starts,
+                song_ids,
+                offsets,
+                max_df,
+            )
+
+    def refresh(self, db: FingerprintsDatabase, max_df: int = HASH_MAX_DF):
+        """
+        Reloads the index from the fingerprints table, lookups keep being served meanwhile.
+        The hashes held by more than `max_df` songs are left out, unless it is 0.
+        """
+        hashes, song_ids, offsets = db.export_fingerprints()
+        if max_df:
+            kept = ~np.isin(hashes, db.get_stop_list(max_df))
+            hashes, song_ids, offsets = hashes[kept], song_ids[kept], offsets[kept]
+
+        self.set_arrays(*self.build_arrays(hashes, song_ids, offsets), max_df=max_df)
+
+    def lookup(
+        self, query_hashes: np.ndarray, query_offsets: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Probes the index for all the query hashes at once.
+
+        :return: The song ID and offset difference (song offset - query offset) of each matching
+            posting, and the index of the query hash it matched.
+        """
+        with self.lock:
+            keys, starts, song_ids, offsets = (
+                self.keys,
+                self.starts,
+                self.song_ids,
+                self.offsets,
+            )
+
+        if len(keys) == 0:
+            nothing = np.empty(0, dtype=np.int64)
+            return nothing.astype(np.int32), nothing, nothing
+
+        positions = np.searchsorted(keys, query_hashes)
+        positions = np.minimum(positions, len(keys) - 1)
+        found = np.flatnonzero(keys[positions] == query_hashes)
+
+        first = starts[positions[found]]
+        counts = starts[positions[found] + 1] - first
+
+        # Expand each [first, first + count) range into posting indices
+        query_idx = np.repeat(found, counts)
+        range_starts = np.repeat(first - (np.cumsum(counts) - counts), counts)
+        postings = np.arange(len(query_idx)) + range_starts
+
+        return (
+            song_ids[postings],
+            offsets[postings] - np.asarray(query_offsets)[query_idx],
+            query_idx,
+        )
+
+    def identify_song(
+        self, query_fingerprints: List[Tuple[int, int]], top_k: int = DEFAULT_TOP_K
+    ) -> List[SongMatch]:
+        """
+        Identifies a song based on a list of fingerprint hashes, with the same interface and
+        scoring as `FingerprintsDatabase.identify_song`.
+
+        :param query_fingerprints: A list of tuples, each containing a fingerprint hash and its offset.
+        :param top_k: The maximum number of candidates to return.
+        :return: The candidates ranked by decreasing score, empty if no hash matched.
+        """
+        start_time = time.perf_counter()
+        query_hashes, query_offsets = to_hash_arrays(query_fingerprints)
+
+        if len(query_hashes) == 0:
+            raise ValueError("Empty fingerprint list provided.")
+
+        song_ids, deltas, _ = self.lookup(query_hashes, query_offsets)
+        matches = score_offset_alignment(song_ids, deltas, top_k=top_k)
+
+        record_query(
+            "memory",
+            time.perf_counter() - start_time,
+            nb_hashes=len(query_hashes),
+            matched_rows=len(song_ids),
+        )
+
+        return matches
+
+
+    def identify_songs_batch(
+        self, queries: List[List[Tuple[int, int]]], top_k: int = DEFAULT_TOP_K
+    ) -> List[List[SongMatch]]:
+        """
+        Identifies many songs at once, with the same interface and scoring as
+        `FingerprintsDatabase.identify_songs_batch`.
+
+        The union of the query hashes is deduplicated and probed once, then the postings of each
+        distinct hash are expanded to every query row holding it, and scored per query.
+
+        :param queries: A list of queries, each a list of (hash, offset) tuples.
+        :param top_k: The maximum number of candidates to return per query.
+        :return: The candidates of each query ranked by decreasing score, empty if no hash matched
+            (or if the query is empty).
+        """
+        start_time = time.perf_counter()
+        queries = [
+            np.column_stack(to_hash_arrays(query_pairs)).astype(np.int64) for query_pairs in queries
+        ]
+        if not queries:
+            return []
+
+        query_pairs = np.concatenate(queries)
+        query_ids = np.repeat(np.arange(len(queries)), [len(pairs) for pairs in queries])
+
+        # Single probe for the distinct hashes : with zero offsets, deltas are the song offsets
+        unique_hashes, inverse = np.unique(query_pairs[:, 0], return_inverse=True)
+        song_ids, song_offsets, hash_idx = self.lookup(
+            unique_hashes, np.zeros(len(unique_hashes), dtype=np.int64)
+        )
+
+        # Postings are grouped by distinct hash : expand each group to the query rows holding it
+        counts = np.bincount(hash_idx, minlength=len(unique_hashes))
+        first = np.cumsum(counts) - counts
+        row_counts = counts[inverse]
+        rows = np.repeat(np.arange(len(query_pairs)), row_counts)
+        postings = np.arange(len(rows)) + np.repeat(
+            first[inverse] - (np.cumsum(row_counts) - row_counts), row_counts
+        )
+
+        # Rows are ordered by query : split the postings per query and score each one
+        deltas = song_offsets[postings] - query_pairs[rows, 1]
+        song_ids = song_ids[postings]
+        bounds = np.searchsorted(query_ids[rows], np.arange(len(queries) + 1))
+
+        record_query(
+            "memory",
+            time.perf_counter() - start_time,
+            nb_hashes=len(query_pairs),
+            matched_rows=len(song_ids),
+        )
+
+        return [
+            score_offset_alignment(song_ids[start:end], deltas[start:end], top_k=top_k)
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+
+
+# Index shared by all the sessions of the process, loaded on first use
+_shared_index: Optional[FingerprintIndex] = None
+_shared_index_lock = threading.Lock()
+
+
+def get_shared_index(refresh: bool = False) -> FingerprintIndex:
+    """
+    Returns the process-wide fingerprint index, loading it on first use from the index file
+    at FINGERPRINT_INDEX_PATH if set, from the database otherwise.
+
+    :param refresh: Reload the index even if it is already loaded.
+    """
+    global _shared_index
+
+    with _shared_index_lock:
+        if _shared_index is None:
+            _shared_index = FingerprintIndex()
+            refresh = True
+
+        if refresh and FINGERPRINT_INDEX_PATH:
+            arrays = open_index_file(FINGERPRINT_INDEX_PATH)
+            _shared_index.set_arrays(
+                arrays["keys"],
+                arrays["starts"],
+                arrays["song_ids"],
+                arrays["offsets"],
+                max_df=arrays["max_df"],
+            )
+        elif refresh:
+            with FingerprintsDatabase() as db:
+                _shared_index.refresh(db)
+
+    return _shared_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage fingerprint index files.")
+    parser.add_argument("command", choices=["build", "info", "verify"])
+    parser.add_argument("path", help="Path to the index file.")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        with FingerprintsDatabase() as db:
+            index = FingerprintIndex.from_database(db)
+        index.save(args.path)
+        print(
+            colored(
+                f"Index written to {args.path} ({len(index)} postings"
+                + (f", without the hashes of more than {index.max_df} songs" if index.max_df else "")
+                + ").",
+                color="green",
+            )
+        )
+
+    elif args.command == "info":
+        arrays = open_index_file(args.path)
+        print(
+            f"{args.path} : {len(arrays['keys'])} distinct hashes, "
+            f"{len(arrays['song_ids'])} postings, {len(arrays['songs'])} songs, "
+            f"stop-list threshold {arrays['max_df'] or 'none'}, {os.path.getsize(args.path)} bytes"
+        )
+
+    elif args.command == "verify":
+        if not verify_index_file(args.path):
+            print(colored(f"{args.path} is corrupted or incomplete.", color="red"))
+            raise SystemExit(1)
+        print(colored(f"{args.path} is valid.", color="green"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import os
+import time
+import argparse
+import threading
+from typing import Optional
+
+import numpy as np
+from termcolor import colored
+
+import __init__
+from core.audio_processing import fingerprint_from_hashes
+from core.database import FingerprintsDatabase, HASH_MAX_DF, collapse_hash_pairs
+from core.metrics import increment
+from models.song_fingerprint import SongFingerprint
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Time (in seconds) a process keeps using its copy of the stop-list before reloading it from the
+# hash statistics, so that hashes becoming common during an import are soon ignored by lookups.
+STOP_LIST_REFRESH_INTERVAL = float(os.getenv("STOP_LIST_REFRESH_INTERVAL", 300))
+
+# Document frequency thresholds shown by `python -m core.hash_stats status`.
+REPORTED_THRESHOLDS = (10, 50, 100, 500, 1000, 5000)
+
+# ------------------------------------------------------------------------------------------------- #
+
+
+class StopList:
+    """Sorted hashes held by more than `max_df` songs, ignored by lookups."""
+
+    def __init__(self, hashes: np.ndarray, max_df: int):
+        self.hashes = hashes
+        self.max_df = max_df
+        self.loaded_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        """Returns whether each hash is stop-listed."""
+        if len(self.hashes) == 0:
+            return np.zeros(len(hashes), dtype=bool)
+
+        positions = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        return self.hashes[positions] == hashes
+
+
+# Stop-list of the process, reloaded every STOP_LIST_REFRESH_INTERVAL seconds
+_stop_list: Optional[StopList] = None
+_stop_list_lock = threading.Lock()
+
+
+def get_stop_list(
+    db: Optional[FingerprintsDatabase] = None, refresh: bool = False
+) -> Optional[StopList]:
+    """
+    Returns the stop-list of the process, loaded from the hash statistics on first use.
+
+    :param db: An open database connection, a new one if None.
+    :param refresh: Reload the stop-list even if it is recent.
+    :return: The stop-list, None if it is disabled (HASH_MAX_DF unset).
+    """
+    global _stop_list
+
+    if not HASH_MAX_DF:
+        return None
+
+    with _stop_list_lock:
+        if (
+            refresh
+            or _stop_list is None
+            or time.monotonic() - _stop_list.loaded_at > STOP_LIST_REFRESH_INTERVAL
+        ):
+            if db is None:
+                with FingerprintsDatabase() as db:
+                    _stop_list = StopList(db.get_stop_list(HASH_MAX_DF), HASH_MAX_DF)
+            else:
+                _stop_list = StopList(db.get_stop_list(HASH_MAX_DF), HASH_MAX_DF)
+        return _stop_list
+
+
+def filter_query(
+    fingerprint: SongFingerprint,
+    db: Optional[FingerprintsDatabase] = None,
+    use_stop_list: bool = True,
+) -> SongFingerprint:
+    """
+    Prepares a query fingerprint for matching : repeated hash pairs are collapsed, and stop-listed
+    hashes dropped.
+
+    :param fingerprint: The fingerprint of the query.
+    :param db: An open database connection to load the stop-list with, a new one if None.
+    :param use_stop_list: Drop the stop-listed hashes. Lookups of an index built without them
+        skip the stop-list, and never load it from the database.
+    :return: The filtered fingerprint, possibly empty.
+    """
+    hashes, offsets = collapse_hash_pairs(*fingerprint.get_arrays())
+
+    stop_list = get_stop_list(db) if use_stop_list else None
+    if stop_list is not None:
+        stopped = stop_list.contains(hashes)
+        increment("stop_listed_hashes_total", int(stopped.sum()))
+        hashes, offsets = hashes[~stopped], offsets[~stopped]
+
+    return fingerprint_from_hashes(hashes, offsets)
+
+
+def print_status(db: FingerprintsDatabase):
+    """Prints the distribution of the document frequencies, and what each threshold would drop."""
+    hashes, dfs = db.get_hash_stats()
+    if len(hashes) == 0:
+        print(
+            colored("No hash statistics : run `python -m core.hash_stats rebuild`.", color="yellow")
+        )
+        return
+
+    print(f"{len(hashes)} distinct hashes, {int(dfs.sum())} (song, hash) pairs")
+    print(
+        f"Document frequency : median {np.median(dfs):g}, "
+        f"p99 {np.percentile(dfs, 99):g}, max {dfs.max()}"
+    )
+
+    # The share of the postings a threshold drops is estimated by its share of (song, hash) pairs
+    for threshold in REPORTED_THRESHOLDS:
+        stopped = dfs > threshold
+        print(
+            f"  HASH_MAX_DF={threshold:<5} : {int(stopped.sum()):>9} hashes stop-listed "
+            f"({stopped.mean():6.2%}), {dfs[stopped].sum() / dfs.sum():6.2%} of the postings"
+        )
+
+    if HASH_MAX_DF:
+        print(colored(f"Current threshold : HASH_MAX_DF={HASH_MAX_DF}", color="green"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the hash statistics and the stop-list.")
+    parser.add_argument("command", choices=["status", "rebuild", "prune"])
+    args = parser.parse_args()
+
+    with FingerprintsDatabase() as db:
+        if args.command == "status":
+            print_status(db)
+
+        elif args.command == "rebuild":
+            db.setup_hash_stats()
+            db.rebuild_hash_stats()
+            print(colored("Hash statistics rebuilt from the fingerprints.", color="green"))
+            print_status(db)
+
+        elif args.command == "prune":
+            if not HASH_MAX_DF:
+                parser.error("Set HASH_MAX_DF to the stop-list threshold.")
+            deleted = db.prune_stop_listed()
+            nb_hashes = len(db.get_stop_list())
+            print(
+                colored(
+                    f"{deleted} hash pairs of {nb_hashes} stop-listed hashes deleted.", color="green"
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
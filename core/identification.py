@@ -0,0 +1,198 @@
+import os
+from typing import Iterable, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from core.analysis_profile import AnalysisProfile, get_catalog_profile
+from core.audio_capture import RingBuffer, DEFAULT_RECORDING_DURATION
+from core.audio_processing import create_spectrogram, get_peaks, create_fingerprint
+from core.database import FingerprintsDatabase
+from core.fingerprint_index import get_shared_index
+from core.hash_stats import filter_query
+from core.metrics import span, observe, COUNT_BUCKETS
+from models.song_fingerprint import SongFingerprint
+from models.song_match import SongMatch
+from utils.audio_utils import resample
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Matching engine used for identification : "postgres" runs the lookups in the database,
+# "memory" serves them from an in-process index loaded from the database on first use.
+MATCHING_ENGINE = os.getenv("MATCHING_ENGINE", "postgres")
+
+# Peak picking and pairing parameters used on recorded queries.
+QUERY_AMPLITUDE_THRESHOLD = -50
+QUERY_NEIGHBORHOOD_SIZE = 100
+QUERY_FAN_VALUE = 150
+
+# Duration (in seconds) of audio received between two lookups of a streaming identification.
+IDENTIFY_INTERVAL = 1.0
+
+# Score margin (in aligned hashes) of the best candidate over the next one above which a streaming
+# identification stops listening and returns it.
+MIN_MATCH_MARGIN = int(os.getenv("IDENTIFY_MIN_MARGIN", 8))
+
+# ------------------------------------------------------------------------------------------------- #
+
+
+def fingerprint_query(
+    y: np.ndarray, sr: int, profile: Optional[AnalysisProfile] = None
+) -> SongFingerprint:
+    """
+    Create the fingerprint of a recorded query with the analysis profile of the catalog (or
+    `profile`), the audio being resampled to its rate if needed.
+    """
+    profile = profile or get_catalog_profile()
+    if sr != profile.sampling_rate:
+        with span("resample", path="identify"):
+            y, sr = resample(y, sr, profile.sampling_rate), profile.sampling_rate
+
+    with span("spectrogram", path="identify"):
+        spectrogram, freqs, times = create_spectrogram(
+            y=y, sr=sr, **profile.get_spectrogram_params()
+        )
+
+    with span("peaks", path="identify"):
+        peaks = get_peaks(
+            spectrogram=spectrogram,
+            amp_thres=QUERY_AMPLITUDE_THRESHOLD,
+            neighborhood_size=QUERY_NEIGHBORHOOD_SIZE,
+        )
+
+    with span("hashes", path="identify"):
+        fingerprint = create_fingerprint(peaks, freqs, times, fan_value=QUERY_FAN_VALUE)
+
+    observe("fingerprint_peaks", len(peaks), buckets=COUNT_BUCKETS, path="identify")
+    observe("fingerprint_hashes", len(fingerprint), buckets=COUNT_BUCKETS, path="identify")
+
+    return fingerprint
+
+
+def match_fingerprint(
+    fingerprint: SongFingerprint, db: Optional[FingerprintsDatabase] = None
+) -> List[SongMatch]:
+    """
+    Match a query fingerprint with the configured matching engine.
+
+    :param fingerprint: The fingerprint of the query, not empty.
+    :param db: An open database connection to use with the "postgres" engine, a new one if None.
+    :return: The candidates ranked by decreasing score, empty if only stop-listed hashes remain.
+    """
+    with span("match", path="identify", engine=MATCHING_ENGINE):
+        index = get_shared_index() if MATCHING_ENGINE == "memory" else None
+
+        # An index built with a stop-list already lacks the stop-listed hashes
+        use_stop_list = index is None or not index.max_df
+        fingerprint = filter_query(fingerprint, db=db, use_stop_list=use_stop_list)
+        if fingerprint.check_empty():
+            return []
+
+        if index is not None:
+            return index.identify_song(fingerprint)
+
+        if db is None:
+            with FingerprintsDatabase() as db:
+                return db.identify_song(fingerprint)
+
+        return db.identify_song(fingerprint)
+
+
+def match_fingerprints_batch(
+    fingerprints: List[SongFingerprint], db: Optional[FingerprintsDatabase] = None
+) -> List[List[SongMatch]]:
+    """
+    Match many query fingerprints in a single pass of the configured matching engine.
+
+    :param fingerprints: The fingerprints of the queries (empty ones get no candidate).
+    :param db: An open database connection to use with the "postgres" engine, a new one if None.
+    :return: The candidates of each query ranked by decreasing score.
+    """
+    with span("match_batch", path="identify", engine=MATCHING_ENGINE):
+        index = get_shared_index() if MATCHING_ENGINE == "memory" else None
+        use_stop_list = index is None or not index.max_df
+        fingerprints = [
+            filter_query(fingerprint, db=db, use_stop_list=use_stop_list)
+            for fingerprint in fingerprints
+        ]
+
+        if index is not None:
+            return index.identify_songs_batch(fingerprints)
+
+        if db is None:
+            with FingerprintsDatabase() as db:
+                return db.identify_songs_batch(fingerprints)
+
+        return db.identify_songs_batch(fingerprints)
+
+
+def is_confident(matches: List[SongMatch], min_margin: int = MIN_MATCH_MARGIN) -> bool:
+    """
+    Whether the best candidate is far enough ahead of the next one to stop listening.
+    """
+    return bool(matches) and matches[0].get_margin() >= min_margin
+
+
+def identify_stream(
+    chunks: Iterable[np.ndarray],
+    sr: int,
+    max_duration: float = DEFAULT_RECORDING_DURATION,
+    interval: float = IDENTIFY_INTERVAL,
+    min_margin: int = MIN_MATCH_MARGIN,
+    db: Optional[FingerprintsDatabase] = None,
+    profile: Optional[AnalysisProfile] = None,
+) -> Tuple[List[SongMatch], float]:
+    """
+    Identify a song from a live stream of audio chunks, returning as soon as the best candidate
+    is `min_margin` aligned hashes ahead of the next one.
+
+    The audio received so far is kept in a ring buffer and matched every `interval` seconds of
+    audio. Lookups run in a background thread, so that reading the stream never waits for the
+    matcher. When the stream ends (hard cap on the listening time), the whole buffer is matched
+    one last time.
+
+    :param chunks: The audio chunks, as float samples at `sr` Hz. Closed on early exit.
+    :param sr: The sampling rate of the chunks.
+    :param max_duration: The maximum duration (in seconds) of audio kept in the buffer.
+    :param interval: The duration (in seconds) of audio received between two lookups.
+    :param min_margin: The score margin above which the best candidate is returned.
+    :param db: An open database connection to use with the "postgres" engine.
+    :param profile: The analysis profile, the one of the catalog by default.
+    :return: The candidates of the last lookup and the duration (in seconds) of audio received.
+    """
+    profile = profile or get_catalog_profile(db)
+    buffer = RingBuffer(int(max_duration * sr))
+    received, matched = 0, 0  # Samples received, samples seen by the last completed lookup
+    matches, pending = [], None
+
+    def lookup(samples: np.ndarray) -> List[SongMatch]:
+        fingerprint = fingerprint_query(samples, sr, profile)
+        if fingerprint.check_empty():
+            return []
+        return match_fingerprint(fingerprint, db=db)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for chunk in chunks:
+            buffer.write(chunk)
+            received += len(chunk)
+
+            if pending is not None and pending[0].done():
+                matches, matched = pending[0].result(), pending[1]
+                pending = None
+                if is_confident(matches, min_margin):
+                    break
+
+            if pending is None and received - matched >= interval * sr:
+                pending = (executor.submit(lookup, buffer.get()), received)
+
+        else:
+            # The stream is exhausted : wait for the last lookup, then match the whole buffer
+            if pending is not None:
+                matches, matched = pending[0].result(), pending[1]
+            if received > matched and not is_confident(matches, min_margin):
+                matches = lookup(buffer.get())
+
+    if hasattr(chunks, "close"):
+        chunks.close()
+
+    return matches, received / sr
@@ -0,0 +1,188 @@
+import os
+import mmap
+import struct
+import hashlib
+from typing import List, Tuple
+
+import numpy as np
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Magic bytes opening every fingerprint index file.
+INDEX_FILE_MAGIC = b"MRFPIDX\0"
+
+# Version of the index file layout. Files written with another version are rejected.
+INDEX_FILE_VERSION = 1
+
+# Header layout : magic, version, stop-list threshold (the HASH_MAX_DF whose stop-listed hashes were
+# left out of the index, 0 if none were), number of keys, number of postings, number of songs,
+# SHA-256 checksum of everything following the header. The header is padded to HEADER_SIZE bytes.
+HEADER_FORMAT = "<8sIIQQQ32s"
+HEADER_SIZE = 128
+
+# Alignment (in bytes) of each array section, so that arrays can be viewed in place from the mapping.
+SECTION_ALIGNMENT = 64
+
+# Size of the blocks read when computing the checksum of a file.
+CHECKSUM_BLOCK_SIZE = 1 << 24
+
+# ------------------------------------------------------------------------------------------------- #
+
+# Sections of the file, in order : the distinct hashes, the start of the postings of each hash,
+# the song ID and offset of each posting, and the table of distinct song IDs.
+SECTIONS = [
+    ("keys", np.dtype("<i8")),
+    ("starts", np.dtype("<i8")),
+    ("song_ids", np.dtype("<i4")),
+    ("offsets", np.dtype("<i4")),
+    ("songs", np.dtype("<i4")),
+]
+
+
+def _section_lengths(nb_keys: int, nb_postings: int, nb_songs: int) -> List[int]:
+    return [nb_keys, nb_keys + 1, nb_postings, nb_postings, nb_songs]
+
+
+def _padding(position: int) -> int:
+    return -position % SECTION_ALIGNMENT
+
+
+def write_index_file(
+    file_path: str,
+    keys: np.ndarray,
+    starts: np.ndarray,
+    song_ids: np.ndarray,
+    offsets: np.ndarray,
+    max_df: int = 0,
+) -> None:
+    """
+    Writes the arrays of a fingerprint index to a file, with the stop-list threshold it was
+    built with.
+
+    The file is written next to its destination and renamed over it once complete and synced,
+    so that readers never see a partially written index.
+    """
+    songs = np.unique(song_ids)
+    arrays = [keys, starts, song_ids, offsets, songs]
+    temp_path = f"{file_path}.tmp"
+
+    checksum = hashlib.sha256()
+    with open(temp_path, "wb") as f:
+        f.write(b"\0" * HEADER_SIZE)
+        position = HEADER_SIZE
+
+        for (_, dtype), array in zip(SECTIONS, arrays):
+            padding = b"\0" * _padding(position)
+            data = np.ascontiguousarray(array, dtype=dtype).tobytes()
+            for chunk in (padding, data):
+                f.write(chunk)
+                checksum.update(chunk)
+            position += len(padding) + len(data)
+
+        header = struct.pack(
+            HEADER_FORMAT,
+            INDEX_FILE_MAGIC,
+            INDEX_FILE_VERSION,
+            max_df,
+            len(keys),
+            len(song_ids),
+            len(songs),
+            checksum.digest(),
+        )
+        f.seek(0)
+        f.write(header.ljust(HEADER_SIZE, b"\0"))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_path, file_path)
+
+
+def read_header(buffer) -> Tuple[int, int, int, int, bytes]:
+    """
+    Parses and validates the header of an index file.
+
+    :return: The stop-list threshold, the number of keys, postings and songs, and the checksum of
+        the file body.
+    """
+    if len(buffer) < HEADER_SIZE:
+        raise ValueError("Index file is truncated.")
+
+    magic, version, max_df, nb_keys, nb_postings, nb_songs, checksum = struct.unpack_from(
+        HEADER_FORMAT, buffer
+    )
+
+    if magic != INDEX_FILE_MAGIC:
+        raise ValueError("Not a fingerprint index file.")
+    if version != INDEX_FILE_VERSION:
+        raise ValueError(
+            f"Unsupported index file version {version} (expected {INDEX_FILE_VERSION})."
+        )
+
+    return max_df, nb_keys, nb_postings, nb_songs, checksum
+
+
+def _layout(nb_keys: int, nb_postings: int, nb_songs: int) -> Tuple[List[int], int]:
+    """Returns the position of each section and the expected size of the file."""
+    positions, position = [], HEADER_SIZE
+    for (_, dtype), length in zip(
+        SECTIONS, _section_lengths(nb_keys, nb_postings, nb_songs)
+    ):
+        position += _padding(position)
+        positions.append(position)
+        position += length * dtype.itemsize
+    return positions, position
+
+
+def verify_index_file(file_path: str) -> bool:
+    """
+    Checks the header, the size and the checksum of an index file.
+
+    :return: True if the file is complete and intact, False otherwise.
+    """
+    with open(file_path, "rb") as f:
+        try:
+            _, nb_keys, nb_postings, nb_songs, checksum = read_header(f.read(HEADER_SIZE))
+        except ValueError:
+            return False
+
+        if os.fstat(f.fileno()).st_size != _layout(nb_keys, nb_postings, nb_songs)[1]:
+            return False
+
+        body_checksum = hashlib.sha256()
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b""):
+            body_checksum.update(block)
+
+    return body_checksum.digest() == checksum
+
+
+def open_index_file(file_path: str, verify: bool = False) -> dict:
+    """
+    Maps an index file in memory and returns read-only views of its arrays.
+
+    The arrays are backed by the shared page cache : every process opening the same file
+    shares a single copy, and no data is read until it is accessed.
+
+    :param file_path: The path to the index file.
+    :param verify: Also check the checksum of the whole file before serving it.
+    :return: A dictionary of arrays (keys, starts, song_ids, offsets, songs), and of the stop-list
+        threshold of the index (max_df).
+    """
+    if verify and not verify_index_file(file_path):
+        raise ValueError(f"Index file {file_path} is corrupted or incomplete.")
+
+    with open(file_path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    max_df, nb_keys, nb_postings, nb_songs, _ = read_header(mapping)
+    positions, size = _layout(nb_keys, nb_postings, nb_songs)
+
+    if len(mapping) != size:
+        raise ValueError(f"Index file {file_path} is corrupted or incomplete.")
+
+    arrays = {
+        name: np.frombuffer(mapping, dtype=dtype, count=length, offset=position)
+        for (name, dtype), length, position in zip(
+            SECTIONS, _section_lengths(nb_keys, nb_postings, nb_songs), positions
+        )
+    }
+    return {**arrays, "max_df": max_df}
@@ -0,0 +1,362 @@
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from termcolor import colored
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Path of a file where the metrics are written in the Prometheus text format (for the textfile
+# collector of the node exporter), and port of an in-process HTTP endpoint serving them.
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# Metrics are collected when explicitly enabled, or when they are exported. Otherwise every call
+# of this module returns immediately.
+METRICS_ENABLED = (
+    os.getenv("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+    or bool(METRICS_FILE)
+    or bool(METRICS_PORT)
+)
+
+# Prefix of the exported metric names.
+METRICS_PREFIX = "music_recognition_"
+
+# Duration (in ms) above which an identification lookup is recorded as a slow query,
+# and number of slow queries kept.
+SLOW_QUERY_THRESHOLD = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", 500)) / 1000
+SLOW_QUERY_LOG_SIZE = 100
+
+# Histogram buckets of durations (s), counts (peaks, hashes, matched rows) and memory sizes (bytes).
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+MEMORY_BUCKETS = tuple(size << 20 for size in (64, 128, 256, 512, 1024, 2048, 4096, 8192))
+
+# ------------------------------------------------------------------------------------------------- #
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms of a process, identified by a name and a set of labels,
+    with a log of the slow queries.
+
+    Registries of worker processes are merged into the one of the parent process through
+    `drain` and `merge`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+        self.gauges: Dict[Tuple[str, tuple], float] = {}
+        self.histograms: Dict[Tuple[str, tuple], dict] = {}
+        self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+    @staticmethod
+    def key(name: str, labels: dict) -> Tuple[str, tuple]:
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_max(self, name: str, value: float, **labels):
+        """Sets a gauge to `value` if it is higher than its current value."""
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = max(self.gauges.get(key, value), value)
+
+    def observe(self, name: str, value: float, buckets: tuple = DURATION_BUCKETS, **labels):
+        """Adds a value to a histogram, whose buckets are set by its first observation."""
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": list(buckets),
+                    "counts": [0] * (len(buckets) + 1),
+                    "sum": 0.0,
+                }
+            histogram["counts"][bisect.bisect_left(histogram["buckets"], value)] += 1
+            histogram["sum"] += value
+
+    def record_slow_query(self, query: dict):
+        with self.lock:
+            self.slow_queries.append(query)
+
+    def drain(self) -> dict:
+        """Returns the content of the registry, and resets it."""
+        with self.lock:
+            snapshot = {
+                "counters": self.counters,
+                "gauges": self.gauges,
+                "histograms": self.histograms,
+                "slow_queries": list(self.slow_queries),
+            }
+            self.clear()
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        """Adds the content of a registry drained in another process."""
+        with self.lock:
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, value in snapshot["gauges"].items():
+                self.gauges[key] = max(self.gauges.get(key, value), value)
+            for key, other in snapshot["histograms"].items():
+                histogram = self.histograms.setdefault(
+                    key, {**other, "counts": [0] * len(other["counts"]), "sum": 0.0}
+                )
+                histogram["counts"] = [a + b for a, b in zip(histogram["counts"], other["counts"])]
+                histogram["sum"] += other["sum"]
+            self.slow_queries.extend(snapshot["slow_queries"])
+
+    def export_text(self) -> str:
+        """Exports the metrics in the Prometheus text format."""
+
+        def labels_text(labels: tuple, extra: tuple = ()) -> str:
+            labels = labels + extra
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+        lines = []
+        with self.lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in metrics}):
+                    lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+                    for (metric, labels), value in sorted(metrics.items()):
+                        if metric == name:
+                            lines.append(
+                                f"{METRICS_PREFIX}{name}{labels_text(labels)} {float(value)!r}"
+                            )
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} histogram")
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulated = 0
+                    bounds = [f"{bound:g}" for bound in histogram["buckets"]] + ["+Inf"]
+                    for bound, count in zip(bounds, histogram["counts"]):
+                        cumulated += count
+                        lines.append(
+                            f"{METRICS_PREFIX}{name}_bucket"
+                            f"{labels_text(labels, (('le', bound),))} {cumulated}"
+                        )
+                    lines.append(
+                        f"{METRICS_PREFIX}{name}_sum{labels_text(labels)} {float(histogram['sum'])!r}"
+                    )
+                    lines.append(f"{METRICS_PREFIX}{name}_count{labels_text(labels)} {cumulated}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Registry of the process
+registry = MetricsRegistry()
+
+# Returned by `span` when metrics are disabled
+_null_span = nullcontext()
+
+
+def increment(name: str, value: float = 1, **labels):
+    """Increments a counter."""
+    if METRICS_ENABLED:
+        registry.increment(name, value, **labels)
+
+
+def observe(name: str, value: float, buckets: tuple = DURATION_BUCKETS, **labels):
+    """Adds a value to a histogram."""
+    if METRICS_ENABLED:
+        registry.observe(name, value, buckets=buckets, **labels)
+
+
+def span(stage: str, **labels):
+    """
+    Context manager timing a stage of the identify or ingest path, as an observation of the
+    `stage_duration_seconds` histogram labeled with the stage.
+    """
+    if not METRICS_ENABLED:
+        return _null_span
+    return _timed_span(stage, labels)
+
+
+@contextmanager
+def _timed_span(stage: str, labels: dict):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe("stage_duration_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+
+def record_query(engine: str, duration: float, nb_hashes: int, matched_rows: int):
+    """
+    Records the matched rows of an identification lookup, and logs it as a slow query if it took
+    more than SLOW_QUERY_THRESHOLD.
+    """
+    if not METRICS_ENABLED:
+        return
+
+    registry.observe("matched_rows", matched_rows, buckets=COUNT_BUCKETS, engine=engine)
+
+    if duration >= SLOW_QUERY_THRESHOLD:
+        registry.increment("slow_queries_total", engine=engine)
+        registry.record_slow_query(
+            {
+                "time": time.time(),
+                "engine": engine,
+                "duration": duration,
+                "hashes": nb_hashes,
+                "matched_rows": matched_rows,
+            }
+        )
+        print(
+            colored(
+                f"Slow identification query ({engine}) : {duration * 1000:.0f} ms, "
+                f"{nb_hashes} hashes, {matched_rows} matched rows.",
+                color="yellow",
+            )
+        )
+
+
+def get_slow_queries() -> List[dict]:
+    """Returns the slow queries logged by the process, the most recent last."""
+    with registry.lock:
+        return list(registry.slow_queries)
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident set size of the process, so that the next `get_peak_rss` measures the
+    peak of the following work only (Linux only : elsewhere the peak of the process is kept).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss() -> Optional[int]:
+    """Returns the peak resident set size (in bytes) of the process, None if it is unknown."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) << 10
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak << 10
+
+
+@contextmanager
+def track_peak_rss(name: str, **labels):
+    """Context manager recording the peak resident set size reached by the process within it."""
+    if not METRICS_ENABLED:
+        yield
+        return
+
+    reset_peak_rss()
+    try:
+        yield
+    finally:
+        peak = get_peak_rss()
+        if peak is not None:
+            registry.observe(name, peak, buckets=MEMORY_BUCKETS, **labels)
+            registry.set_max(f"max_{name}", peak, **labels)
+
+
+def collect_metrics(function, *args, **kwargs) -> tuple:
+    """
+    Calls a function in a worker process, and returns its result with the metrics it recorded,
+    to be merged into the registry of the parent process with `merge_metrics`.
+    """
+    if not METRICS_ENABLED:
+        return function(*args, **kwargs), None
+
+    registry.drain()
+    result = function(*args, **kwargs)
+    return result, registry.drain()
+
+
+def merge_metrics(snapshot: Optional[dict]):
+    """Merges the metrics returned by `collect_metrics` into the registry of the process."""
+    if snapshot is not None:
+        registry.merge(snapshot)
+
+
+def write_metrics(file_path: Optional[str] = METRICS_FILE):
+    """Writes the metrics of the process to a file in the Prometheus text format, atomically."""
+    if not (METRICS_ENABLED and file_path):
+        return
+
+    temp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(registry.export_text())
+    os.replace(temp_path, file_path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the metrics on /metrics, and the slow queries as JSON on /slow_queries."""
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = registry.export_text().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/slow_queries":
+            body = json.dumps(get_slow_queries()).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# HTTP endpoint of the process, started on first use
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int = METRICS_PORT) -> Optional[ThreadingHTTPServer]:
+    """
+    Starts the metrics endpoint of the process in a background thread, once.
+    Does nothing if metrics are disabled or no port is set.
+    """
+    global _server
+
+    if not (METRICS_ENABLED and port):
+        return None
+
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer(("", port), MetricsHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+            print(colored(f"Metrics served on http://localhost:{port}/metrics", color="green"))
+
+    return _server
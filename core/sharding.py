@@ -0,0 +1,600 @@
+import os
+import time
+import argparse
+import threading
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from termcolor import colored
+
+import __init__
+from core.database import PostgresDatabase, FingerprintsDatabase, DEFAULT_TOP_K
+from core.fingerprint_index import score_offset_alignment
+from core.metrics import record_query
+from models.song_match import SongMatch
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Shards of the fingerprints table, as `name=dsn` entries separated by semicolons, e.g.
+# "shard1=postgresql://host1/music;shard2=postgresql://host2/music". The name `primary`, without
+# DSN, designates the fingerprints table of the main database. Shards can be schemas of a single
+# instance : "shard1=dbname=music options=-csearch_path=shard1".
+# Unset, fingerprints are not sharded.
+FINGERPRINT_SHARDS = os.getenv("FINGERPRINT_SHARDS", "")
+
+# Name of the fingerprints table of the main database, as a shard.
+PRIMARY_SHARD = "primary"
+
+# Number of hash buckets. A hash belongs to bucket `hash % NB_BUCKETS` : the modulus being prime,
+# every field of the packed hash contributes to the bucket, which spreads the skewed frequency bins.
+# Each shard owns a contiguous range of buckets, recorded in the shard map of the main database.
+NB_BUCKETS = 251
+
+# Time (in seconds) a process keeps using its copy of the shard map before reloading it. A rebalance
+# waits twice as long between its steps, so that every process follows it.
+SHARD_MAP_REFRESH_INTERVAL = float(os.getenv("SHARD_MAP_REFRESH_INTERVAL", 10))
+
+# ------------------------------------------------------------------------------------------------- #
+
+
+def parse_shards(value: str = FINGERPRINT_SHARDS) -> Dict[str, Optional[str]]:
+    """Parses the list of shards : the DSN of each shard by name (None for the main database)."""
+    shards = {}
+    for entry in filter(None, (entry.strip() for entry in value.split(";"))):
+        name, _, dsn = entry.partition("=")
+        shards[name.strip()] = dsn.strip() or None
+    return shards
+
+
+def get_buckets(hashes: np.ndarray) -> np.ndarray:
+    """Returns the bucket of each hash."""
+    return np.asarray(hashes, dtype=np.int64) % NB_BUCKETS
+
+
+def plan_buckets(shard_names: List[str]) -> List[str]:
+    """Returns the shard of each bucket when they are split in even contiguous ranges."""
+    return [shard_names[bucket * len(shard_names) // NB_BUCKETS] for bucket in range(NB_BUCKETS)]
+
+
+class ShardMap:
+    """
+    Placement of the buckets : the shard each bucket is read from, and the shard it is being moved
+    to during a rebalance (the bucket is then written to both).
+    """
+
+    def __init__(self, shards: List[str], targets: List[Optional[str]]):
+        self.shards = shards
+        self.targets = targets
+        self.loaded_at = time.monotonic()
+
+    def read_shards(self) -> Dict[str, np.ndarray]:
+        """Returns the buckets read from each shard, as a boolean mask over the buckets."""
+        masks = {}
+        for bucket, shard in enumerate(self.shards):
+            masks.setdefault(shard, np.zeros(NB_BUCKETS, dtype=bool))[bucket] = True
+        return masks
+
+    def write_shards(self) -> Dict[str, np.ndarray]:
+        """Returns the buckets written to each shard, moving buckets being written twice."""
+        masks = self.read_shards()
+        for bucket, target in enumerate(self.targets):
+            if target is not None:
+                masks.setdefault(target, np.zeros(NB_BUCKETS, dtype=bool))[bucket] = True
+        return masks
+
+
+def setup_shard_map(db: FingerprintsDatabase, shard_names: List[str]):
+    """
+    Creates the shard map in the main database. A new map spreads the buckets over the configured
+    shards, unless the main database already holds fingerprints : they stay there until a rebalance.
+    """
+    db.create_table(
+        "shard_buckets",
+        [
+            "bucket SMALLINT PRIMARY KEY",
+            "shard VARCHAR(100) NOT NULL",
+            "target VARCHAR(100)",
+        ],
+    )
+
+    if db.fetch_one("SELECT COUNT(*) FROM shard_buckets")[0]:
+        return
+
+    if db.fetch_one("SELECT EXISTS (SELECT 1 FROM fingerprints)")[0]:
+        placement = [PRIMARY_SHARD] * NB_BUCKETS
+        print(
+            colored(
+                "Fingerprints are still in the main database : "
+                "run `python -m core.sharding rebalance` to move them to the shards.",
+                color="yellow",
+            )
+        )
+    else:
+        placement = plan_buckets(shard_names)
+
+    with db.transaction():
+        for bucket, shard in enumerate(placement):
+            db.execute_query(
+                "INSERT INTO shard_buckets (bucket, shard) VALUES (%s, %s) "
+                "ON CONFLICT DO NOTHING",
+                (bucket, shard),
+            )
+
+
+def load_shard_map(db: FingerprintsDatabase) -> ShardMap:
+    """Loads the shard map from the main database (buckets missing from it are in the main one)."""
+    shards, targets = [PRIMARY_SHARD] * NB_BUCKETS, [None] * NB_BUCKETS
+
+    exists = db.fetch_one("SELECT to_regclass('shard_buckets') IS NOT NULL")[0]
+    if exists:
+        rows = db.fetch_all("SELECT bucket, shard, target FROM shard_buckets")
+        for bucket, shard, target in rows:
+            shards[bucket], targets[bucket] = shard, target
+    db.commit()
+
+    return ShardMap(shards, targets)
+
+
+# Shard map of the process, reloaded every SHARD_MAP_REFRESH_INTERVAL seconds
+_shard_map: Optional[ShardMap] = None
+_shard_map_lock = threading.Lock()
+
+# Threads probing the shards concurrently, shared by all the sessions of the process
+_fan_out_executor: Optional[ThreadPoolExecutor] = None
+_fan_out_lock = threading.Lock()
+
+
+def get_shard_map(db: FingerprintsDatabase, refresh: bool = False) -> ShardMap:
+    global _shard_map
+
+    with _shard_map_lock:
+        if (
+            refresh
+            or _shard_map is None
+            or time.monotonic() - _shard_map.loaded_at > SHARD_MAP_REFRESH_INTERVAL
+        ):
+            _shard_map = load_shard_map(db)
+        return _shard_map
+
+
+def fan_out(calls: Dict[str, Callable]) -> dict:
+    """Runs a call per shard concurrently, and returns their results by shard."""
+    global _fan_out_executor
+
+    if len(calls) <= 1:
+        return {name: call() for name, call in calls.items()}
+
+    with _fan_out_lock:
+        if _fan_out_executor is None:
+            _fan_out_executor = ThreadPoolExecutor(thread_name_prefix="shard")
+
+    futures = {name: _fan_out_executor.submit(call) for name, call in calls.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+
+class ShardSet:
+    """
+    Shards of the fingerprints table of a database session.
+
+    Each hash is stored in the shard owning its bucket. Lookups route the query hashes to their
+    shards, probe them concurrently, and merge the partial offset histograms they return before
+    scoring, so that results are the same as with a single table.
+    """
+
+    def __init__(
+        self,
+        primary: FingerprintsDatabase,
+        shards: Optional[Dict[str, Optional[str]]] = None,
+    ):
+        self.primary = primary
+        self.dsns = parse_shards() if shards is None else shards
+        self.sessions: Dict[str, PostgresDatabase] = {}
+
+    def session(self, name: str) -> PostgresDatabase:
+        """Returns the connection of the session to a shard, checked out on first use."""
+        if name == PRIMARY_SHARD:
+            return self.primary
+
+        if name not in self.sessions:
+            if not self.dsns.get(name):
+                raise KeyError(f"Unknown shard {name!r} : add it to FINGERPRINT_SHARDS.")
+            session = PostgresDatabase(dsn=self.dsns[name])
+            session.connect()
+            self.sessions[name] = session
+
+        return self.sessions[name]
+
+    def close(self):
+        for session in self.sessions.values():
+            session.disconnect()
+        self.sessions = {}
+
+    @contextmanager
+    def transaction(self):
+        """Opens a transaction on every shard, committed when the block exits."""
+        with ExitStack() as stack:
+            for name in self.dsns:
+                if name != PRIMARY_SHARD:
+                    stack.enter_context(self.session(name).transaction())
+            yield self
+
+    def get_map(self) -> ShardMap:
+        return get_shard_map(self.primary)
+
+    def setup(self):
+        """Creates the fingerprints table of each shard and the shard map."""
+        for name in self.dsns:
+            if name == PRIMARY_SHARD:
+                continue
+            session = self.session(name)
+            session.create_table(
+                "fingerprints",
+                [
+                    "id BIGSERIAL PRIMARY KEY",
+                    "song_id INTEGER NOT NULL",
+                    "hash BIGINT NOT NULL",
+                    '"offset" INTEGER NOT NULL',
+                ],
+            )
+            session.execute_query(
+                "CREATE INDEX IF NOT EXISTS idx_fingerprints_hash ON fingerprints(hash)"
+            )
+            session.execute_query(
+                "CREATE INDEX IF NOT EXISTS idx_fingerprints_song ON fingerprints(song_id)"
+            )
+
+        setup_shard_map(self.primary, list(self.dsns))
+        get_shard_map(self.primary, refresh=True)
+
+    def insert(self, song_ids: np.ndarray, hashes: np.ndarray, offsets: np.ndarray):
+        """Inserts hash pairs into their shards, and into the target shard of moving buckets."""
+        buckets = get_buckets(hashes)
+        for name, mask in self.get_map().write_shards().items():
+            rows = mask[buckets]
+            if rows.any():
+                self.session(name).copy_from(
+                    "fingerprints",
+                    ["song_id", "hash", "offset"],
+                    [song_ids[rows], hashes[rows], offsets[rows]],
+                )
+
+    def delete_song(self, song_id: int):
+        """Deletes the hash pairs of a song from every shard."""
+        for name in set(self.dsns) | set(self.get_map().write_shards()):
+            self.session(name).execute_query(
+                "DELETE FROM fingerprints WHERE song_id = %s", (song_id,)
+            )
+
+    def scan(self, query: str, dtypes: list) -> List[np.ndarray]:
+        """
+        Runs a query on each shard for the buckets it is read from, concurrently.
+
+        :param query: A query of the fingerprints table, with a `%s` placeholder for the list of
+            buckets, and the `%%` of its literals escaped.
+        :return: The concatenated result columns of the shards.
+        """
+
+        def scan_shard(name: str, mask: np.ndarray):
+            session = self.session(name)
+            shard_query = session.cursor.mogrify(query, (np.flatnonzero(mask).tolist(),))
+            return session.copy_to(shard_query.decode(), dtypes)
+
+        read_shards = self.get_map().read_shards()
+        for name in read_shards:
+            self.session(name)
+
+        columns = fan_out(
+            {
+                name: lambda name=name, mask=mask: scan_shard(name, mask)
+                for name, mask in read_shards.items()
+            }
+        )
+        empty = [np.empty(0, dtype=dtype) for dtype in dtypes]
+        return list(map(np.concatenate, zip(empty, *columns.values())))
+
+    def export(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Exports the hash pairs of every shard, each for the buckets it is read from."""
+        query = (
+            'SELECT hash, song_id, "offset" FROM fingerprints '
+            f"WHERE song_id IS NOT NULL AND mod(hash, {NB_BUCKETS}) = ANY(%s)"
+        )
+        return tuple(self.scan(query, [np.int64, np.int32, np.int32]))
+
+    def count_rows(self) -> int:
+        """Returns the number of hash pairs stored in the shards, each for the buckets it is read from."""
+        query = (
+            "SELECT COUNT(*) FROM fingerprints "
+            f"WHERE song_id IS NOT NULL AND mod(hash, {NB_BUCKETS}) = ANY(%s)"
+        )
+        return int(self.scan(query, [np.int64])[0].sum())
+
+    def count_hashes(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the stored hashes with the number of songs holding each of them."""
+        query = (
+            "SELECT hash, COUNT(DISTINCT song_id)::integer FROM fingerprints "
+            f"WHERE song_id IS NOT NULL AND mod(hash, {NB_BUCKETS}) = ANY(%s) GROUP BY hash"
+        )
+        return tuple(self.scan(query, [np.int64, np.int32]))
+
+    def get_song_hashes(self, song_id: int) -> np.ndarray:
+        """Returns the distinct hashes stored for a song."""
+        query = (
+            f"SELECT DISTINCT hash FROM fingerprints WHERE song_id = {int(song_id)} "
+            f"AND mod(hash, {NB_BUCKETS}) = ANY(%s)"
+        )
+        return self.scan(query, [np.int64])[0]
+
+    def get_hash_songs(self, hashes: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the distinct (song ID, hash) pairs stored for the given hashes."""
+        hash_list = ",".join(str(int(h)) for h in hashes)
+        query = (
+            f"SELECT DISTINCT song_id, hash FROM fingerprints "
+            f"WHERE hash = ANY(ARRAY[{hash_list}]::bigint[]) AND song_id IS NOT NULL "
+            f"AND mod(hash, {NB_BUCKETS}) = ANY(%s)"
+        )
+        return tuple(self.scan(query, [np.int32, np.int64]))
+
+    def delete_hashes(self, hashes: List[int]) -> int:
+        """
+        Deletes the hash pairs of the given hashes from every shard.
+
+        :return: The number of hash pairs deleted.
+        """
+        deleted = 0
+        for name in set(self.dsns) | set(self.get_map().write_shards()):
+            session = self.session(name)
+            session.execute_query("DELETE FROM fingerprints WHERE hash = ANY(%s)", (hashes,))
+            deleted += session.cursor.rowcount
+        return deleted
+
+    def route(self, hashes: np.ndarray) -> Dict[str, np.ndarray]:
+        """Returns the indices of the hashes read from each shard."""
+        buckets = get_buckets(hashes)
+        return {
+            name: rows
+            for name, mask in self.get_map().read_shards().items()
+            if len(rows := np.flatnonzero(mask[buckets]))
+        }
+
+    def probe(self, query: str, columns: List[np.ndarray], dtypes: list) -> List[np.ndarray]:
+        """
+        Runs a partial histogram query on each shard with the query rows routed to it, concurrently.
+
+        :param columns: The query columns, the hashes being the second-to-last one.
+        :return: The concatenated result columns of the shards.
+        """
+        routes = self.route(columns[-2])
+        for name in routes:
+            self.session(name)
+
+        def probe_shard(name: str, rows: np.ndarray):
+            session = self.session(name)
+            params = tuple(column[rows].tolist() for column in columns)
+            return session.copy_to(session.cursor.mogrify(query, params).decode(), dtypes)
+
+        partials = fan_out(
+            {
+                name: lambda name=name, rows=rows: probe_shard(name, rows)
+                for name, rows in routes.items()
+            }
+        )
+        empty = [np.empty(0, dtype=dtype) for dtype in dtypes]
+        return list(map(np.concatenate, zip(empty, *partials.values())))
+
+    def identify_song(
+        self, query_hashes: np.ndarray, query_offsets: np.ndarray, top_k: int = DEFAULT_TOP_K
+    ) -> List[SongMatch]:
+        """Identifies a song, with the same scoring as `FingerprintsDatabase.identify_song`."""
+        start_time = time.perf_counter()
+
+        query = """
+        SELECT f.song_id, f."offset" - q."offset" AS delta, COUNT(*)::integer
+        FROM fingerprints f
+        JOIN unnest(%s::bigint[], %s::integer[]) AS q(hash, "offset") ON f.hash = q.hash
+        GROUP BY f.song_id, delta
+        """
+        song_ids, deltas, counts = self.probe(
+            query, [query_hashes, query_offsets], [np.int32, np.int32, np.int32]
+        )
+
+        record_query(
+            "sharded",
+            time.perf_counter() - start_time,
+            nb_hashes=len(query_hashes),
+            matched_rows=int(counts.sum()),
+        )
+
+        return score_offset_alignment(song_ids, deltas, top_k=top_k, weights=counts)
+
+    def identify_songs_batch(
+        self, queries: List[Tuple[np.ndarray, np.ndarray]], top_k: int = DEFAULT_TOP_K
+    ) -> List[List[SongMatch]]:
+        """
+        Identifies many songs at once, with the same scoring as `identify_song`.
+
+        :param queries: The hashes and offsets of each query.
+        """
+        start_time = time.perf_counter()
+        query_ids = np.repeat(np.arange(len(queries)), [len(hashes) for hashes, _ in queries])
+        query_hashes = np.concatenate([hashes for hashes, _ in queries])
+        query_offsets = np.concatenate([offsets for _, offsets in queries])
+
+        query = """
+        SELECT q.query_id, f.song_id, f."offset" - q."offset" AS delta, COUNT(*)::integer
+        FROM fingerprints f
+        JOIN unnest(%s::integer[], %s::bigint[], %s::integer[]) AS q(query_id, hash, "offset")
+            ON f.hash = q.hash
+        GROUP BY q.query_id, f.song_id, delta
+        """
+        ids, song_ids, deltas, counts = self.probe(
+            query,
+            [query_ids, query_hashes, query_offsets],
+            [np.int32, np.int32, np.int32, np.int32],
+        )
+
+        record_query(
+            "sharded",
+            time.perf_counter() - start_time,
+            nb_hashes=len(query_hashes),
+            matched_rows=int(counts.sum()),
+        )
+
+        # Group the partial histograms by query
+        order = np.argsort(ids, kind="stable")
+        ids, song_ids, deltas, counts = ids[order], song_ids[order], deltas[order], counts[order]
+        bounds = np.searchsorted(ids, np.arange(len(queries) + 1))
+
+        return [
+            score_offset_alignment(
+                song_ids[start:end], deltas[start:end], top_k=top_k, weights=counts[start:end]
+            )
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+
+
+def wait_for_processes(wait: float):
+    """Waits until every process has reloaded the shard map."""
+    print(
+        colored(
+            f"Waiting {wait:.0f} s for every process to reload the shard map...",
+            color="yellow",
+        )
+    )
+    time.sleep(wait)
+
+
+def rebalance(db: FingerprintsDatabase, wait: float = 2 * SHARD_MAP_REFRESH_INTERVAL):
+    """
+    Moves buckets online so that the configured shards own even ranges of buckets, e.g. after a
+    shard was added to FINGERPRINT_SHARDS. Identifications and imports keep running meanwhile.
+
+    1. The moving buckets get their target shard : new hash pairs are written to both shards.
+    2. Once every process writes to both, the hash pairs stored before are copied to the target,
+       except for the songs the target already holds : written twice meanwhile, or copied by an
+       interrupted rebalance. Each copy waits for the imports writing to the shard to commit, so
+       that no song is missing from both the snapshot of the source and the target.
+    3. The buckets are switched to the target, which now serves their lookups.
+    4. Once no process reads the source anymore, the hash pairs are deleted from it.
+    """
+    shards = db.shards
+    placement = plan_buckets(list(shards.dsns))
+    shard_map = get_shard_map(db, refresh=True)
+
+    moves = {}
+    for bucket, (current, target) in enumerate(zip(shard_map.shards, placement)):
+        if current != target:
+            moves.setdefault((current, target), []).append(bucket)
+
+    if not moves:
+        print(colored("Buckets are already balanced.", color="green"))
+        return
+
+    # 1. Dual writes
+    with db.transaction():
+        for (_, target), buckets in moves.items():
+            db.execute_query(
+                "UPDATE shard_buckets SET target = %s WHERE bucket = ANY(%s)", (target, buckets)
+            )
+    wait_for_processes(wait)
+
+    # 2. Copy of the existing hash pairs, bucket by bucket to bound memory use
+    cutoff = db.fetch_one("SELECT COALESCE(MAX(id), 0) FROM songs")[0]
+    db.commit()
+
+    for (source, target), buckets in moves.items():
+        print(f"Copying {len(buckets)} buckets from {source} to {target}...")
+        source_db, target_db = shards.session(source), shards.session(target)
+
+        for bucket in buckets:
+            # The SHARE lock waits for the transactions writing to the table to commit, and blocks
+            # new writes until the end of the transaction, lookups carrying on meanwhile
+            with source_db.transaction():
+                source_db.execute_query("LOCK TABLE fingerprints IN SHARE MODE")
+                hashes, song_ids, offsets = source_db.copy_to(
+                    'SELECT hash, song_id, "offset" FROM fingerprints '
+                    f"WHERE song_id <= {int(cutoff)} AND mod(hash, {NB_BUCKETS}) = {int(bucket)}",
+                    [np.int64, np.int32, np.int32],
+                )
+
+            if not len(hashes):
+                continue
+
+            # The songs of the snapshot whose dual writes were in progress are committed on the
+            # target once the lock is held, and skipped like the ones it already holds
+            with target_db.transaction():
+                target_db.execute_query("LOCK TABLE fingerprints IN SHARE MODE")
+                target_db.execute_query(
+                    "CREATE TEMPORARY TABLE moved_pairs "
+                    '(song_id INTEGER, hash BIGINT, "offset" INTEGER) ON COMMIT DROP'
+                )
+                target_db.copy_from(
+                    "moved_pairs", ["song_id", "hash", "offset"], [song_ids, hashes, offsets]
+                )
+                target_db.execute_query(
+                    f"""
+                    WITH present AS (
+                        SELECT DISTINCT song_id FROM fingerprints
+                        WHERE mod(hash, {NB_BUCKETS}) = {int(bucket)}
+                    )
+                    INSERT INTO fingerprints (song_id, hash, "offset")
+                    SELECT m.song_id, m.hash, m."offset" FROM moved_pairs m
+                    WHERE NOT EXISTS (SELECT 1 FROM present p WHERE p.song_id = m.song_id)
+                    """
+                )
+
+        target_db.execute_query("ANALYZE fingerprints")
+
+    # 3. Switch of the lookups
+    with db.transaction():
+        for (_, target), buckets in moves.items():
+            db.execute_query(
+                "UPDATE shard_buckets SET shard = target, target = NULL WHERE bucket = ANY(%s)",
+                (buckets,),
+            )
+    wait_for_processes(wait)
+
+    # 4. Cleanup of the sources
+    for (source, _), buckets in moves.items():
+        source_db = shards.session(source)
+        for bucket in buckets:
+            source_db.execute_query(
+                f"DELETE FROM fingerprints WHERE mod(hash, {NB_BUCKETS}) = %s", (bucket,)
+            )
+        print(colored(f"Moved {len(buckets)} buckets out of {source}.", color="green"))
+
+    get_shard_map(db, refresh=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the shards of the fingerprints table.")
+    parser.add_argument("command", choices=["status", "setup", "rebalance"])
+    parser.add_argument(
+        "--wait",
+        type=float,
+        default=2 * SHARD_MAP_REFRESH_INTERVAL,
+        help="Time (in seconds) given to the other processes to reload the shard map.",
+    )
+    args = parser.parse_args()
+
+    if not FINGERPRINT_SHARDS:
+        parser.error("Set FINGERPRINT_SHARDS to the list of shards.")
+
+    with FingerprintsDatabase() as db:
+        if args.command == "setup":
+            db.shards.setup()
+        elif args.command == "rebalance":
+            db.shards.setup()
+            rebalance(db, wait=args.wait)
+
+        shard_map = get_shard_map(db, refresh=True)
+        for name, mask in shard_map.read_shards().items():
+            print(f"{name} : {mask.sum()} buckets")
+        moving = sum(target is not None for target in shard_map.targets)
+        if moving:
+            print(colored(f"{moving} buckets moving.", color="yellow"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import os
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Number of threads used by each FFT. A single thread by default, so that ingestion worker
+# processes do not oversubscribe the cores; raise it for one-off analyses of long files.
+STFT_WORKERS = int(os.getenv("STFT_WORKERS", 1))
+
+# Power floor applied before the conversion to dB, so that digital silence maps to a finite level
+# (-200 dB) instead of -inf.
+POWER_FLOOR = 1e-20
+
+# ------------------------------------------------------------------------------------------------- #
+
+
+@lru_cache(maxsize=8)
+def get_window(wsize: int) -> np.ndarray:
+    """
+    Hann window of `wsize` samples (float32), as used by matplotlib's `window_hanning`.
+    Computed once per size and shared : the returned array must not be modified.
+    """
+    window = np.hanning(wsize).astype(np.float32)
+    window.flags.writeable = False
+    return window
+
+
+def frame_signal(y: np.ndarray, wsize: int, hop: int) -> np.ndarray:
+    """
+    Split a signal into frames of `wsize` samples starting every `hop` samples, as a strided
+    read-only view of the signal (no copy). A signal shorter than a frame is zero-padded into one.
+    """
+    if len(y) < wsize:
+        y = np.pad(y, (0, wsize - len(y)))
+    return sliding_window_view(y, wsize)[::hop]
+
+
+def get_nb_bins(wsize: int, sr: int, max_frequency: Optional[float] = None) -> int:
+    """
+    Number of frequency bins of a one-sided spectrum of `wsize` samples, up to `max_frequency` (Hz)
+    included if set.
+    """
+    nb_bins = wsize // 2 + 1
+    if max_frequency is None:
+        return nb_bins
+    return min(nb_bins, int(max_frequency * wsize / sr) + 1)
+
+
+def power_spectrum(
+    frames: np.ndarray, sr: int, workers: int = STFT_WORKERS, nb_bins: Optional[int] = None
+) -> np.ndarray:
+    """
+    One-sided power spectral density of each frame, scaled like `matplotlib.mlab.specgram`
+    (Hann window, density per Hz, energy of negative frequencies folded into the positive ones).
+    With `nb_bins`, only the lowest bins are kept, the others being neither scaled nor converted.
+
+    :return: A (frames x frequency bins) float32 array.
+    """
+    # Imported on first use, so that importing this module does not load scipy
+    import scipy.fft
+
+    wsize = frames.shape[1]
+    window = get_window(wsize)
+
+    spectrum = scipy.fft.rfft(
+        frames.astype(np.float32, copy=False) * window, axis=1, workers=workers
+    )[:, :nb_bins]
+    psd = np.square(spectrum.real)
+    psd += np.square(spectrum.imag)
+
+    # Every bin but DC (and Nyquist for an even window size) holds the energy of two
+    nyquist = wsize // 2 if wsize % 2 == 0 else None
+    psd[:, 1:nyquist] *= 2
+    psd *= np.float32(1 / (sr * np.square(window, dtype=np.float64).sum()))
+
+    return psd
+
+
+def power_to_db(psd: np.ndarray) -> np.ndarray:
+    """Converts power values to dB, floored at POWER_FLOOR."""
+    db = np.maximum(psd, np.float32(POWER_FLOOR))
+    np.log10(db, out=db)
+    db *= 10
+    return db
+
+
+def stft(
+    y: np.ndarray,
+    sr: int,
+    wsize: int,
+    hop: int,
+    workers: int = STFT_WORKERS,
+    max_frequency: Optional[float] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Short-time Fourier transform of a signal, in dB, with the same frames, frequencies, times and
+    scaling as `matplotlib.mlab.specgram(y, NFFT=wsize, Fs=sr, noverlap=wsize - hop)`,
+    computed in float32. With `max_frequency` (Hz), the bins above it are dropped.
+
+    :return: The (frequency bins x frames) spectrogram in dB, the frequency of each bin (Hz)
+        and the time of the center of each frame (s).
+    """
+    nb_bins = get_nb_bins(wsize, sr, max_frequency)
+    frames = frame_signal(np.asarray(y), wsize, hop)
+    spectrogram = power_to_db(power_spectrum(frames, sr, workers=workers, nb_bins=nb_bins)).T
+
+    freqs = np.fft.rfftfreq(wsize, 1 / sr)[:nb_bins]
+    times = (wsize / 2 + hop * np.arange(len(frames))) / sr
+
+    return spectrogram, freqs, times
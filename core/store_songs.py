@@ -1,9 +1,60 @@
 import os
 import json
+import time
+import hashlib
+from collections import defaultdict
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
+from termcolor import colored
+
+from core.analysis_profile import AnalysisProfile, get_catalog_profile
 from core.database import FingerprintsDatabase
-from core.audio_processing import *
-from utils.audio_utils import *
+from core.audio_processing import (
+    create_spectrogram,
+    get_peaks,
+    create_fingerprint,
+    fingerprint_from_hashes,
+    stream_fingerprint,
+    store_fingerprint,
+    PEAK_NEIGHBORHOOD_SIZE,
+    DEFAULT_AMPLITUDE_THRESHOLD,
+    DEFAULT_FAN_VALUE,
+    MAX_HASH_TIME_DELTA,
+    HASH_FIELD_BITS,
+)
+from core.fingerprint_cache import get_fingerprint_cache, fingerprint_file_cached
+from core.metrics import (
+    span,
+    increment,
+    observe,
+    track_peak_rss,
+    write_metrics,
+    COUNT_BUCKETS,
+)
+from core.workers import run_in_worker_pool
+from utils.audio_utils import (
+    load_audio,
+    stream_audio,
+    get_duration,
+    hash_file,
+)
+from models.song_fingerprint import SongFingerprint
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Default number of worker processes computing fingerprints in parallel during an import.
+# With a single worker, files are processed in the calling process.
+DEFAULT_WORKERS = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+
+# Default number of fingerprinted songs written to the database in a single transaction.
+DEFAULT_BATCH_SIZE = 8
+
+# Duration (in seconds) above which audio files are fingerprinted with the streaming pipeline,
+# whose memory use does not depend on the length of the file (DJ mixes, live recordings, podcasts...).
+STREAMING_MIN_DURATION = 10 * 60
+
+# ------------------------------------------------------------------------------------------------- #
 
 
 def process_audio_file(
@@ -13,9 +64,21 @@ def process_audio_file(
     store_in_db: bool = False,
     plot_spectrogram: bool = False,
     plot_peaks: bool = False,
+    streaming: Optional[bool] = None,
+    content_hash: Optional[str] = None,
+    profile: Optional[AnalysisProfile] = None,
 ) -> list:
     """
-    Process an audio file through all steps to create a fingerprint.
+    Process an audio file through all steps to create a fingerprint, with the analysis `profile`
+    (the one of the catalog by default).
+
+    With `streaming`, the file is decoded and analyzed block by block, with a memory use independent
+    of its length (plots are not available). By default, streaming is used for files longer than
+    STREAMING_MIN_DURATION.
+
+    When the fingerprint cache is enabled (FINGERPRINT_CACHE_DIR), the stages already computed for
+    the same content and parameters are reused, unless plots are requested. `content_hash` avoids
+    hashing the file again when it is already known.
     """
 
     file_path = os.path.join(folder_path, file_name)
@@ -24,17 +87,63 @@ def process_audio_file(
     if verbose not in [0, 1, 2]:
         raise Exception("Verbose should be 0, 1 or 2.")
 
-    # Read the audio file
-    y, sr = load_audio(file_path=file_path, verbose=verbose)
+    if streaming is None:
+        streaming = get_duration(file_path) > STREAMING_MIN_DURATION
 
-    # Create a spectrogram
-    spectrogram, freqs, times = create_spectrogram(y=y, sr=sr, plot=plot_spectrogram)
+    profile = profile or get_catalog_profile()
+    sr = profile.sampling_rate
 
-    # Get peaks from the spectrogram
-    peaks = get_peaks(spectrogram=spectrogram, plot=plot_peaks)
+    cache = get_fingerprint_cache()
 
-    # Create a fingerprint from the peaks
-    fingerprint = create_fingerprint(peaks, freqs, times)
+    with track_peak_rss("ingest_peak_rss_bytes"):
+        if cache is not None and not (plot_spectrogram or plot_peaks):
+            with span("cached_fingerprint", path="ingest"):
+                fingerprint = fingerprint_file_cached(
+                    cache,
+                    file_path,
+                    content_hash=content_hash,
+                    streaming=streaming,
+                    sr=sr,
+                    **profile.get_spectrogram_params(),
+                )
+
+        elif streaming:
+            # Decode, analyze and hash the audio file block by block
+            with span("stream_fingerprint", path="ingest"):
+                hash_batches = list(
+                    stream_fingerprint(
+                        stream_audio(file_path, sr=sr),
+                        sr=sr,
+                        **profile.get_spectrogram_params(),
+                    )
+                )
+                hashes, offsets = map(
+                    np.concatenate,
+                    zip(*hash_batches, (np.empty(0, np.int64), np.empty(0, np.int32))),
+                )
+                fingerprint = fingerprint_from_hashes(hashes, offsets)
+
+        else:
+            # Read the audio file
+            with span("load_audio", path="ingest"):
+                y, sr = load_audio(file_path=file_path, sr=sr, verbose=verbose)
+
+            # Create a spectrogram
+            with span("spectrogram", path="ingest"):
+                spectrogram, freqs, times = create_spectrogram(
+                    y=y, sr=sr, plot=plot_spectrogram, **profile.get_spectrogram_params()
+                )
+
+            # Get peaks from the spectrogram
+            with span("peaks", path="ingest"):
+                peaks = get_peaks(spectrogram=spectrogram, plot=plot_peaks)
+            observe("fingerprint_peaks", len(peaks), buckets=COUNT_BUCKETS, path="ingest")
+
+            # Create a fingerprint from the peaks
+            with span("hashes", path="ingest"):
+                fingerprint = create_fingerprint(peaks, freqs, times)
+
+    observe("fingerprint_hashes", len(fingerprint), buckets=COUNT_BUCKETS, path="ingest")
 
     if verbose >= 1:
         print(
@@ -44,10 +153,10 @@ def process_audio_file(
             ),
         )
     if verbose == 2:
-        for i, hash_pair in enumerate(fingerprint, 1):
+        for hash_value, offset in fingerprint:
             print(
                 colored(
-                    f"Time : {hash_pair.get_offset} - Hash : {hash_pair.get_hash}",
+                    f"Time : {offset} - Hash : {hash_value}",
                     color="yellow",
                 )
             )
@@ -64,3 +173,389 @@ def process_audio_file(
             )
 
     return fingerprint
+
+
+def fingerprint_audio_file_timed(
+    file_name: str,
+    folder_path: str,
+    content_hash: Optional[str] = None,
+    profile: Optional[AnalysisProfile] = None,
+) -> Tuple[SongFingerprint, float]:
+    """
+    Fingerprint an audio file, and return the fingerprint with the time (in seconds) it took.
+    """
+    start = time.perf_counter()
+    fingerprint = process_audio_file(
+        file_name, folder_path, verbose=0, content_hash=content_hash, profile=profile
+    )
+    return fingerprint, time.perf_counter() - start
+
+
+def fingerprint_audio_files(
+    file_names: List[str],
+    folder_path: str,
+    workers: int = DEFAULT_WORKERS,
+    content_hashes: Optional[Dict[str, str]] = None,
+    profile: Optional[AnalysisProfile] = None,
+) -> Iterator[Tuple[str, Union[SongFingerprint, Exception], Optional[float]]]:
+    """
+    Fingerprint audio files in worker processes. A file killing its worker process (out of memory
+    on a long file...) fails alone, the other files being retried in a new pool.
+
+    :param content_hashes: The content hash of the files, if already known.
+    :param profile: The analysis profile, the one of the catalog by default.
+    :return: An iterator of (file name, fingerprint, seconds) in completion order, where the
+        fingerprint is replaced by the exception raised if the file could not be processed, and
+        seconds is the time spent fingerprinting the file (None on error).
+    """
+    content_hashes = content_hashes or {}
+    profile = profile or get_catalog_profile()
+
+    if workers <= 1:
+        for file_name in file_names:
+            try:
+                yield file_name, *fingerprint_audio_file_timed(
+                    file_name,
+                    folder_path,
+                    content_hash=content_hashes.get(file_name),
+                    profile=profile,
+                )
+            except Exception as e:
+                yield file_name, e, None
+        return
+
+    jobs = {
+        file_name: (file_name, folder_path, content_hashes.get(file_name), profile)
+        for file_name in file_names
+    }
+    for file_name, result in run_in_worker_pool(
+        fingerprint_audio_file_timed, jobs, workers, profile=profile
+    ):
+        if isinstance(result, Exception):
+            yield file_name, result, None
+        else:
+            yield file_name, *result
+
+
+def get_fingerprint_params(profile: Optional[AnalysisProfile] = None) -> dict:
+    """
+    Parameters the stored fingerprints depend on : songs indexed with other values must be re-indexed.
+
+    :param profile: The analysis profile, the one of the catalog by default.
+    """
+    return {
+        **(profile or get_catalog_profile()).get_params(),
+        "neighborhood_size": PEAK_NEIGHBORHOOD_SIZE,
+        "amplitude_threshold": DEFAULT_AMPLITUDE_THRESHOLD,
+        "fan_value": DEFAULT_FAN_VALUE,
+        "max_hash_time_delta": MAX_HASH_TIME_DELTA,
+        "hash_field_bits": HASH_FIELD_BITS,
+    }
+
+
+def get_params_key(params: Optional[dict] = None) -> str:
+    """
+    Short digest identifying a set of fingerprint parameters (the current ones by default).
+    """
+    params = get_fingerprint_params() if params is None else params
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def plan_ingestion(
+    db: FingerprintsDatabase,
+    file_names: List[str],
+    folder_path: str,
+    song_details: dict,
+    params_key: str,
+) -> Tuple[Dict[str, dict], List[str]]:
+    """
+    Compare audio files with the ingestion manifest to find the ones to (re)index.
+
+    A file is skipped if a song was already indexed from the same content with the same fingerprint
+    parameters. Files whose size and modification time did not change are skipped without being read,
+    copies included : each path has its own manifest entry. A changed file (or one indexed with other
+    parameters) replaces the song previously indexed from its path, unless another existing file
+    still points to it. Songs stored before the manifest existed are recognized by their title and
+    artists, and recorded in the manifest as they are.
+
+    :return: The manifest entry of each file to index, with the IDs of the songs it `replaces`,
+        and the names of the files skipped.
+    """
+    manifest = db.get_manifest()
+    indexed = {(entry["content_hash"], entry["params_key"]): entry for entry in manifest}
+    entries_by_path, paths_by_song = defaultdict(list), defaultdict(set)
+    for entry in manifest:
+        entries_by_path[entry["file_path"]].append(entry)
+        paths_by_song[entry["song_id"]].add(entry["file_path"])
+
+    to_index, skipped, planned = {}, [], set()
+
+    for file_name in file_names:
+        file_path = os.path.join(folder_path, file_name)
+        stat = os.stat(file_path)
+        previous = entries_by_path[file_path]
+
+        if any(
+            entry["params_key"] == params_key
+            and entry["file_size"] == stat.st_size
+            and entry["modified_time"] == stat.st_mtime
+            for entry in previous
+        ):
+            skipped.append(file_name)
+            continue
+
+        entry = {
+            "file_path": file_path,
+            "file_size": stat.st_size,
+            "modified_time": stat.st_mtime,
+            "content_hash": hash_file(file_path),
+            "params_key": params_key,
+        }
+
+        # Same content already indexed (touched, moved or copied file) : only refresh the manifest
+        existing = indexed.get((entry["content_hash"], params_key))
+        if existing is None and not previous:
+            details = song_details.get(os.path.splitext(file_name)[0], {})
+            song_id = db.find_song(details.get("title"), details.get("artists"))
+            existing = {"song_id": song_id} if song_id is not None else None
+
+        if existing is not None:
+            db.add_to_manifest({**entry, "song_id": existing["song_id"]})
+            skipped.append(file_name)
+            continue
+
+        # Copy of a file indexed in this run
+        if entry["content_hash"] in planned:
+            skipped.append(file_name)
+            continue
+
+        # The song of a file that changed is kept as long as a copy of the file still exists
+        planned.add(entry["content_hash"])
+        to_index[file_name] = {
+            **entry,
+            "replaces": [
+                old_entry["song_id"]
+                for old_entry in previous
+                if not any(
+                    path != file_path and os.path.exists(path)
+                    for path in paths_by_song[old_entry["song_id"]]
+                )
+            ],
+        }
+
+    return to_index, skipped
+
+
+def store_song(
+    db: FingerprintsDatabase,
+    song_details: dict,
+    fingerprint: SongFingerprint,
+    manifest_entry: Optional[dict] = None,
+) -> int:
+    """
+    Store a song and its fingerprint, and record it in the ingestion manifest, in a single transaction.
+    The songs previously indexed from the same file are deleted in the same transaction.
+    """
+    with db.transaction():
+        if manifest_entry is not None:
+            for song_id in manifest_entry["replaces"]:
+                db.delete_song(song_id)
+
+        song_id = store_fingerprint(db, song_details, fingerprint)
+
+        if manifest_entry is not None:
+            db.add_to_manifest({**manifest_entry, "song_id": song_id})
+
+    return song_id
+
+
+def store_batch(
+    db: FingerprintsDatabase, batch: List[tuple], failed: Dict[str, str]
+) -> Dict[str, int]:
+    """
+    Store a batch of (file name, song details, fingerprint, manifest entry) in a single transaction.
+    If the transaction fails, the songs are stored one by one so that a single bad song
+    does not prevent the others from being stored.
+
+    :return: The ID of the song stored from each file stored.
+    """
+    try:
+        with span("store", path="ingest"), db.transaction():
+            return {
+                file_name: store_song(db, song_details, fingerprint, manifest_entry)
+                for file_name, song_details, fingerprint, manifest_entry in batch
+            }
+
+    except Exception:
+        stored = {}
+        for file_name, song_details, fingerprint, manifest_entry in batch:
+            try:
+                stored[file_name] = store_song(db, song_details, fingerprint, manifest_entry)
+            except Exception as e:
+                failed[file_name] = str(e)
+        return stored
+
+
+def store_audio_files(
+    file_names: List[str],
+    folder_path: str,
+    workers: int = DEFAULT_WORKERS,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    progress_callback: Optional[Callable[[int, int, str], None]] = None,
+    file_callback: Optional[Callable[[dict], None]] = None,
+    verbose: int = 1,
+) -> dict:
+    """
+    Fingerprint audio files in parallel and store them in the database.
+
+    Files already indexed with the current fingerprint parameters, according to the ingestion
+    manifest, are skipped, and changed files replace their previous song. Worker processes decode and
+    fingerprint the remaining files, while the calling process writes the results through a single
+    connection, `batch_size` songs per transaction. Each song is recorded in the manifest within the
+    transaction that stores it, so an interrupted import resumes after the last committed batch.
+    An error on a file (corrupted audio, missing metadata...) is recorded and does not stop the import.
+
+    :param file_names: The audio files to import.
+    :param folder_path: The folder containing the files and their `song_details.json`.
+    :param workers: The number of worker processes.
+    :param batch_size: The number of songs written per transaction.
+    :param progress_callback: Called with (files done, total files, file name) after each file.
+    :param file_callback: Called with the result of each file once it is final : a dictionary with
+        the `file` name, its `status` (stored, skipped or failed), and when known the `song_id`, the
+        number of `hashes`, the `error`, the `fingerprint_seconds` and the `store_seconds` (the
+        time of its batch transaction divided among the songs of the batch).
+    :param verbose: The verbosity level, to control log messages.
+    :return: A dictionary with the lists of `stored` and `skipped` files, and the `failed` files
+        with their error.
+    """
+    with open(os.path.join(folder_path, "song_details.json"), "r") as f:
+        song_details = json.load(f)
+
+    def report(file_name: str, status: str, **fields):
+        if file_callback:
+            file_callback({"file": file_name, "status": status, **fields})
+
+    total_files = len(file_names)
+    stored, failed, batch, fingerprint_times = [], {}, [], {}
+
+    with FingerprintsDatabase() as db:
+        db.setup_manifest()
+        profile = get_catalog_profile(db, record=True)
+        with span("plan", path="ingest"):
+            to_index, skipped = plan_ingestion(
+                db,
+                file_names,
+                folder_path,
+                song_details,
+                get_params_key(get_fingerprint_params(profile)),
+            )
+
+        for done, file_name in enumerate(skipped, 1):
+            report(file_name, "skipped")
+            if progress_callback:
+                progress_callback(done, total_files, file_name)
+
+        if verbose and skipped:
+            print(colored(f"Skipped {len(skipped)} files already indexed.", color="yellow"))
+
+        fingerprints = fingerprint_audio_files(
+            list(to_index),
+            folder_path,
+            workers=workers,
+            content_hashes={
+                file_name: entry["content_hash"] for file_name, entry in to_index.items()
+            },
+            profile=profile,
+        )
+
+        for done, (file_name, fingerprint, seconds) in enumerate(fingerprints, len(skipped) + 1):
+            try:
+                if isinstance(fingerprint, Exception):
+                    raise fingerprint
+
+                details = song_details[os.path.splitext(file_name)[0]]
+                batch.append((file_name, details, fingerprint, to_index[file_name]))
+                fingerprint_times[file_name] = seconds
+
+                if verbose:
+                    print(
+                        colored(
+                            f"Generated fingerprint for song : {file_name} ({len(fingerprint)} points).",
+                            color="green",
+                        )
+                    )
+
+            except Exception as e:
+                failed[file_name] = repr(e)
+                report(file_name, "failed", error=repr(e), fingerprint_seconds=seconds)
+                if verbose:
+                    print(colored(f"Failed to process {file_name} : {e!r}", color="red"))
+
+            if len(batch) >= batch_size or done == total_files:
+                start = time.perf_counter()
+                song_ids = store_batch(db, batch, failed)
+                store_seconds = (time.perf_counter() - start) / max(len(batch), 1)
+                stored += list(song_ids)
+
+                for batch_file, _, batch_fingerprint, _ in batch:
+                    times = {
+                        "fingerprint_seconds": fingerprint_times.pop(batch_file),
+                        "store_seconds": store_seconds,
+                    }
+                    if batch_file in song_ids:
+                        report(
+                            batch_file,
+                            "stored",
+                            song_id=song_ids[batch_file],
+                            hashes=len(batch_fingerprint),
+                            **times,
+                        )
+                    else:
+                        report(batch_file, "failed", error=failed[batch_file], **times)
+                batch = []
+
+            if progress_callback:
+                progress_callback(done, total_files, file_name)
+
+    increment("ingested_files_total", len(stored), result="stored")
+    increment("ingested_files_total", len(skipped), result="skipped")
+    increment("ingested_files_total", len(failed), result="failed")
+    write_metrics()
+
+    return {"stored": stored, "skipped": skipped, "failed": failed}
+
+
+def store_audio_folder(
+    folder_path: str = "data/songs",
+    workers: int = DEFAULT_WORKERS,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    verbose: int = 1,
+) -> dict:
+    """
+    Fingerprint all the `.mp3` files of a folder and store them in the database.
+    Files already indexed are skipped, so that the import of a growing library only processes new
+    and changed files.
+
+    :param folder_path: The folder where audio files and their `song_details.json` are stored.
+    :param workers: The number of worker processes.
+    :param batch_size: The number of songs written per transaction.
+    :param verbose: The verbosity level, to control log messages.
+    :return: A dictionary with the lists of `stored` and `skipped` files, and the `failed` files
+        with their error.
+    """
+    file_names = [
+        file_name for file_name in os.listdir(folder_path) if file_name.endswith(".mp3")
+    ]
+
+    def print_progress(done: int, total: int, file_name: str):
+        if verbose:
+            print(f"[{done}/{total}] {file_name}")
+
+    return store_audio_files(
+        file_names,
+        folder_path,
+        workers=workers,
+        batch_size=batch_size,
+        progress_callback=print_progress,
+        verbose=verbose,
+    )
@@ -0,0 +1,142 @@
+import os
+import importlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Generator, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from core.analysis_profile import AnalysisProfile, get_profile
+from core.audio_processing import create_spectrogram, get_peaks, create_fingerprint
+from core.metrics import collect_metrics, merge_metrics
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Whether worker processes are pre-warmed when their pool starts : they load the audio libraries
+# and fingerprint a short synthetic signal once, instead of paying for it on their first job.
+WORKER_PREWARM = os.getenv("WORKER_PREWARM", "true").lower() not in ("0", "false", "no")
+
+# Libraries loaded by the workers of an import (decoding files) and of the service (decoding clips).
+INGEST_MODULES = ("librosa", "soundfile", "soxr")
+SERVICE_MODULES = ("soundfile", "soxr")
+
+# Duration (in seconds) of the synthetic signal fingerprinted on warm-up.
+WARM_UP_DURATION = 2
+
+# ------------------------------------------------------------------------------------------------- #
+
+
+def warm_up_worker(
+    modules: Tuple[str, ...] = INGEST_MODULES, profile: Optional[AnalysisProfile] = None
+):
+    """
+    Prepares a worker process for its jobs : imports the given libraries, and runs the fingerprint
+    pipeline once with the analysis `profile` of its jobs (ANALYSIS_PROFILE by default), so that
+    its lazy imports and caches (FFT windows and plans) are ready.
+    """
+    profile = profile or get_profile()
+
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            # Jobs needing it fail with a clear error, the pool itself must start
+            pass
+
+    rng = np.random.default_rng(0)
+    y = rng.standard_normal(profile.sampling_rate * WARM_UP_DURATION).astype(np.float32)
+    spectrogram, freqs, times = create_spectrogram(
+        y=y, sr=profile.sampling_rate, **profile.get_spectrogram_params()
+    )
+    create_fingerprint(get_peaks(spectrogram=spectrogram), freqs, times)
+
+
+def create_worker_pool(
+    max_workers: int,
+    modules: Tuple[str, ...] = INGEST_MODULES,
+    profile: Optional[AnalysisProfile] = None,
+) -> ProcessPoolExecutor:
+    """
+    Creates a pool of worker processes, pre-warmed with `warm_up_worker` unless WORKER_PREWARM is
+    disabled. Workers are kept for the lifetime of the pool and serve many jobs each.
+    """
+    if not WORKER_PREWARM:
+        return ProcessPoolExecutor(max_workers=max_workers)
+
+    return ProcessPoolExecutor(
+        max_workers=max_workers, initializer=warm_up_worker, initargs=(modules, profile)
+    )
+
+
+def _run_jobs(
+    function: Callable, jobs: Dict[str, tuple], max_workers: int, **pool_kwargs
+) -> Generator[Tuple[str, Any], None, Tuple[List[str], List[str]]]:
+    """
+    Runs jobs in a new worker pool, at most `max_workers` at a time, until one of its worker
+    processes dies.
+
+    :return: The jobs in flight when a worker process died, and the jobs not submitted yet.
+    """
+    executor = create_worker_pool(max_workers, **pool_kwargs)
+    queue, futures = deque(jobs), {}
+    try:
+        while queue or futures:
+            while queue and len(futures) < max_workers:
+                futures[executor.submit(collect_metrics, function, *jobs[queue[0]])] = queue[0]
+                queue.popleft()
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                key = futures.pop(future)
+                error = future.exception()
+                if isinstance(error, BrokenProcessPool):
+                    futures[future], broken = key, True
+                elif error:
+                    yield key, error
+                else:
+                    result, metrics = future.result()
+                    merge_metrics(metrics)
+                    yield key, result
+
+            if broken:
+                return list(futures.values()), list(queue)
+    except BrokenProcessPool:
+        # A worker process died while a job was submitted, which counts as in flight if no other is
+        return list(futures.values()) or [queue.popleft()], list(queue)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    return [], []
+
+
+def run_in_worker_pool(
+    function: Callable, jobs: Dict[str, tuple], max_workers: int, **pool_kwargs
+) -> Iterator[Tuple[str, Any]]:
+    """
+    Runs `function(*args)` for each job in a pool of worker processes created with
+    `create_worker_pool(max_workers, **pool_kwargs)`, the metrics recorded by the workers being
+    merged into the registry of the process.
+
+    When a worker process dies (killed by the OOM killer on a long file...), the pool is recreated :
+    the jobs that were in flight are retried one at a time, so that only the job killing its worker
+    fails, and the other jobs carry on.
+
+    :param jobs: The arguments of each job, by key.
+    :return: An iterator of (job key, result) in completion order, where the result is replaced by
+        the exception raised if the job failed.
+    """
+    pending = list(jobs)
+    while pending:
+        in_flight, pending = yield from _run_jobs(
+            function, {key: jobs[key] for key in pending}, max_workers, **pool_kwargs
+        )
+
+        while in_flight:
+            crashed, in_flight = yield from _run_jobs(
+                function, {key: jobs[key] for key in in_flight}, 1, **pool_kwargs
+            )
+            for key in crashed:
+                yield key, BrokenProcessPool(f"A worker process died while running job {key!r}.")
+
@@ -3,9 +3,12 @@ import streamlit as st
 import __init__
 from app.views.songs_import import import_songs
 from app.views.guess_songs import identify_song
+from core.metrics import start_metrics_server
 
 
 def app():
+    start_metrics_server()
+
     st.title("Music Recognition App")
 
     identifying, importing = st.tabs(["Identify a song", "Import songs"])
@@ -0,0 +1,52 @@
+from termcolor import colored
+
+import __init__
+from core.database import FingerprintsDatabase
+from core.audio_processing import DEFAULT_WINDOW_SIZE, DEFAULT_WINDOW_RATIO
+from utils.audio_utils import DEFAULT_SAMPLING_RATE
+
+
+def format_size(size: int) -> str:
+    """Format a size in bytes as a human-readable string."""
+    for unit in ["B", "kB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def print_sizes(label: str, sizes: dict):
+    print(
+        colored(
+            f"{label} : table {format_size(sizes['table'])}, "
+            f"hash index {format_size(sizes['index'])}, "
+            f"total {format_size(sizes['total'])}",
+            color="yellow",
+        )
+    )
+
+
+with FingerprintsDatabase() as db:
+    sizes_before = db.get_table_sizes()
+    print_sizes("Before migration", sizes_before)
+
+    hop_length = DEFAULT_WINDOW_SIZE - int(DEFAULT_WINDOW_SIZE * DEFAULT_WINDOW_RATIO)
+    migrated = db.migrate_fingerprints(
+        sampling_rate=DEFAULT_SAMPLING_RATE,
+        window_size=DEFAULT_WINDOW_SIZE,
+        hop_length=hop_length,
+    )
+
+    if not migrated:
+        print(colored("Fingerprints already use the integer format.", color="green"))
+    else:
+        sizes_after = db.get_table_sizes()
+        print_sizes("After migration", sizes_after)
+        print(
+            colored(
+                f"Fingerprints migrated successfully "
+                f"({sizes_before['total'] / sizes_after['total']:.1f}x smaller).",
+                color="green",
+                attrs=["bold"],
+            )
+        )
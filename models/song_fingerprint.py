@@ -1,8 +1,15 @@
-from typing import List, Tuple, Optional
+from typing import Iterable, Iterator, List, Tuple, Optional, Union
+
+import numpy as np
+
+# Number of hash pairs a fingerprint has room for before its columns are first grown.
+INITIAL_CAPACITY = 1024
 
 
 class SongHashPair:
-    def __init__(self, hash: str, offset: float):
+    __slots__ = ("hash", "offset")
+
+    def __init__(self, hash: int, offset: int):
         self.hash = hash
         self.offset = offset
 
@@ -18,41 +25,133 @@ class SongHashPair:
     def __ne__(self, other) -> bool:
         return not self.__eq__(other)
 
-    def get_hash(self) -> str:
+    def get_hash(self) -> int:
         return self.hash
 
-    def get_offset(self) -> float:
+    def get_offset(self) -> int:
         return self.offset
 
-    def get_hash_pair(self) -> Tuple[str, float]:
+    def get_hash_pair(self) -> Tuple[int, int]:
         return (self.hash, self.offset)
 
 
 class SongFingerprint:
+    """
+    Hash pairs of a song, stored in two contiguous columns : packed hashes (int64) and frame
+    offsets (int32). Appends grow the columns geometrically, and `hashes` and `offsets` are views
+    of their filled part, handed to NumPy and to the database without copies.
+
+    Iterating a fingerprint still yields (hash, offset) tuples.
+    """
+
     def __init__(
-        self, song_id: Optional[int] = None, hash_pairs: List[SongHashPair] = []
+        self,
+        song_id: Optional[int] = None,
+        hash_pairs: Optional[Iterable[SongHashPair]] = None,
     ):
         self.song_id = song_id
-        self.hash_pairs = hash_pairs
+        self._hashes = np.empty(INITIAL_CAPACITY, dtype=np.int64)
+        self._offsets = np.empty(INITIAL_CAPACITY, dtype=np.int32)
+        self._size = 0
+
+        if hash_pairs is not None:
+            pairs = [hash_pair.get_hash_pair() for hash_pair in hash_pairs]
+            if pairs:
+                hashes, offsets = zip(*pairs)
+                self.add_hashes(np.array(hashes), np.array(offsets))
+
+    @classmethod
+    def from_arrays(
+        cls, hashes: np.ndarray, offsets: np.ndarray, song_id: Optional[int] = None
+    ) -> "SongFingerprint":
+        """
+        Creates a fingerprint from columns of hashes and offsets, used as they are when they
+        already have the right dtypes.
+        """
+        if len(hashes) != len(offsets):
+            raise ValueError("hashes and offsets must have the same length")
+
+        fingerprint = cls(song_id=song_id)
+        fingerprint._hashes = np.ascontiguousarray(hashes, dtype=np.int64)
+        fingerprint._offsets = np.ascontiguousarray(offsets, dtype=np.int32)
+        fingerprint._size = len(fingerprint._hashes)
+        return fingerprint
+
+    @property
+    def hashes(self) -> np.ndarray:
+        """The packed hashes of the fingerprint (a view, valid until the next append)."""
+        return self._hashes[: self._size]
+
+    @property
+    def offsets(self) -> np.ndarray:
+        """The offsets (in frames) of the hashes (a view, valid until the next append)."""
+        return self._offsets[: self._size]
+
+    @property
+    def hash_pairs(self) -> List[SongHashPair]:
+        return [SongHashPair(hash, offset) for hash, offset in self]
 
     def __len__(self) -> int:
-        return len(self.hash_pairs)
+        return self._size
 
-    def __iter__(self):
-        for hash_pair in self.hash_pairs:
-            yield hash_pair.get_hash_pair()
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return zip(self.hashes.tolist(), self.offsets.tolist())
 
     def check_empty(self) -> bool:
-        return len(self.hash_pairs) == 0
+        return self._size == 0
+
+    def reserve(self, capacity: int):
+        """Grows the columns to hold at least `capacity` hash pairs, doubling their size."""
+        if capacity <= len(self._hashes):
+            return
+
+        new_capacity = max(capacity, 2 * len(self._hashes), INITIAL_CAPACITY)
+        for name in ("_hashes", "_offsets"):
+            column = getattr(self, name)
+            grown = np.empty(new_capacity, dtype=column.dtype)
+            grown[: self._size] = column[: self._size]
+            setattr(self, name, grown)
 
     def add_hash_pair(self, hash_pair: SongHashPair):
-        self.hash_pairs.append(hash_pair)
+        self.reserve(self._size + 1)
+        self._hashes[self._size] = hash_pair.get_hash()
+        self._offsets[self._size] = hash_pair.get_offset()
+        self._size += 1
+
+    def add_hashes(self, hashes: Union[np.ndarray, list], offsets: Union[np.ndarray, list]):
+        """Appends columns of hashes and offsets."""
+        if len(hashes) != len(offsets):
+            raise ValueError("hashes and offsets must have the same length")
+
+        end = self._size + len(hashes)
+        self.reserve(end)
+        self._hashes[self._size : end] = hashes
+        self._offsets[self._size : end] = offsets
+        self._size = end
 
     def get_song_id(self) -> str:
         return self.song_id
 
-    def get_fingerprint(self) -> List[Tuple[str, float]]:
-        return [hash_pair.get_hash_pair() for hash_pair in self.hash_pairs]
+    def get_fingerprint(self) -> List[Tuple[int, int]]:
+        return list(self)
+
+    def get_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the hashes and offsets of the fingerprint, as views."""
+        return self.hashes, self.offsets
 
     def set_song_id(self, song_id: int):
         self.song_id = song_id
+
+
+def to_hash_arrays(
+    hash_pairs: Union[SongFingerprint, Iterable[Tuple[int, int]]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the hashes (int64) and offsets (int32) of a fingerprint or of (hash, offset) tuples,
+    without copies for a fingerprint.
+    """
+    if isinstance(hash_pairs, SongFingerprint):
+        return hash_pairs.get_arrays()
+
+    pairs = np.array(list(hash_pairs), dtype=np.int64).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1].astype(np.int32)
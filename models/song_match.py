@@ -0,0 +1,55 @@
+from typing import List, Tuple
+
+
+class SongMatch:
+    def __init__(self, song_id: int, score: int, offset: int, margin: int = 0):
+        """
+        :param song_id: The ID of the candidate song.
+        :param score: Number of query hashes aligned on the best offset difference.
+        :param offset: The best offset difference (in frames) between the song and the query.
+        :param margin: Score difference with the next candidate in the ranking.
+        """
+        self.song_id = song_id
+        self.score = score
+        self.offset = offset
+        self.margin = margin
+
+    def __repr__(self) -> str:
+        return (
+            f"SongMatch(song_id={self.song_id}, score={self.score}, "
+            f"offset={self.offset}, margin={self.margin})"
+        )
+
+    def __eq__(self, other) -> bool:
+        return (
+            self.song_id == other.song_id
+            and self.score == other.score
+            and self.offset == other.offset
+            and self.margin == other.margin
+        )
+
+    def get_song_id(self) -> int:
+        return self.song_id
+
+    def get_score(self) -> int:
+        return self.score
+
+    def get_offset(self) -> int:
+        return self.offset
+
+    def get_margin(self) -> int:
+        return self.margin
+
+
+def rank_matches(candidates: List[Tuple[int, int, int]]) -> List[SongMatch]:
+    """
+    Build the ranked list of matches from (song_id, score, offset) candidates,
+    each match carrying its margin over the next one.
+    """
+    candidates = sorted(candidates, key=lambda candidate: candidate[1], reverse=True)
+    scores = [score for _, score, _ in candidates] + [0]
+
+    return [
+        SongMatch(song_id, score, offset, margin=score - scores[i + 1])
+        for i, (song_id, score, offset) in enumerate(candidates)
+    ]
@@ -0,0 +1,349 @@
+"""
+Headless identification service : an asyncio HTTP API identifying clips uploaded by clients.
+
+    POST /identify    Identify a clip sent as the request body or as the `file` field of a form :
+                      an audio file (WAV, FLAC, OGG, MP3), raw 16-bit PCM samples with
+                      `?sample_rate=<Hz>&channels=<n>`, or a precomputed fingerprint as JSON
+                      {"hashes": [...], "offsets": [...]} computed with the analysis profile
+                      of the catalog.
+    GET  /health      Status and load of the service, and analysis profile of the catalog (read
+                      again every PROFILE_REFRESH_INTERVAL seconds).
+    GET  /metrics     Metrics in the Prometheus text format (when metrics are enabled).
+
+Clips are decoded and fingerprinted in a pool of worker processes, and matched on pooled database
+connections from a thread pool, so that throughput grows with the number of cores. Requests beyond
+the concurrency limit wait in a bounded queue : when it is full, new requests are rejected (503)
+instead of piling up, and requests taking longer than the timeout are abandoned (504). When a
+worker process dies, the pool is restarted and the clip retried once before answering 503.
+
+Usage :
+    python3 service.py [--host 0.0.0.0] [--port 8080] [--workers 4]
+"""
+
+import os
+import time
+import asyncio
+import argparse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from aiohttp import web
+from termcolor import colored
+
+import __init__
+from core.analysis_profile import AnalysisProfile, get_catalog_profile
+from core.audio_processing import fingerprint_from_hashes
+from core.database import FingerprintsDatabase, POOL_MAX_SIZE
+from core.fingerprint_index import get_shared_index
+from core.identification import fingerprint_query, match_fingerprint, MATCHING_ENGINE
+from core.metrics import (
+    span,
+    increment,
+    observe,
+    collect_metrics,
+    merge_metrics,
+    registry,
+    METRICS_ENABLED,
+)
+from core.workers import create_worker_pool, SERVICE_MODULES
+from models.song_fingerprint import SongFingerprint
+from models.song_match import SongMatch
+from utils.audio_utils import load_audio_bytes
+
+# ------------------------------------------- CONSTANTS ------------------------------------------- #
+
+# Address the service listens on.
+SERVICE_HOST = os.getenv("SERVICE_HOST", "0.0.0.0")
+SERVICE_PORT = int(os.getenv("SERVICE_PORT", 8080))
+
+# Number of worker processes decoding and fingerprinting clips.
+SERVICE_WORKERS = int(os.getenv("SERVICE_WORKERS", os.cpu_count() or 1))
+
+# Number of requests processed at once. Twice the number of workers by default, so that the workers
+# keep fingerprinting while other requests wait for the database.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("SERVICE_MAX_CONCURRENT", 2 * SERVICE_WORKERS))
+
+# Number of requests waiting for a processing slot, beyond which new requests are rejected (503).
+MAX_QUEUED_REQUESTS = int(os.getenv("SERVICE_MAX_QUEUED", 64))
+
+# Maximum time (in seconds) spent on a request, waiting time included, before answering 504.
+REQUEST_TIMEOUT = float(os.getenv("SERVICE_REQUEST_TIMEOUT", 30))
+
+# Maximum size (in MB) of an uploaded clip (413 beyond), and duration (in seconds) of a clip
+# actually fingerprinted : the rest is ignored.
+MAX_UPLOAD_SIZE = int(os.getenv("SERVICE_MAX_UPLOAD_MB", 20)) << 20
+MAX_CLIP_DURATION = 30
+
+# ------------------------------------------------------------------------------------------------- #
+
+
+def fingerprint_clip(
+    data: bytes,
+    profile: AnalysisProfile,
+    pcm_sample_rate: Optional[int] = None,
+    pcm_channels: int = 1,
+) -> Tuple[np.ndarray, np.ndarray, float]:
+    """
+    Decode and fingerprint an uploaded clip with the analysis profile of the catalog, in a worker
+    process.
+
+    :return: The hashes and offsets of the fingerprint, and the duration (in seconds) of the clip.
+    """
+    with span("decode", path="service"):
+        y, sr = load_audio_bytes(
+            data,
+            sr=profile.sampling_rate,
+            pcm_sample_rate=pcm_sample_rate,
+            pcm_channels=pcm_channels,
+        )
+    duration = len(y) / sr
+
+    hashes, offsets = fingerprint_query(y[: MAX_CLIP_DURATION * sr], sr, profile).get_arrays()
+
+    return hashes, offsets, duration
+
+
+def lookup(fingerprint: SongFingerprint) -> Tuple[List[SongMatch], Optional[dict]]:
+    """
+    Match a fingerprint and fetch the details of the best candidate, on a pooled connection.
+    """
+    with FingerprintsDatabase() as db:
+        matches = match_fingerprint(fingerprint, db=db)
+        if not matches:
+            return matches, None
+
+        with span("metadata", path="service"):
+            return matches, db.get_song_details_by_id(matches[0].get_song_id())
+
+
+def match_to_dict(match: SongMatch) -> dict:
+    return {
+        "song_id": match.get_song_id(),
+        "score": match.get_score(),
+        "margin": match.get_margin(),
+        "offset": match.get_offset(),
+    }
+
+
+def error_response(status: int, message: str, **kwargs) -> web.Response:
+    increment("service_requests_total", status=str(status))
+    return web.json_response({"error": message}, status=status, **kwargs)
+
+
+async def read_clip(request: web.Request) -> Tuple[Optional[SongFingerprint], bytes, dict]:
+    """
+    Read the clip of a request.
+
+    :return: The precomputed fingerprint sent, or the audio data and its PCM format (if raw).
+    """
+    params = dict(request.query)
+
+    if request.content_type == "application/json":
+        body = await request.json()
+        hashes = np.asarray(body["hashes"], dtype=np.int64)
+        offsets = np.asarray(body["offsets"], dtype=np.int32)
+        if hashes.shape != offsets.shape or hashes.ndim != 1:
+            raise ValueError("hashes and offsets must be lists of the same length")
+        return fingerprint_from_hashes(hashes, offsets), b"", {}
+
+    if request.content_type == "multipart/form-data":
+        form = await request.post()
+        field = form.get("file")
+        if not isinstance(field, web.FileField):
+            raise ValueError("missing file field")
+        params.update({key: value for key, value in form.items() if isinstance(value, str)})
+        data = field.file.read()
+    else:
+        data = await request.read()
+
+    if not data:
+        raise ValueError("empty clip")
+
+    pcm = {}
+    if "sample_rate" in params:
+        pcm = {
+            "pcm_sample_rate": int(params["sample_rate"]),
+            "pcm_channels": int(params.get("channels", 1)),
+        }
+        if pcm["pcm_sample_rate"] <= 0 or pcm["pcm_channels"] <= 0:
+            raise ValueError("sample_rate and channels must be positive")
+
+    return None, data, pcm
+
+
+async def run_in_workers(app: web.Application, function: Callable, *args, **kwargs):
+    """
+    Run a function in the worker pool, and return its result along with the metrics recorded.
+    When a worker process dies (killed by the OOM killer, crashed decoder...), the pool is broken
+    for good : it is replaced by a new one, and the function retried once.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        workers = app["workers"]
+        try:
+            return await loop.run_in_executor(
+                workers, partial(collect_metrics, function, *args, **kwargs)
+            )
+        except BrokenProcessPool:
+            # Concurrent requests see the same broken pool, only the first one replaces it
+            async with app["workers_lock"]:
+                if app["workers"] is workers:
+                    print(colored("A worker process died, restarting the workers.", color="red"))
+                    increment("service_worker_restarts_total")
+                    workers.shutdown(wait=False, cancel_futures=True)
+                    profile = await loop.run_in_executor(app["lookups"], get_catalog_profile)
+                    app["workers"] = create_worker_pool(
+                        app["nb_workers"], modules=SERVICE_MODULES, profile=profile
+                    )
+            if attempt:
+                raise
+
+
+async def process_identify(request: web.Request) -> web.Response:
+    app = request.app
+    loop = asyncio.get_running_loop()
+    start_time = time.perf_counter()
+
+    try:
+        fingerprint, data, pcm = await read_clip(request)
+    except web.HTTPRequestEntityTooLarge:
+        return error_response(413, f"Clips are limited to {MAX_UPLOAD_SIZE >> 20} MB.")
+    except (ValueError, KeyError, TypeError) as e:
+        return error_response(400, f"Invalid request : {e}")
+
+    async with app["slots"]:
+        observe("service_queue_seconds", time.perf_counter() - start_time)
+        duration = None
+
+        if fingerprint is None:
+            # Read in a lookup thread, as the profile is reloaded from the catalog once in a while
+            profile = await loop.run_in_executor(app["lookups"], get_catalog_profile)
+            try:
+                (hashes, offsets, duration), worker_metrics = await run_in_workers(
+                    app, fingerprint_clip, data, profile, **pcm
+                )
+            except BrokenProcessPool:
+                # Not necessarily the fault of the clip : other requests may have killed the workers
+                return error_response(
+                    503, "Could not process the clip, retry later.", headers={"Retry-After": "1"}
+                )
+            except Exception as e:
+                return error_response(400, f"Could not decode the clip ({type(e).__name__}).")
+            merge_metrics(worker_metrics)
+            fingerprint = fingerprint_from_hashes(hashes, offsets)
+
+        if fingerprint.check_empty():
+            matches, details = [], None
+        else:
+            matches, details = await loop.run_in_executor(app["lookups"], lookup, fingerprint)
+
+    increment("service_requests_total", status="200")
+    increment("identifications_total", result="found" if matches else "not_found")
+
+    return web.json_response(
+        {
+            "match": {**match_to_dict(matches[0]), **(details or {})} if matches else None,
+            "candidates": [match_to_dict(match) for match in matches],
+            "hashes": len(fingerprint),
+            "duration": duration,
+            "time": time.perf_counter() - start_time,
+        }
+    )
+
+
+async def identify(request: web.Request) -> web.Response:
+    app = request.app
+
+    # Backpressure : reject at once rather than queue beyond what can be served in time
+    if app["pending"] >= MAX_CONCURRENT_REQUESTS + MAX_QUEUED_REQUESTS:
+        return error_response(
+            503, "The service is overloaded, retry later.", headers={"Retry-After": "1"}
+        )
+
+    app["pending"] += 1
+    try:
+        with span("request", path="service"):
+            return await asyncio.wait_for(process_identify(request), REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        return error_response(504, f"The identification took more than {REQUEST_TIMEOUT:g} s.")
+    finally:
+        app["pending"] -= 1
+
+
+async def health(request: web.Request) -> web.Response:
+    profile = await asyncio.get_running_loop().run_in_executor(
+        request.app["lookups"], get_catalog_profile
+    )
+    return web.json_response(
+        {
+            "status": "ok",
+            "engine": MATCHING_ENGINE,
+            "profile": profile.name,
+            "pending": request.app["pending"],
+            "capacity": MAX_CONCURRENT_REQUESTS + MAX_QUEUED_REQUESTS,
+        }
+    )
+
+
+async def metrics(request: web.Request) -> web.Response:
+    if not METRICS_ENABLED:
+        raise web.HTTPNotFound()
+    return web.Response(text=registry.export_text(), content_type="text/plain")
+
+
+async def executors(app: web.Application):
+    """Starts the worker processes and the lookup threads with the app, and stops them with it."""
+    app["lookups"] = ThreadPoolExecutor(max_workers=POOL_MAX_SIZE)
+
+    # Workers are warmed up with the profile of the catalog at startup, each clip being then
+    # fingerprinted with its current profile (see PROFILE_REFRESH_INTERVAL)
+    profile = await asyncio.get_running_loop().run_in_executor(app["lookups"], get_catalog_profile)
+    app["workers"] = create_worker_pool(app["nb_workers"], modules=SERVICE_MODULES, profile=profile)
+
+    if MATCHING_ENGINE == "memory":
+        # Load the index before accepting requests rather than on the first one
+        await asyncio.get_running_loop().run_in_executor(app["lookups"], get_shared_index)
+
+    yield
+
+    app["workers"].shutdown(cancel_futures=True)
+    app["lookups"].shutdown(cancel_futures=True)
+
+
+def create_app(workers: int = SERVICE_WORKERS) -> web.Application:
+    app = web.Application(client_max_size=MAX_UPLOAD_SIZE)
+    app["nb_workers"] = workers
+    app["slots"] = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    app["workers_lock"] = asyncio.Lock()
+    app["pending"] = 0
+
+    app.cleanup_ctx.append(executors)
+    app.router.add_post("/identify", identify)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--workers", type=int, default=SERVICE_WORKERS)
+    args = parser.parse_args()
+
+    print(
+        colored(
+            f"Identification service listening on http://{args.host}:{args.port} "
+            f"({args.workers} workers, {MATCHING_ENGINE} engine)",
+            color="green",
+        )
+    )
+    web.run_app(create_app(args.workers), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
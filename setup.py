@@ -4,7 +4,20 @@ from termcolor import colored
 import __init__
 
 
-with FingerprintsDatabase() as db:
-    db.setup()
-    store_audio_folder(folder_path="data/songs", verbose=1)
+if __name__ == "__main__":
+    with FingerprintsDatabase() as db:
+        db.setup()
+
+    result = store_audio_folder(folder_path="data/songs", verbose=1)
+
+    print(
+        colored(
+            f"{len(result['stored'])} songs stored, {len(result['skipped'])} already indexed.",
+            color="green",
+        )
+    )
+
+    for file_name, error in result["failed"].items():
+        print(colored(f"{file_name} could not be stored : {error}", color="red"))
+
     print(colored("Database initialized successfully.", color="green", attrs=["bold"]))
@@ -1,7 +1,11 @@
-from typing import Union
+import io
+import hashlib
+from typing import Iterator, Optional, Union
 
 import numpy as np
-import librosa
+
+# librosa, soundfile and soxr are imported by the functions using them, so that importing this
+# module does not load the decoders.
 
 # ------------------------------------------- CONSTANTS ------------------------------------------- #
 
@@ -10,6 +14,13 @@ import librosa
 # 22050 Hz provides a balance between quality and file size, suitable for most audio applications.
 DEFAULT_SAMPLING_RATE = 22050
 
+# Default duration (in seconds) of the audio blocks decoded at once when streaming a file.
+# Memory used by the decoder depends on this duration only, not on the length of the file.
+DEFAULT_BLOCK_DURATION = 10
+
+# Size (in bytes) of the blocks read when hashing the content of a file.
+CONTENT_HASH_BLOCK_SIZE = 1 << 20
+
 
 def load_audio(
     file_path: str,
@@ -30,6 +41,8 @@ def load_audio(
     Returns:
     tuple: A tuple containing the audio data and the sampling rate.
     """
+    import librosa
+
     if offset is not None:
         total_duration = librosa.get_duration(path=file_path)
         if offset >= total_duration:
@@ -49,3 +62,143 @@ def load_audio(
         y, sr = librosa.load(file_path, sr=sr, duration=duration, offset=offset)
 
     return y, sr
+
+
+def load_audio_bytes(
+    data: bytes,
+    sr: int = DEFAULT_SAMPLING_RATE,
+    pcm_sample_rate: Optional[int] = None,
+    pcm_channels: int = 1,
+) -> tuple:
+    """
+    Decode audio held in memory (an uploaded clip) and return it downmixed to mono and resampled to 'sr' like `load_audio`.
+
+    Parameters:
+    data (bytes): The content of an audio file (WAV, FLAC, OGG, or MP3 with libsndfile >= 1.1), or raw samples.
+    sr (int, optional): The target sampling rate of the audio. Defaults to DEFAULT_SAMPLING_RATE.
+    pcm_sample_rate (int or None, optional): If set, 'data' holds raw 16-bit little-endian PCM samples at this rate instead of a file. Defaults to None.
+    pcm_channels (int, optional): The number of interleaved channels of raw PCM samples. Defaults to 1.
+
+    Returns:
+    tuple: A tuple containing the audio data and the sampling rate.
+    """
+    import soundfile as sf
+
+    if pcm_sample_rate is not None:
+        return load_pcm(
+            np.frombuffer(data, dtype="<i2"), pcm_sample_rate, sr=sr, channels=pcm_channels
+        )
+
+    y, original_sr = sf.read(io.BytesIO(data), dtype="float32", always_2d=True)
+
+    return resample(y.mean(axis=1), original_sr, sr), sr
+
+
+def load_pcm(
+    samples: np.ndarray,
+    sample_rate: int,
+    sr: int = DEFAULT_SAMPLING_RATE,
+    channels: int = 1,
+) -> tuple:
+    """
+    Convert raw 16-bit PCM samples held in memory (a microphone recording) to mono float audio at 'sr' like `load_audio`.
+    Nothing is written to disk, and the audio is only resampled if it was captured at another rate.
+
+    Parameters:
+    samples (np.ndarray): The int16 samples, interleaved if there are several channels.
+    sample_rate (int): The sampling rate the samples were captured at.
+    sr (int, optional): The target sampling rate of the audio. Defaults to DEFAULT_SAMPLING_RATE.
+    channels (int, optional): The number of interleaved channels. Defaults to 1.
+
+    Returns:
+    tuple: A tuple containing the audio data and the sampling rate.
+    """
+    samples = samples[: len(samples) - len(samples) % channels]
+    if channels == 1:
+        y = samples.astype(np.float32)
+    else:
+        y = samples.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+    y /= 32768
+
+    return resample(y, sample_rate, sr), sr
+
+
+def resample(y: np.ndarray, sample_rate: int, sr: int = DEFAULT_SAMPLING_RATE) -> np.ndarray:
+    """
+    Resample mono audio from 'sample_rate' to 'sr', as float32. The audio is returned as it is if the rates are equal.
+
+    Parameters:
+    y (np.ndarray): The audio samples.
+    sample_rate (int): The sampling rate of the samples.
+    sr (int, optional): The target sampling rate. Defaults to DEFAULT_SAMPLING_RATE.
+
+    Returns:
+    np.ndarray: The resampled audio.
+    """
+    if sample_rate != sr:
+        import soxr
+
+        y = soxr.resample(y, sample_rate, sr)
+
+    return y.astype(np.float32, copy=False)
+
+
+def get_duration(file_path: str) -> float:
+    """
+    Return the duration (in seconds) of an audio file without decoding it.
+    """
+    import librosa
+
+    return librosa.get_duration(path=file_path)
+
+
+def hash_file(file_path: str) -> str:
+    """
+    Return the SHA-256 hex digest of the content of a file, read block by block.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(CONTENT_HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stream_audio(
+    file_path: str,
+    sr: int = DEFAULT_SAMPLING_RATE,
+    block_duration: float = DEFAULT_BLOCK_DURATION,
+) -> Iterator[np.ndarray]:
+    """
+    Read an audio file block by block, downmixed to mono and resampled to 'sr' like `load_audio`.
+
+    Parameters:
+    file_path (str): The path to the audio file.
+    sr (int, optional): The target sampling rate of the audio. Defaults to DEFAULT_SAMPLING_RATE.
+    block_duration (float, optional): The duration of the blocks read at once, in seconds. Defaults to DEFAULT_BLOCK_DURATION.
+
+    Returns:
+    Iterator[np.ndarray]: The consecutive blocks of audio samples.
+    """
+    import soundfile as sf
+    import soxr
+
+    with sf.SoundFile(file_path) as f:
+        block_size = int(block_duration * f.samplerate)
+        resampler = (
+            soxr.ResampleStream(f.samplerate, sr, 1, dtype="float32")
+            if f.samplerate != sr
+            else None
+        )
+
+        while True:
+            block = f.read(block_size, dtype="float32", always_2d=True).mean(axis=1)
+            last = len(block) < block_size
+
+            if resampler is not None:
+                block = resampler.resample_chunk(block, last=last)
+
+            if len(block):
+                yield block
+
+            if last:
+                break